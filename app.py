@@ -19,6 +19,7 @@ st.set_page_config(
 if "page" not in st.session_state: st.session_state.page = "main"
 if "authenticated" not in st.session_state: st.session_state.authenticated = False
 if "results" not in st.session_state: st.session_state.results = None
+magi_core.resume_webhook_deliveries() # restart the delivery worker for anything queued before a restart
 
 # --- 3. Style & Authentication ---
 common.load_css()
@@ -0,0 +1 @@
+"""Benchmarks for the MAGI core against a local mock LLM (see `python -m bench --help`)."""
@@ -0,0 +1,93 @@
+"""Run the MAGI benchmarks against the mock LLM and write the results as JSON.
+
+Usage:
+    python -m bench -o results.json                      # every scenario
+    python -m bench --quick --scenarios single,history   # small sizes, a subset
+    python -m bench --error-rate 0.1 --ttft-ms 800 --tps 40
+    python -m bench --baseline old.json -o new.json      # print p50/p95 changes against an earlier run
+
+Provider calls never leave the machine: the personas and SEELE use the `local`
+provider, pointed at an in-process mock server (see bench/mock_llm.py).
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import platform
+import subprocess
+import sys
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from bench import mock_llm, scenarios
+
+def _git_revision() -> str:
+    try: return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5).stdout.strip() or "unknown"
+    except (OSError, subprocess.SubprocessError): return "unknown"
+
+def _percentiles(node: Any, path: str = "") -> Iterator[Tuple[str, Dict[str, float]]]:
+    """Every summarize() block in a result tree, keyed by its dotted path."""
+    if isinstance(node, dict):
+        if "p50_ms" in node: yield path, node; return
+        for k, v in node.items(): yield from _percentiles(v, f"{path}.{k}" if path else k)
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any]) -> List[str]:
+    """Lines describing how p50/p95 moved between two result files."""
+    old = dict(_percentiles(baseline.get("scenarios", {})))
+    lines = []
+    for path, now in _percentiles(current.get("scenarios", {})):
+        before = old.get(path)
+        if not before: continue
+        deltas = [f"{q} {before[q]:.1f} -> {now[q]:.1f} ms ({(now[q] - before[q]) / before[q] * 100:+.1f}%)" for q in ("p50_ms", "p95_ms") if before.get(q)]
+        if deltas: lines.append(f"{path}: " + ", ".join(deltas))
+    return lines
+
+async def _run(args: argparse.Namespace, names: List[str]) -> Dict[str, Any]:
+    mock = mock_llm.server_from_args(args)
+    base_url = await mock.start()
+    try:
+        with scenarios.isolated_workspace(base_url, args.max_concurrency):
+            results = await scenarios.run_scenarios(names, mock, args.iterations, args.users, args.pdf_pages, args.history_sizes,
+                                                    stream=not args.no_stream, on_done=lambda n: print(f"[DONE] {n}", file=sys.stderr))
+    finally:
+        await mock.stop()
+    return results
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m bench", description="Benchmark the MAGI core against a mock LLM provider.")
+    parser.add_argument("-o", "--output", help="write the JSON report here (default: stdout)")
+    parser.add_argument("--scenarios", default=",".join(scenarios.SCENARIOS), help=f"comma-separated subset of: {', '.join(scenarios.SCENARIOS)}")
+    parser.add_argument("--quick", action="store_true", help="small sizes for a smoke run")
+    parser.add_argument("--iterations", type=int, help="deliberations per user (default 5, quick 2)")
+    parser.add_argument("--users", type=int, default=10, help="concurrent users in the concurrent scenario")
+    parser.add_argument("--pdf-pages", type=int, help="pages in the large PDF (default 500, quick 50)")
+    parser.add_argument("--history-sizes", help="comma-separated history sizes (default 10000,100000; quick 1000,10000)")
+    parser.add_argument("--max-concurrency", type=int, default=8, help="in-flight limit of the local provider's scheduler")
+    parser.add_argument("--no-stream", action="store_true", help="call the provider in one shot instead of streaming")
+    parser.add_argument("--baseline", help="earlier report to compare p50/p95 against")
+    mock_llm.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    names = [n.strip() for n in args.scenarios.split(",") if n.strip()]
+    unknown = [n for n in names if n not in scenarios.SCENARIOS]
+    if unknown: parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+    args.iterations = max(1, args.iterations or (2 if args.quick else 5))
+    args.pdf_pages = max(1, args.pdf_pages or (50 if args.quick else 500))
+    args.history_sizes = [int(s) for s in (args.history_sizes or ("1000,10000" if args.quick else "10000,100000")).split(",") if s.strip()]
+
+    report = {"revision": _git_revision(), "timestamp": datetime.datetime.now().isoformat(), "python": platform.python_version(),
+              "platform": platform.platform(),
+              "settings": {k: v for k, v in vars(args).items() if k not in ("output", "baseline", "scenarios")},
+              "scenarios": asyncio.run(_run(args, names))}
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f: f.write(text + "\n")
+    else: print(text)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f: baseline = json.load(f)
+        print(f"Compared with {baseline.get('revision', '?')} ({baseline.get('timestamp', '?')}):", file=sys.stderr)
+        for line in compare(baseline, report) or ["no matching scenarios"]: print("  " + line, file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
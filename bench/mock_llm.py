@@ -0,0 +1,157 @@
+"""OpenAI-compatible mock LLM server for benchmarks.
+
+It plugs in as the `local` provider (base_url http://host:port/v1) and answers
+/v1/chat/completions with a synthetic MAGI-style opinion, either streamed as
+SSE or in one response. Time to first token follows a log-normal distribution
+(plus prefill time for prompt tokens its simulated prefix cache does not cover),
+generation runs at a fixed tokens/sec, and a share of requests can be refused
+with 429 + Retry-After.
+
+Standalone:
+    python -m bench.mock_llm --port 8900 --ttft-ms 600 --tps 60 --error-rate 0.05
+"""
+import argparse
+import asyncio
+import collections
+import hashlib
+import json
+import math
+import random
+import time
+import uuid
+from typing import Any, Dict, Optional
+
+from aiohttp import web
+
+VOTES = ("【是認】", "【条件付是認】", "【否認】")
+FILLER = ("検討", "結果", "リスク", "効率", "倫理", "確率", "判断", "計画", "影響", "合理")
+
+class MockLLMServer:
+    """In-process mock; start() returns the base_url to configure for the local provider."""
+    def __init__(self, ttft_ms: float = 300.0, ttft_sigma: float = 0.3, tokens_per_sec: float = 80.0, completion_tokens: int = 200,
+                 error_rate: float = 0.0, retry_after: float = 1.0, vote_weights: tuple = (1, 1, 1), seed: Optional[int] = None,
+                 prefill_tps: float = 0.0, prefix_cache: bool = True):
+        self.ttft_ms, self.ttft_sigma = ttft_ms, ttft_sigma
+        self.tokens_per_sec, self.completion_tokens = tokens_per_sec, completion_tokens
+        self.error_rate, self.retry_after = error_rate, retry_after
+        self.vote_weights = vote_weights
+        self.prefill_tps, self.prefix_cache = prefill_tps, prefix_cache
+        self.rng = random.Random(seed)
+        self.cached_prefixes: "collections.OrderedDict[str, float]" = collections.OrderedDict() # system prompt hash -> when its prefill is done
+        self.stats = {"requests": 0, "rate_limited": 0, "streamed": 0, "prompt_tokens": 0, "cached_prompt_tokens": 0, "completion_tokens": 0}
+        self.runner: Optional[web.AppRunner] = None
+
+    def reset_stats(self) -> None:
+        for k in self.stats: self.stats[k] = 0
+        self.cached_prefixes.clear()
+
+    def _cached_tokens(self, messages: list, prompt_tokens: int) -> int:
+        """Tokens of the system message if an identical one has already been prefilled.
+
+        Requests that arrive while the first one is still prefilling miss, as with real providers.
+        """
+        system = "".join(m.get("content") or "" for m in messages if m.get("role") == "system")
+        if not self.prefix_cache or not system: return 0
+        key, now = hashlib.sha256(system.encode("utf-8")).hexdigest(), time.monotonic()
+        ready = self.cached_prefixes.get(key)
+        if ready is None:
+            self.cached_prefixes[key] = now + (prompt_tokens / self.prefill_tps if self.prefill_tps else 0.0)
+            while len(self.cached_prefixes) > 256: self.cached_prefixes.popitem(last=False)
+            return 0
+        self.cached_prefixes.move_to_end(key)
+        return len(system) // 4 if ready <= now else 0
+
+    def _ttft(self) -> float:
+        if self.ttft_sigma <= 0: return self.ttft_ms / 1000
+        return self.rng.lognormvariate(math.log(max(self.ttft_ms, 1) / 1000), self.ttft_sigma)
+
+    def _tokens(self) -> list:
+        body = [self.rng.choice(FILLER) for _ in range(max(1, self.completion_tokens - 8))]
+        vote = self.rng.choices(VOTES, weights=self.vote_weights)[0]
+        return ["理由: "] + body + ["\n条件: ", "なし", "\n結論: ", vote]
+
+    async def completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.stats["requests"] += 1
+        if self.error_rate and self.rng.random() < self.error_rate:
+            self.stats["rate_limited"] += 1
+            return web.json_response({"error": {"message": "Rate limit exceeded (mock 429)", "type": "rate_limit_exceeded"}},
+                                     status=429, headers={"retry-after": str(self.retry_after)})
+        prompt_tokens = sum(len(m.get("content") or "") for m in body.get("messages", [])) // 4
+        cached = min(prompt_tokens, self._cached_tokens(body.get("messages", []), prompt_tokens))
+        tokens = self._tokens()
+        self.stats["prompt_tokens"] += prompt_tokens
+        self.stats["cached_prompt_tokens"] += cached
+        self.stats["completion_tokens"] += len(tokens)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens), "total_tokens": prompt_tokens + len(tokens),
+                 "prompt_tokens_details": {"cached_tokens": cached}}
+        cid, model, created = f"chatcmpl-{uuid.uuid4().hex[:12]}", body.get("model", "mock"), int(time.time())
+        prefill = (prompt_tokens - cached) / self.prefill_tps if self.prefill_tps else 0.0
+        await asyncio.sleep(self._ttft() + prefill)
+
+        if not body.get("stream"):
+            await asyncio.sleep(len(tokens) / self.tokens_per_sec)
+            return web.json_response({"id": cid, "object": "chat.completion", "created": created, "model": model, "usage": usage,
+                                      "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "".join(tokens)}}]})
+
+        self.stats["streamed"] += 1
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await resp.prepare(request)
+        async def send(payload: Dict[str, Any]) -> None:
+            await resp.write(f"data: {json.dumps({'id': cid, 'object': 'chat.completion.chunk', 'created': created, 'model': model, **payload}, ensure_ascii=False)}\n\n".encode("utf-8"))
+        step = 5 # tokens per chunk
+        for i in range(0, len(tokens), step):
+            if i: await asyncio.sleep(step / self.tokens_per_sec)
+            await send({"choices": [{"index": 0, "delta": {"content": "".join(tokens[i:i + step])}, "finish_reason": None}]})
+        # Like vLLM and llama.cpp, report usage on the last chunk even when stream_options did not ask for it
+        await send({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage})
+        if (body.get("stream_options") or {}).get("include_usage"): await send({"choices": [], "usage": usage})
+        await resp.write(b"data: [DONE]\n\n")
+        await resp.write_eof()
+        return resp
+
+    async def models(self, request: web.Request) -> web.Response:
+        return web.json_response({"object": "list", "data": [{"id": "mock-model", "object": "model", "owned_by": "bench"}]})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes([web.post("/v1/chat/completions", self.completions), web.get("/v1/models", self.models)])
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self.runner = web.AppRunner(self.app(), access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        bound = self.runner.addresses[0][1]
+        return f"http://{host}:{bound}/v1"
+
+    async def stop(self) -> None:
+        if self.runner: await self.runner.cleanup(); self.runner = None
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Mock behaviour options, shared with the benchmark runner."""
+    parser.add_argument("--ttft-ms", type=float, default=300.0, help="median time to first token")
+    parser.add_argument("--ttft-sigma", type=float, default=0.3, help="log-normal spread of the TTFT (0 = fixed)")
+    parser.add_argument("--tps", type=float, default=80.0, help="generation speed in tokens/sec")
+    parser.add_argument("--completion-tokens", type=int, default=200)
+    parser.add_argument("--prefill-tps", type=float, default=0.0, help="prompt tokens/sec added to the TTFT for uncached prompt tokens (0 = free)")
+    parser.add_argument("--no-prefix-cache", action="store_true", help="never report a system prompt as cached")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with injected 429s")
+    parser.add_argument("--seed", type=int, default=None)
+
+def server_from_args(args: argparse.Namespace) -> MockLLMServer:
+    return MockLLMServer(args.ttft_ms, args.ttft_sigma, args.tps, args.completion_tokens, args.error_rate, args.retry_after, seed=args.seed,
+                         prefill_tps=args.prefill_tps, prefix_cache=not args.no_prefix_cache)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve a mock OpenAI-compatible LLM for MAGI benchmarks.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    add_arguments(parser)
+    args = parser.parse_args()
+    web.run_app(server_from_args(args).app(), host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""Benchmark scenarios: each returns a JSON-serialisable dict of timings.
+
+Everything runs against a throwaway workspace (personas, api_keys, users and the
+SQLite stores all point into a temp dir), so benchmarks never touch real data
+and every run starts cold.
+"""
+import asyncio
+import contextlib
+import datetime
+import os
+import random
+import shutil
+import tempfile
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import magi_core
+
+from bench.mock_llm import MockLLMServer
+
+STORE_PATHS = ("PERSONA_PATH", "API_KEYS_PATH", "HISTORY_PATH", "TEMPLATES_PATH", "USERS_PATH", "WEBHOOKS_PATH", "SESSIONS_PATH", "CACHE_DB_PATH", "DB_PATH")
+MOCK_MODEL = "mock-model"
+QUESTION = "第3新東京市の防衛予算を20%増額し、迎撃システムの更新に充てるべきか。"
+PERSONA_PROMPTS = {
+    "MELCHIOR": ("MELCHIOR-1", "あなたは科学者としての赤木ナオコです。論理と合理性に基づいて判断してください。"),
+    "BALTHASAR": ("BALTHASAR-2", "あなたは母としての赤木ナオコです。人命と倫理を重視して判断してください。"),
+    "CASPER": ("CASPER-3", "あなたは女としての赤木ナオコです。直感と感情に基づいて判断してください。"),
+}
+
+@contextlib.contextmanager
+def isolated_workspace(base_url: str, max_concurrency: int = 8) -> Iterator[str]:
+    """Point every magi_core store at a temp dir whose personas and SEELE all use the mock via the local provider."""
+    saved = {name: getattr(magi_core, name) for name in STORE_PATHS}
+    workdir = tempfile.mkdtemp(prefix="magi-bench-")
+    try:
+        for name in STORE_PATHS: setattr(magi_core, name, os.path.join(workdir, os.path.basename(saved[name])))
+        config = magi_core.load_api_config()
+        config["seele_model"] = {"provider": "local", "name": MOCK_MODEL}
+        config["response_cache"]["enabled"] = False # every call has to reach the mock
+        config["early_exit"]["enabled"] = False
+        config["providers"]["local"] = {"api_key": "not-needed", "base_url": base_url, "models": [MOCK_MODEL],
+                                        "limits": {"rpm": 0, "tpm": 0, "max_concurrency": max_concurrency}}
+        magi_core.save_api_config(config)
+        magi_core.save_persona_config({pid: {"name": name, "prompt": prompt, "model_provider": "local", "model_name": MOCK_MODEL, "temperature": 0.7}
+                                       for pid, (name, prompt) in PERSONA_PROMPTS.items()})
+        yield workdir
+    finally:
+        for name, path in saved.items(): setattr(magi_core, name, path)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    """count, mean and p50/p90/p95/p99/max in milliseconds."""
+    if not samples: return {"count": 0}
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+    ms = lambda v: round(v * 1000, 3)
+    return {"count": len(ordered), "mean_ms": ms(sum(ordered) / len(ordered)), "p50_ms": ms(pick(0.5)), "p90_ms": ms(pick(0.9)),
+            "p95_ms": ms(pick(0.95)), "p99_ms": ms(pick(0.99)), "max_ms": ms(ordered[-1])}
+
+def time_calls(fn: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter(); fn(); samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+# --- Deliberations ---
+
+async def _one_deliberation(question: str, context: str, debate: bool, stream: bool, exchange: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    started = time.perf_counter()
+    first = None
+    policy = {"enabled": False}
+    if stream:
+        final: Dict[str, Any] = {}
+        async for event in magi_core.ask_magi_system_stream(question, context, debate, True, stream=True, early_exit=policy, exchange=exchange):
+            if first is None and event["type"] == "chunk": first = time.perf_counter() - started
+            if event["type"] == "done": final = event
+    else:
+        final = await magi_core.ask_magi_system(question, context, debate, True, early_exit=policy, exchange=exchange)
+    failed = any(r[1].startswith("AI Error") for r in final["magi_results"]) or final["seele_summary"].startswith("【警告】")
+    return {"seconds": time.perf_counter() - started, "first_chunk": first, "failed": failed, "debate": final.get("debate") or {}}
+
+async def run_deliberations(mock: MockLLMServer, users: int, per_user: int, debate: bool = False, stream: bool = True, context: str = "",
+                            exchange: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """`users` concurrent clients, each running `per_user` deliberations back to back."""
+    mock.reset_stats()
+    magi_core.reset_metrics()
+    runs: List[Dict[str, Any]] = []
+
+    async def user(n: int) -> None:
+        for i in range(per_user): runs.append(await _one_deliberation(f"{QUESTION} (user {n}, run {i})", context, debate, stream, exchange))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(n) for n in range(users)))
+    wall = time.perf_counter() - started
+    out = {"users": users, "deliberations": len(runs), "debate": debate, "stream": stream, "wall_seconds": round(wall, 3),
+           "throughput_per_min": round(len(runs) / wall * 60, 2) if wall else 0.0, "failed": sum(r["failed"] for r in runs),
+           "latency": summarize([r["seconds"] for r in runs]), "mock": dict(mock.stats), "personas": magi_core.get_persona_metrics()}
+    if stream: out["first_chunk"] = summarize([r["first_chunk"] for r in runs if r["first_chunk"] is not None])
+    rounds = [r["debate"] for r in runs if len(r["debate"].get("round_seconds", [])) == 2]
+    if rounds:
+        out["round_two"] = summarize([d["round_seconds"][1] for d in rounds])
+        out["opinion_tokens_mean"] = round(sum(d["opinion_tokens"] for d in rounds) / len(rounds), 1)
+        out["full_text_opinion_tokens_mean"] = round(sum(d["full_text_opinion_tokens"] for d in rounds) / len(rounds), 1)
+    return out
+
+DEBATE_EXCHANGES = {
+    "full": {"mode": "full", "exclude_self": False},
+    "full_exclude_self": {"mode": "full", "exclude_self": True},
+    "digest": {"mode": "digest", "exclude_self": False},
+    "digest_exclude_self": {"mode": "digest", "exclude_self": True},
+}
+
+async def run_debate_exchange(mock: MockLLMServer, iterations: int, stream: bool = True) -> Dict[str, Any]:
+    """Debate runs under each opinion exchange strategy, with round-two latency and prompt tokens relative to full text."""
+    out = {name: await run_deliberations(mock, 1, iterations, debate=True, stream=stream, exchange=ex) for name, ex in DEBATE_EXCHANGES.items()}
+    full = out["full"]
+    for res in out.values():
+        res["prompt_tokens_vs_full"] = round(res["mock"]["prompt_tokens"] / full["mock"]["prompt_tokens"], 3) if full["mock"]["prompt_tokens"] else None
+        res["round_two_p50_vs_full"] = round(res["round_two"]["p50_ms"] / full["round_two"]["p50_ms"], 3) if full.get("round_two", {}).get("p50_ms") and res.get("round_two") else None
+    return out
+
+# --- Attachments ---
+
+def make_pdf(pages: int, lines_per_page: int = 45, seed: int = 0) -> bytes:
+    """A plain text PDF with `pages` pages of filler sentences, built without any PDF writer dependency."""
+    rng = random.Random(seed)
+    words = ("angel", "defense", "budget", "pilot", "synchronization", "barrier", "entry", "plug", "unit", "nerv", "seele", "geofront", "risk", "cost")
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for p in range(pages):
+        lines = [f"Page {p + 1}."] + [" ".join(rng.choice(words) for _ in range(12)) + "." for _ in range(lines_per_page)]
+        text = " T* ".join(f"({line}) Tj" for line in lines)
+        stream = f"BT /F1 9 Tf 11 TL 40 800 Td {text} ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents {len(objects)} 0 R /Resources << /Font << /F1 3 0 R >> >> >>")
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>"
+    out, offsets = bytearray(b"%PDF-1.4\n"), []
+    for n, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{n} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    out += "".join(f"{o:010d} 00000 n \n" for o in offsets).encode("latin-1")
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1")
+    return bytes(out)
+
+async def run_large_pdf(mock: MockLLMServer, pages: int, iterations: int) -> Dict[str, Any]:
+    """Extraction (cold, then from the page cache), context selection, parsing and deliberations on the extracted text."""
+    pdf = make_pdf(pages)
+    started = time.perf_counter()
+    text = await asyncio.to_thread(magi_core.extract_text_from_file, pdf, "bench.pdf")
+    cold = time.perf_counter() - started
+    warm = await asyncio.to_thread(time_calls, lambda: magi_core.extract_text_from_file(pdf, "bench.pdf"), max(3, iterations))
+    select = await asyncio.to_thread(time_calls, lambda: magi_core.select_context(text, QUESTION, magi_core.DEFAULT_CONTEXT_BUDGET), max(3, iterations))
+    sample = "理由: " + text[:4000] + "\n条件: 予算の段階的執行\n結論: 【条件付是認】"
+    parse = time_calls(lambda: magi_core.parse_response("MELCHIOR-1", sample), 1000)
+    return {"pages": pages, "pdf_bytes": len(pdf), "text_chars": len(text), "extract_cold_ms": round(cold * 1000, 3),
+            "extract_cached": warm, "select_context": select, "parse_response": parse,
+            "deliberation": await run_deliberations(mock, 1, iterations, context=text)}
+
+# --- Stores ---
+
+def _synthetic_entry(n: int, now: datetime.datetime, rng: random.Random) -> Dict[str, Any]:
+    ts = now - datetime.timedelta(seconds=rng.randrange(365 * 86400))
+    votes = [rng.choice(("是認", "条件付是認", "否認")) for _ in magi_core.MAGI_UNITS]
+    return {"id": f"bench_{n:08d}", "timestamp": ts.isoformat(), "user_id": f"user{n % 50}", "question": f"{QUESTION} #{n}", "file_name": "",
+            "results": [{"name": f"{u}-{i + 1}", "reason": "理由: " + "検討" * 200, "vote": v, "condition": ""}
+                        for i, (u, v) in enumerate(zip(magi_core.MAGI_UNITS, votes))],
+            "final_score": magi_core.vote_score([(None, None, v) for v in votes]), "seele_summary": "総括" * 100}
+
+def seed_history(entries: int, seed: int = 0) -> float:
+    """Bulk-insert synthetic entries spread over the last year in one transaction; returns the seconds taken."""
+    rng, now = random.Random(seed), datetime.datetime.now()
+    conn = magi_core._history_db()
+    try:
+        started = time.perf_counter()
+        for n in range(entries): magi_core._insert_history(conn, _synthetic_entry(n, now, rng))
+        conn.commit()
+        return time.perf_counter() - started
+    finally: conn.close()
+
+def run_history(size: int, repeat: int) -> Dict[str, Any]:
+    """Read and write latency of the history store once it holds `size` entries."""
+    magi_core.clear_history()
+    seconds = seed_history(size)
+    results = [("MELCHIOR-1", "理由: 問題なし", "是認", ""), ("BALTHASAR-2", "理由: 要検討", "条件付是認", "段階実施"), ("CASPER-3", "理由: 反対", "否認", "")]
+    month_ago = (datetime.date.today() - datetime.timedelta(days=30)).isoformat()
+    return {"entries": size, "seed_seconds": round(seconds, 3), "seed_rows_per_sec": round(size / seconds, 1) if seconds else 0.0,
+            "add_history_with_user": time_calls(lambda: magi_core.add_history_with_user("bench", QUESTION, results, 0, "総括"), repeat),
+            "query_first_page": time_calls(lambda: magi_core.query_history(limit=20), repeat),
+            "query_deep_page": time_calls(lambda: magi_core.query_history(limit=20, offset=size // 2), repeat),
+            "query_user_page": time_calls(lambda: magi_core.query_history("user7", limit=20), repeat),
+            "count_history": time_calls(magi_core.count_history, repeat),
+            "analytics_all_time": time_calls(magi_core.get_analytics, repeat),
+            "analytics_30_days": time_calls(lambda: magi_core.get_analytics(start_day=month_ago), repeat)}
+
+def run_json_stores(users: int, repeat: int) -> Dict[str, Any]:
+    """load_json/read_json/save_json on a users.json with `users` accounts: cached copies, shared views, cold reads and atomic writes."""
+    path = magi_core.USERS_PATH
+    data = {"users": {f"user{n}": {"password": "pbkdf2_sha256$1$00$00", "name": f"User {n}", "role": "Operator"} for n in range(users)}}
+    magi_core.save_json(path, data)
+    def cold_load() -> None:
+        with magi_core._JSON_CACHE_LOCK: magi_core._JSON_CACHE.pop(path, None)
+        magi_core.load_json(path, {})
+    return {"users": users, "bytes": os.path.getsize(path), "load_cached": time_calls(lambda: magi_core.load_json(path, {}), repeat),
+            "read_shared": time_calls(lambda: magi_core.read_json(path, {}), repeat), "api_settings": time_calls(magi_core.api_settings, repeat),
+            "load_cold": time_calls(cold_load, repeat), "save": time_calls(lambda: magi_core.save_json(path, data), repeat)}
+
+# --- Registry ---
+
+SCENARIOS = ("single", "debate", "debate_exchange", "concurrent", "large_pdf", "history", "stores")
+
+async def run_scenarios(names: List[str], mock: MockLLMServer, iterations: int, users: int, pdf_pages: int, history_sizes: List[int],
+                        stream: bool = True, on_done: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+    """Run the named scenarios in order against an already started mock; returns results keyed by scenario."""
+    out: Dict[str, Any] = {}
+    for name in names:
+        if name == "single": out[name] = await run_deliberations(mock, 1, iterations, stream=stream)
+        elif name == "debate": out[name] = await run_deliberations(mock, 1, iterations, debate=True, stream=stream)
+        elif name == "debate_exchange": out[name] = await run_debate_exchange(mock, iterations, stream=stream)
+        elif name == "concurrent": out[name] = await run_deliberations(mock, users, iterations, stream=stream)
+        elif name == "large_pdf": out[name] = await run_large_pdf(mock, pdf_pages, iterations)
+        elif name == "history": out[name] = {str(size): await asyncio.to_thread(run_history, size, max(20, iterations * 10)) for size in history_sizes}
+        elif name == "stores": out[name] = {str(n): await asyncio.to_thread(run_json_stores, n, max(20, iterations * 10)) for n in (100, 1000, 10000)}
+        else: raise ValueError(f"Unknown scenario: {name}")
+        if on_done: on_done(name)
+    return out
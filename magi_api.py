@@ -0,0 +1,230 @@
+"""HTTP API for MAGI deliberations, for services that cannot drive the Streamlit UI.
+
+Run next to the UI (see docker-compose.yml):
+    python magi_api.py --host 0.0.0.0 --port 8600
+
+Endpoints (all but login take "Authorization: Bearer <session token>"):
+    POST /v1/sessions                     {"username", "password"} -> {"token"}
+    POST /v1/deliberations                {"question", "context"?, "file_name"?, "file_base64"?, "pages"?,
+                                           "debate"?, "synthesis"?} -> 202 {"id", "status"}; 429 when the queue is full
+    GET  /v1/deliberations/{id}           status, plus the result once done
+    GET  /v1/deliberations/{id}/events    Server-Sent Events: the ask_magi_system_stream events, replayed from the start
+                                          (or from Last-Event-ID) and then live
+    GET  /metrics                         provider metrics in Prometheus text format (unauthenticated, like /health)
+
+Tokens are the same ones create_session issues to the UI. Work is queued to a
+bounded pool of workers; finished jobs are kept for JOB_TTL seconds.
+"""
+import argparse
+import asyncio
+import base64
+import binascii
+import json
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+import magi_core
+
+DEFAULT_WORKERS = 4
+DEFAULT_QUEUE_SIZE = 32
+JOB_TTL = 3600 # seconds a finished job stays pollable
+MAX_BODY_BYTES = 50 * 1024 * 1024
+PRIVILEGED_ROLES = ("Commander", "Sub-Commander")
+
+class ApiJob:
+    """One queued deliberation and the events it has produced so far."""
+    def __init__(self, user: Dict[str, str], params: Dict[str, Any]):
+        self.id = uuid.uuid4().hex
+        self.user = user
+        self.params = params
+        self.status = "queued"
+        self.events: List[Dict[str, Any]] = []
+        self.result: Optional[Dict[str, Any]] = None
+        self.error = ""
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.changed = asyncio.Condition()
+
+    async def publish(self, event: Dict[str, Any]) -> None:
+        async with self.changed:
+            self.events.append(event)
+            self.changed.notify_all()
+
+    async def finish(self, status: str, error: str = "") -> None:
+        async with self.changed:
+            self.status, self.error, self.finished_at = status, error, time.time()
+            self.changed.notify_all()
+
+    def finished(self) -> bool:
+        return self.status in ("done", "error")
+
+    def summary(self) -> Dict[str, Any]:
+        out = {"id": self.id, "status": self.status, "question": self.params["question"], "created_at": self.created_at, "finished_at": self.finished_at}
+        if self.result is not None: out["result"] = self.result
+        if self.error: out["error"] = self.error
+        return out
+
+async def run_job(job: ApiJob) -> None:
+    """Execute a deliberation, publishing its stream events and recording it to history."""
+    p = job.params
+    job.status = "running"
+    trace = magi_core.Trace()
+    try:
+        context = p["context"]
+        # Take the upload out of the job so it is not held for JOB_TTL once the text is extracted
+        content, p["file_content"] = p["file_content"], None
+        if content is not None:
+            with trace.span("SYSTEM", "extract"):
+                context = await asyncio.to_thread(magi_core.extract_text_from_file, content, p["file_name"], p["page_range"])
+            del content
+        async for event in magi_core.ask_magi_system_stream(p["question"], context, p["debate"], p["synthesis"], p["file_name"], trace=trace):
+            if event["type"] == "done":
+                job.result = {k: event[k] for k in ("magi_results", "final_score", "seele_summary", "early_exit", "debate")}
+            await job.publish(event)
+        await asyncio.to_thread(magi_core.add_history_with_user, job.user["username"], p["question"], job.result["magi_results"],
+                                job.result["final_score"], job.result["seele_summary"], p["file_name"], trace)
+        await job.finish("done")
+    except Exception as e:
+        await job.publish({"type": "error", "error": f"{type(e).__name__}: {e}"})
+        await job.finish("error", f"{type(e).__name__}: {e}")
+
+async def _worker(app: web.Application) -> None:
+    queue: asyncio.Queue = app["runtime"]["queue"]
+    while True:
+        job = await queue.get()
+        try: await run_job(job)
+        finally: queue.task_done()
+
+def _prune_jobs(jobs: Dict[str, ApiJob]) -> None:
+    cutoff = time.time() - JOB_TTL
+    for jid in [jid for jid, j in jobs.items() if j.finished_at and j.finished_at < cutoff]: del jobs[jid]
+
+def _json_error(status: int, message: str, **headers: str) -> web.Response:
+    return web.json_response({"error": message}, status=status, headers=headers or None)
+
+async def _json_body(request: web.Request) -> Optional[Dict[str, Any]]:
+    """The request body as a JSON object, or None if it is not one."""
+    try: body = await request.json()
+    except (json.JSONDecodeError, UnicodeDecodeError): return None
+    return body if isinstance(body, dict) else None
+
+async def _authenticate(request: web.Request) -> Optional[Dict[str, str]]:
+    header = request.headers.get("Authorization", "")
+    token = header[7:].strip() if header.lower().startswith("bearer ") else ""
+    return await asyncio.to_thread(magi_core.validate_session, token) if token else None
+
+def _visible_job(request: web.Request, user: Dict[str, str]) -> Optional[ApiJob]:
+    """A job the caller may see: their own, or anyone's for privileged roles (as in the LOGS page)."""
+    job = request.app["jobs"].get(request.match_info["job_id"])
+    if job and (job.user["username"] == user["username"] or user.get("role") in PRIVILEGED_ROLES): return job
+    return None
+
+async def login(request: web.Request) -> web.Response:
+    body = await _json_body(request)
+    if body is None: return _json_error(400, "Body must be a JSON object.")
+    user = await asyncio.to_thread(magi_core.authenticate_user, str(body.get("username", "")), str(body.get("password", "")))
+    if not user: return _json_error(401, "Invalid credentials.")
+    token = await asyncio.to_thread(magi_core.create_session, user)
+    return web.json_response({"token": token, "user": user})
+
+async def submit(request: web.Request) -> web.Response:
+    user = await _authenticate(request)
+    if not user: return _json_error(401, "Missing or invalid session token.")
+    body = await _json_body(request)
+    if body is None: return _json_error(400, "Body must be a JSON object.")
+    question = str(body.get("question", "")).strip()
+    if not question: return _json_error(400, "'question' is required.")
+    file_content = None
+    if body.get("file_base64"):
+        try: file_content = base64.b64decode(body["file_base64"], validate=True)
+        except (binascii.Error, ValueError): return _json_error(400, "'file_base64' is not valid base64.")
+    try: page_range = magi_core.parse_page_range(str(body.get("pages", "")))
+    except ValueError as e: return _json_error(400, str(e))
+    params = {"question": question, "context": str(body.get("context", "")), "file_name": str(body.get("file_name", "")), "file_content": file_content,
+              "page_range": page_range, "debate": bool(body.get("debate", False)), "synthesis": bool(body.get("synthesis", True))}
+
+    jobs: Dict[str, ApiJob] = request.app["jobs"]
+    _prune_jobs(jobs)
+    job = ApiJob(user, params)
+    try: request.app["runtime"]["queue"].put_nowait(job)
+    except asyncio.QueueFull:
+        return _json_error(429, "Deliberation queue is full; retry later.", **{"Retry-After": "30"})
+    jobs[job.id] = job
+    return web.json_response({"id": job.id, "status": job.status}, status=202, headers={"Location": f"/v1/deliberations/{job.id}"})
+
+async def poll(request: web.Request) -> web.Response:
+    user = await _authenticate(request)
+    if not user: return _json_error(401, "Missing or invalid session token.")
+    job = _visible_job(request, user)
+    if not job: return _json_error(404, "No such deliberation.")
+    return web.json_response(job.summary())
+
+async def events(request: web.Request) -> web.StreamResponse:
+    user = await _authenticate(request)
+    if not user: return _json_error(401, "Missing or invalid session token.")
+    job = _visible_job(request, user)
+    if not job: return _json_error(404, "No such deliberation.")
+    try: sent = int(request.headers.get("Last-Event-ID", -1)) + 1
+    except ValueError: sent = 0
+
+    resp = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    await resp.prepare(request)
+    while True:
+        async with job.changed:
+            await job.changed.wait_for(lambda: len(job.events) > sent or job.finished())
+            pending, finished = job.events[sent:], job.finished()
+        for event in pending:
+            await resp.write(f"id: {sent}\nevent: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+            sent += 1
+        if finished and sent >= len(job.events): break
+    await resp.write_eof()
+    return resp
+
+async def metrics(request: web.Request) -> web.Response:
+    return web.Response(text=magi_core.render_prometheus(), content_type="text/plain", headers={"X-Content-Type-Options": "nosniff"})
+
+async def health(request: web.Request) -> web.Response:
+    runtime = request.app["runtime"]
+    return web.json_response({"status": "ok", "queued": runtime["queue"].qsize(), "queue_size": runtime["queue"].maxsize, "workers": len(runtime["workers"])})
+
+def create_app(workers: int = DEFAULT_WORKERS, queue_size: int = DEFAULT_QUEUE_SIZE) -> web.Application:
+    """Build the API application; workers start with the app and stop on shutdown."""
+    app = web.Application(client_max_size=MAX_BODY_BYTES)
+    app["jobs"] = {}
+    app["runtime"] = {"queue": None, "workers": []} # filled on startup, inside the serving loop
+
+    async def start_workers(app: web.Application) -> None:
+        runtime = app["runtime"]
+        runtime["queue"] = asyncio.Queue(maxsize=queue_size)
+        runtime["workers"] = [asyncio.create_task(_worker(app)) for _ in range(workers)]
+
+    async def stop_workers(app: web.Application) -> None:
+        for t in app["runtime"]["workers"]: t.cancel()
+        await asyncio.gather(*app["runtime"]["workers"], return_exceptions=True)
+
+    app.on_startup.append(start_workers)
+    app.on_cleanup.append(stop_workers)
+    app.add_routes([
+        web.get("/health", health),
+        web.get("/metrics", metrics),
+        web.post("/v1/sessions", login),
+        web.post("/v1/deliberations", submit),
+        web.get("/v1/deliberations/{job_id}", poll),
+        web.get("/v1/deliberations/{job_id}/events", events),
+    ])
+    return app
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve MAGI deliberations over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8600)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="deliberations run at once")
+    parser.add_argument("--queue-size", type=int, default=DEFAULT_QUEUE_SIZE, help="waiting deliberations before 429")
+    args = parser.parse_args()
+    web.run_app(create_app(max(1, args.workers), max(1, args.queue_size)), host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()
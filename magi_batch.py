@@ -0,0 +1,145 @@
+"""Headless batch deliberation: push a file of topics through MAGI without the UI.
+
+Usage:
+    python magi_batch.py topics.jsonl -o results.jsonl --concurrency 4 --rpm 20
+
+Input is JSONL (one object per line) or CSV with the fields:
+    topic        (required; "question" is accepted too)
+    id           (optional; defaults to the row number)
+    attachments  (optional; path, or list of paths / ';'-separated in CSV)
+    pages        (optional; PDF page range such as "1-50")
+    debate, synthesis (optional; override the command-line defaults)
+
+Each finished topic is appended to the output JSONL and recorded in the history
+store under the batch user id. Completed ids go to a checkpoint file, so an
+interrupted run picks up where it stopped when started again with the same arguments.
+"""
+import argparse
+import asyncio
+import csv
+import datetime
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional, Set
+
+import magi_core
+
+def _flag(value: Any, default: bool) -> bool:
+    if value is None or value == "": return default
+    if isinstance(value, bool): return value
+    return str(value).strip().lower() in ("1", "true", "yes", "on")
+
+def load_topics(path: str) -> List[Dict[str, Any]]:
+    """Read topics from a .csv file or JSONL, normalising each into a job description."""
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        if path.lower().endswith(".csv"): rows = list(csv.DictReader(f))
+        else: rows = [json.loads(line) for line in f if line.strip()]
+    topics = []
+    for n, row in enumerate(rows, start=1):
+        topic = (row.get("topic") or row.get("question") or "").strip()
+        if not topic: raise ValueError(f"{path}: row {n} has no topic")
+        attachments = row.get("attachments", row.get("attachment")) or []
+        if isinstance(attachments, str): attachments = [p.strip() for p in attachments.split(";") if p.strip()]
+        try: magi_core.parse_page_range(row.get("pages") or "")
+        except ValueError as e: raise ValueError(f"{path}: row {n}: {e}")
+        topics.append({"id": str(row.get("id") or n), "topic": topic, "attachments": attachments, "pages": row.get("pages") or "",
+                       "debate": row.get("debate"), "synthesis": row.get("synthesis")})
+    ids = [t["id"] for t in topics]
+    if len(set(ids)) != len(ids): raise ValueError(f"{path}: duplicate ids")
+    return topics
+
+def load_checkpoint(path: str) -> Set[str]:
+    if not os.path.exists(path): return set()
+    with open(path, "r", encoding="utf-8") as f: return {line.rstrip("\n") for line in f if line.strip()}
+
+def _read_attachments(paths: List[str], pages: str) -> Dict[str, str]:
+    """Extract every attachment, returning the joined context and a display name."""
+    page_range = magi_core.parse_page_range(pages)
+    texts, names = [], []
+    for p in paths:
+        with open(p, "rb") as f: content = f.read()
+        name = os.path.basename(p)
+        text = magi_core.extract_text_from_file(content, name, page_range)
+        texts.append(f"=== {name} ===\n{text}" if len(paths) > 1 else text)
+        names.append(name)
+    return {"context": "\n\n".join(texts), "file_name": ", ".join(names)}
+
+class BatchRunner:
+    """Runs topics concurrently under a shared budget and persists each result as it lands."""
+    def __init__(self, output: str, checkpoint: str, user_id: str, concurrency: int, rpm: int, debate: bool, synthesis: bool, record_history: bool = True):
+        self.output, self.checkpoint = output, checkpoint
+        self.user_id = user_id
+        self.concurrency, self.rpm = concurrency, rpm
+        self.debate, self.synthesis = debate, synthesis
+        self.record_history = record_history
+        self.stats = {"done": 0, "failed": 0, "skipped": 0}
+
+    def _persist(self, record: Dict[str, Any]) -> None:
+        # Runs on the loop thread only, so lines from concurrent topics never interleave
+        with open(self.output, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush(); os.fsync(f.fileno())
+        if record["status"] == "ok":
+            with open(self.checkpoint, "a", encoding="utf-8") as f:
+                f.write(record["id"] + "\n"); f.flush(); os.fsync(f.fileno())
+
+    async def _run_one(self, item: Dict[str, Any], budget: magi_core.ProviderScheduler) -> None:
+        async with budget.slot(0):
+            started = time.perf_counter()
+            record: Dict[str, Any] = {"id": item["id"], "topic": item["topic"]}
+            trace = magi_core.Trace()
+            try:
+                material = {"context": "", "file_name": ""}
+                if item["attachments"]:
+                    with trace.span("SYSTEM", "extract"): material = await asyncio.to_thread(_read_attachments, item["attachments"], item["pages"])
+                res = await magi_core.ask_magi_system(item["topic"], material["context"], _flag(item["debate"], self.debate), _flag(item["synthesis"], self.synthesis), material["file_name"], trace=trace)
+                if self.record_history:
+                    await asyncio.to_thread(magi_core.add_history_with_user, self.user_id, item["topic"], res["magi_results"], res["final_score"], res["seele_summary"], material["file_name"], trace)
+                record.update(status="ok", file_name=material["file_name"], **res)
+                self.stats["done"] += 1
+            except Exception as e:
+                record.update(status="error", error=f"{type(e).__name__}: {e}")
+                self.stats["failed"] += 1
+            record.update(elapsed=round(time.perf_counter() - started, 3), finished_at=datetime.datetime.now().isoformat())
+            self._persist(record)
+            print(f"[{record['status'].upper()}] {item['id']} ({record['elapsed']:.1f}s) {item['topic'][:40]}", file=sys.stderr)
+
+    async def run(self, topics: List[Dict[str, Any]]) -> Dict[str, int]:
+        done = load_checkpoint(self.checkpoint)
+        todo = [t for t in topics if t["id"] not in done]
+        self.stats["skipped"] = len(topics) - len(todo)
+        if self.stats["skipped"]: print(f"Resuming: {self.stats['skipped']} topic(s) already in {self.checkpoint}", file=sys.stderr)
+        # rpm paces deliberation starts; the per-provider schedulers still pace the calls inside them
+        budget = magi_core.ProviderScheduler(rpm=self.rpm, max_concurrency=self.concurrency)
+        await asyncio.gather(*(self._run_one(t, budget) for t in todo))
+        return self.stats
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Run a batch of topics through the MAGI system.")
+    parser.add_argument("input", help="topics file (.jsonl or .csv)")
+    parser.add_argument("-o", "--output", help="results JSONL (default: <input>.results.jsonl)")
+    parser.add_argument("--checkpoint", help="completed-id file (default: <output>.checkpoint)")
+    parser.add_argument("--user-id", default="batch", help="history user id for recorded results (default: batch)")
+    parser.add_argument("--concurrency", type=int, default=4, help="deliberations in flight at once")
+    parser.add_argument("--rpm", type=int, default=0, help="deliberations started per minute (0 = unlimited)")
+    parser.add_argument("--debate", action="store_true", help="run the debate round by default")
+    parser.add_argument("--no-synthesis", action="store_true", help="skip SEELE synthesis by default")
+    parser.add_argument("--no-history", action="store_true", help="do not record results in the history store")
+    parser.add_argument("--metrics", help="write provider metrics (Prometheus text) to this file when done")
+    args = parser.parse_args(argv)
+
+    output = args.output or os.path.splitext(args.input)[0] + ".results.jsonl"
+    runner = BatchRunner(output, args.checkpoint or output + ".checkpoint", args.user_id, max(1, args.concurrency), max(0, args.rpm),
+                         args.debate, not args.no_synthesis, record_history=not args.no_history)
+    try: topics = load_topics(args.input)
+    except (OSError, ValueError) as e:
+        print(f"Cannot read topics: {e}", file=sys.stderr); return 2
+    stats = asyncio.run(runner.run(topics))
+    if args.metrics: magi_core.write_metrics_file(args.metrics)
+    print(f"Finished: {stats['done']} ok, {stats['failed']} failed, {stats['skipped']} skipped -> {output}", file=sys.stderr)
+    return 1 if stats["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,23 +4,48 @@ import re
 import json
 import datetime
 import random
-import requests
 import uuid
-from typing import List, Tuple, Dict, Any, Optional
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+import hashlib
+import hmac
+import weakref
+import threading
+import concurrent.futures
+import sqlite3
+import time
+import tempfile
+import multiprocessing
+import collections
+import math
+import email.utils
+import contextlib
+import copy
+import csv
+import bisect
+import contextvars
+import logging
+from typing import List, Tuple, Dict, Any, Optional, AsyncIterator, Iterator, Iterable
+from tenacity import AsyncRetrying, stop_after_attempt, wait_exponential, retry_if_exception
+
+try:
+    import fcntl
+except ImportError: # Windows: in-process locking only
+    fcntl = None
 
 # PDF Analysis
 import PyPDF2
 import io
 
 # AI Providers
+import httpx
 import google.generativeai as genai
-from groq import AsyncGroq
-from openai import AsyncOpenAI
-from anthropic import AsyncAnthropic
+from groq import AsyncGroq, APIConnectionError as GroqConnectionError
+from openai import AsyncOpenAI, APIConnectionError as OpenAIConnectionError
+from anthropic import AsyncAnthropic, APIConnectionError as AnthropicConnectionError
 
 # --- 1. Constants & Paths ---
 
+logger = logging.getLogger(__name__)
+
 BASE_DIR = os.path.dirname(__file__)
 PERSONA_PATH = os.path.join(BASE_DIR, "personas.json")
 API_KEYS_PATH = os.path.join(BASE_DIR, "api_keys.json")
@@ -29,6 +54,8 @@ TEMPLATES_PATH = os.path.join(BASE_DIR, "templates.json")
 USERS_PATH = os.path.join(BASE_DIR, "users.json")
 WEBHOOKS_PATH = os.path.join(BASE_DIR, "webhooks.json")
 SESSIONS_PATH = os.path.join(BASE_DIR, "sessions.json")
+CACHE_DB_PATH = os.path.join(BASE_DIR, "response_cache.db")
+DB_PATH = os.path.join(BASE_DIR, "magi.db")
 
 # Output format instruction for consistent parsing
 OUTPUT_INSTRUCTION = """
@@ -47,6 +74,9 @@ OUTPUT_INSTRUCTION = """
 結論: 【是認】
 """
 
+# Opening of the prompt prefix every unit shares; the persona itself is given after the material
+MAGI_PREAMBLE = "あなたはMAGIシステムを構成する3つの人格のうちの1つです。以下の参考資料と審議事項を読み、後から指定される役割として判断してください。"
+
 # SEELE Synthesis Prompt
 SEELE_PROMPT = """
 あなたはゼーレ（SEELE）の最高幹部であり、MAGIシステムの審議結果を総括する責任者です。
@@ -66,28 +96,110 @@ SEELE_PROMPT = """
 
 # --- 2. Configuration & Data Management (JSON) ---
 
+# Parsed JSON files keyed by path, with the (mtime_ns, size) they were read at.
+# A hit costs one stat(); callers get a private copy they are free to mutate.
+_JSON_CACHE: Dict[str, Tuple[Tuple[int, int, int], Any]] = globals().get("_JSON_CACHE", {})
+_JSON_CACHE_LOCK = globals().get("_JSON_CACHE_LOCK", threading.Lock())
+
+def _file_signature(path: str) -> Optional[Tuple[int, int, int]]:
+    try:
+        st = os.stat(path)
+        # save_json renames a new file into place, so the inode changes on every write even when
+        # two same-size writes land within one mtime tick
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+    except OSError: return None
+
+def read_json(path: str, default: Any) -> Any:
+    """Like load_json, but returns the cached object itself: shared by every caller, so it must not be mutated.
+
+    Results are served from memory until the file's inode, mtime or size changes; a hit costs one stat().
+    """
+    sig = _file_signature(path)
+    if sig is None: return default
+    with _JSON_CACHE_LOCK:
+        hit = _JSON_CACHE.get(path)
+        if hit and hit[0] == sig: return hit[1]
+    # OSError (EMFILE, EACCES, EIO, ...) propagates: the file may be fine, so it must not be set aside
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        print(f"Error loading {path}: {e}")
+        # Keep the unreadable file around so the next save doesn't destroy the only copy
+        with contextlib.suppress(OSError):
+            if not os.path.exists(path + ".corrupt"): os.replace(path, path + ".corrupt")
+        return default
+    with _JSON_CACHE_LOCK: _JSON_CACHE[path] = (sig, data)
+    return data
+
 def load_json(path: str, default: Any) -> Any:
-    """Load JSON file safely, returning default if missing or invalid."""
-    if os.path.exists(path):
-        try:
-            with open(path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            print(f"Error loading {path}: {e}")
-    return default
+    """Load JSON file safely, returning default if missing or not valid JSON (I/O errors are raised).
+
+    The result is a private copy the caller is free to mutate; read-only hot paths use read_json.
+    """
+    data = read_json(path, default)
+    return data if data is default else copy.deepcopy(data)
 
-def save_json(path: str, data: Any) -> None:
-    """Save data to JSON file with UTF-8 encoding."""
+def save_json(path: str, data: Any) -> bool:
+    """Save data to JSON atomically (temp file, fsync, rename), refreshing the in-memory copy; False if the write failed."""
+    tmp = None
     try:
-        with open(path, 'w', encoding='utf-8') as f:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
             json.dump(data, f, indent=4, ensure_ascii=False)
+            f.flush(); os.fsync(f.fileno())
+        os.replace(tmp, path); tmp = None
+        sig = _file_signature(path)
+        with _JSON_CACHE_LOCK:
+            if sig: _JSON_CACHE[path] = (sig, copy.deepcopy(data))
+            else: _JSON_CACHE.pop(path, None)
+        return True
     except Exception as e:
         print(f"Error saving {path}: {e}")
+        return False
+    finally:
+        if tmp:
+            with contextlib.suppress(OSError): os.remove(tmp)
+
+# One lock per store: writers to users.json never wait on templates.json and vice versa.
+_PATH_LOCKS: Dict[str, threading.RLock] = globals().get("_PATH_LOCKS", {})
+
+@contextlib.contextmanager
+def file_lock(path: str) -> Iterator[None]:
+    """Hold an exclusive lock on a JSON store for a read-modify-write cycle.
+
+    The thread lock serialises sessions in this process; flock on a sidecar file
+    covers other processes (e.g. a second server) where fcntl is available.
+    """
+    with _JSON_CACHE_LOCK: lock = _PATH_LOCKS.setdefault(path, threading.RLock())
+    with lock:
+        if fcntl is None:
+            yield
+            return
+        with open(path + ".lock", "a") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try: yield
+            finally: fcntl.flock(fh, fcntl.LOCK_UN)
+
+# Schemas already created in this process; the lock keeps first-use setup single-threaded
+_DB_READY: set = globals().get("_DB_READY", set())
+_DB_INIT_LOCK = globals().get("_DB_INIT_LOCK", threading.Lock())
+
+def db_connect(path: str) -> sqlite3.Connection:
+    """Open a SQLite connection in WAL mode so readers never block the single writer."""
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
 
 def load_persona_config() -> Dict[str, Any]:
     """Load persona configurations (Melchior, Balthasar, Casper)."""
     return load_json(PERSONA_PATH, {})
 
+def persona_settings() -> Dict[str, Any]:
+    """Read-only persona configurations for the deliberation path (shared; never mutate)."""
+    return read_json(PERSONA_PATH, {})
+
 def save_persona_config(config: Dict[str, Any]) -> None:
     """Save persona configurations."""
     save_json(PERSONA_PATH, config)
@@ -96,6 +208,12 @@ def load_api_config() -> Dict[str, Any]:
     """Load API provider settings and available models."""
     default_config = {
         "seele_model": {"provider": "google", "name": "gemini-2.0-flash"},
+        "response_cache": {"enabled": False, "ttl_seconds": 86400, "max_entries": 1000},
+        "sessions": {"ttl_seconds": 604800, "max_per_user": 5},
+        "auth": {"hash_iterations": 600000},
+        "early_exit": {"enabled": False, "skip_debate_unanimous": True, "skip_debate_score": 0, "early_synthesis": False},
+        "prompt_cache": {"enabled": True, "min_tokens": 1024},
+        "debate_exchange": {"mode": "full", "exclude_self": False, "digest_chars": DEBATE_DIGEST_CHARS},
         "providers": {
             "google": {"api_key": "", "models": []},
             "groq": {"api_key": "", "models": []},
@@ -108,16 +226,106 @@ def load_api_config() -> Dict[str, Any]:
     # Ensure structure integrity
     if "providers" not in data: data["providers"] = default_config["providers"]
     if "seele_model" not in data: data["seele_model"] = default_config["seele_model"]
+    if "response_cache" not in data: data["response_cache"] = default_config["response_cache"]
+    if "sessions" not in data: data["sessions"] = default_config["sessions"]
+    if "auth" not in data: data["auth"] = default_config["auth"]
+    if "early_exit" not in data: data["early_exit"] = default_config["early_exit"]
+    if "prompt_cache" not in data: data["prompt_cache"] = default_config["prompt_cache"]
+    if "debate_exchange" not in data: data["debate_exchange"] = default_config["debate_exchange"]
     if "local" not in data["providers"]: data["providers"]["local"] = default_config["providers"]["local"]
     return data
 
+# api_keys.json object last read by api_settings() -> the defaults-filled view built from it
+_API_SETTINGS: Dict[str, Any] = globals().get("_API_SETTINGS", {"source": None, "view": None})
+
+def api_settings() -> Dict[str, Any]:
+    """Read-only load_api_config() for hot paths, rebuilt only when api_keys.json changes (shared; never mutate).
+
+    Provider calls consult the config several times each, so they skip the private copy load_api_config makes.
+    """
+    source = read_json(API_KEYS_PATH, None)
+    cached = _API_SETTINGS
+    if source is not None and cached["source"] is source: return cached["view"]
+    view = load_api_config()
+    if source is not None: _API_SETTINGS.update(source=source, view=view)
+    return view
+
 def save_api_config(config: Dict[str, Any]) -> None:
     """Save API provider settings."""
     save_json(API_KEYS_PATH, config)
 
+def _history_db() -> sqlite3.Connection:
+    """Open the history store, creating it (and importing a legacy history.json) on first use."""
+    conn = db_connect(DB_PATH)
+    if ("history", DB_PATH) in _DB_READY: return conn
+    with _DB_INIT_LOCK:
+        if ("history", DB_PATH) in _DB_READY: return conn
+        conn.execute("""CREATE TABLE IF NOT EXISTS history (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT UNIQUE NOT NULL, timestamp TEXT NOT NULL,
+            user_id TEXT, question TEXT, file_name TEXT, final_score INTEGER, entry TEXT NOT NULL)""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_history_user_ts ON history (user_id, timestamp)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_history_ts ON history (timestamp)")
+        conn.execute("CREATE TABLE IF NOT EXISTS history_traces (id TEXT PRIMARY KEY, trace TEXT NOT NULL)")
+        has_analytics = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'analytics_daily'").fetchone()
+        conn.execute("""CREATE TABLE IF NOT EXISTS analytics_daily (
+            day TEXT NOT NULL, user_id TEXT NOT NULL, persona TEXT NOT NULL, vote TEXT NOT NULL, count INTEGER NOT NULL,
+            PRIMARY KEY (day, user_id, persona, vote))""")
+        migrated = False
+        if os.path.exists(HISTORY_PATH):
+            # Under the store's lock (other processes share magi.db), and committed before the rename:
+            # a concurrent start or a failed import leaves history.json in place
+            with file_lock(HISTORY_PATH):
+                if os.path.exists(HISTORY_PATH) and not conn.execute("SELECT 1 FROM history LIMIT 1").fetchone():
+                    legacy = load_json(HISTORY_PATH, [])
+                    for entry in reversed(legacy): # history.json is stored newest first
+                        _insert_history(conn, entry)
+                    conn.commit()
+                    os.replace(HISTORY_PATH, HISTORY_PATH + ".migrated")
+                    migrated = True
+        if not migrated and not has_analytics:
+            # Store created before aggregates existed: backfill them once from the raw entries
+            for (raw,) in conn.execute("SELECT entry FROM history").fetchall():
+                _aggregate_history(conn, json.loads(raw))
+        conn.commit()
+        _DB_READY.add(("history", DB_PATH))
+    return conn
+
+def _insert_history(conn: sqlite3.Connection, entry: Dict[str, Any]) -> None:
+    cur = conn.execute("INSERT OR IGNORE INTO history (id, timestamp, user_id, question, file_name, final_score, entry) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (entry["id"], entry["timestamp"], entry.get("user_id"), entry.get("question", ""), entry.get("file_name", ""),
+                        entry.get("final_score", 0), json.dumps(entry, ensure_ascii=False)))
+    if cur.rowcount: _aggregate_history(conn, entry)
+
+def _persona_key(name: str) -> str:
+    """Map a display name such as 'MELCHIOR-1' onto its MAGI unit for aggregation."""
+    upper = name.upper()
+    return next((unit for unit in MAGI_UNITS if unit in upper), upper)
+
+def _aggregate_history(conn: sqlite3.Connection, entry: Dict[str, Any]) -> None:
+    """Fold one entry into the daily vote buckets, in the same transaction as its insert."""
+    day = entry["timestamp"][:10]
+    for r in entry.get("results", []):
+        conn.execute("""INSERT INTO analytics_daily (day, user_id, persona, vote, count) VALUES (?, ?, ?, ?, 1)
+                        ON CONFLICT (day, user_id, persona, vote) DO UPDATE SET count = count + 1""",
+                     (day, entry.get("user_id") or "", _persona_key(r.get("name", "")), r.get("vote", "否認")))
+
+def _record_history(entry: Dict[str, Any], trace: Optional["Trace"] = None) -> None:
+    """Append one entry; a single-row insert, so concurrent writers never overwrite each other.
+
+    A trace is stored alongside in the same transaction, including the span of the insert itself.
+    """
+    conn = _history_db()
+    try:
+        started = time.perf_counter()
+        _insert_history(conn, entry)
+        if trace is not None:
+            trace.add("SYSTEM", "history write", started, time.perf_counter())
+            conn.execute("INSERT OR REPLACE INTO history_traces VALUES (?, ?)", (entry["id"], json.dumps(trace.to_dict())))
+        conn.commit()
+    finally: conn.close()
+
 def add_history(question: str, results: List[Tuple[str, str, str, str]], final_score: int, seele_summary: str = "", file_name: str = "") -> None:
     """Legacy wrapper for adding history (without user context)."""
-    history = load_json(HISTORY_PATH, [])
     # Append random suffix to ensure ID uniqueness (even if multiple entries in 1sec)
     unique_id = datetime.datetime.now().strftime("%Y%m%d%H%M%S") + "_" + str(uuid.uuid4())[:4]
     entry = {
@@ -129,12 +337,11 @@ def add_history(question: str, results: List[Tuple[str, str, str, str]], final_s
         "final_score": final_score,
         "seele_summary": seele_summary
     }
-    history.insert(0, entry)
-    save_json(HISTORY_PATH, history[:100])
+    _record_history(entry)
 
-def add_history_with_user(user_id: str, question: str, results: List[Tuple[str, str, str, str]], final_score: int, seele_summary: str = "", file_name: str = "") -> None:
-    """Record a deliberation session into history.json with user context."""
-    history = load_json(HISTORY_PATH, [])
+def add_history_with_user(user_id: str, question: str, results: List[Tuple[str, str, str, str]], final_score: int, seele_summary: str = "", file_name: str = "",
+                          trace: Optional["Trace"] = None) -> None:
+    """Record a deliberation session into the history store with user context, and its timing trace if given."""
     # Append random suffix to ensure ID uniqueness
     unique_id = datetime.datetime.now().strftime("%Y%m%d%H%M%S") + "_" + str(uuid.uuid4())[:4]
     entry = {
@@ -147,126 +354,487 @@ def add_history_with_user(user_id: str, question: str, results: List[Tuple[str,
         "final_score": final_score,
         "seele_summary": seele_summary
     }
-    history.insert(0, entry)
-    save_json(HISTORY_PATH, history[:100]) # Keep last 100 entries
+    _record_history(entry, trace)
 
-def execute_webhook_action(webhook_id: str, title: str, text: str) -> bool:
-    """Execute an external webhook action (Slack/Discord)."""
-    webhooks = load_json(WEBHOOKS_PATH, {"webhooks": {}}).get("webhooks", {})
-    cfg = webhooks.get(webhook_id)
-    if not cfg or not cfg.get("url"): return False
-    
+def query_history(user_id: Optional[str] = None, limit: Optional[int] = 20, offset: int = 0) -> List[Dict[str, Any]]:
+    """Return history entries newest first, optionally for one user; limit=None returns all."""
+    where, params = ("WHERE user_id = ?", [user_id]) if user_id is not None else ("", [])
+    conn = _history_db()
     try:
-        payload = {"text": f"【MAGI SYSTEM DECISION】\n*Topic*: {title}\n\n{text}"}
-        res = requests.post(cfg["url"], json=payload, timeout=10)
-        return res.status_code < 300
-    except Exception as e:
-        print(f"Webhook failed: {e}")
-        return False
+        rows = conn.execute(f"SELECT entry FROM history {where} ORDER BY timestamp DESC, seq DESC LIMIT ? OFFSET ?",
+                            params + [-1 if limit is None else limit, offset]).fetchall()
+    finally: conn.close()
+    return [json.loads(r[0]) for r in rows]
+
+def get_history_traces(entry_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Timing traces for the given history entries, keyed by entry id (entries without one are absent)."""
+    if not entry_ids: return {}
+    conn = _history_db()
+    try:
+        rows = conn.execute(f"SELECT id, trace FROM history_traces WHERE id IN ({','.join('?' * len(entry_ids))})", list(entry_ids)).fetchall()
+    finally: conn.close()
+    return {i: json.loads(t) for i, t in rows}
+
+def count_history(user_id: Optional[str] = None) -> int:
+    """Number of stored entries, optionally for one user."""
+    where, params = ("WHERE user_id = ?", [user_id]) if user_id is not None else ("", [])
+    conn = _history_db()
+    try: return conn.execute(f"SELECT COUNT(*) FROM history {where}", params).fetchone()[0]
+    finally: conn.close()
+
+def clear_history() -> None:
+    """Delete all history entries, their traces and aggregates."""
+    conn = _history_db()
+    try:
+        conn.execute("DELETE FROM history"); conn.execute("DELETE FROM history_traces"); conn.execute("DELETE FROM analytics_daily"); conn.commit()
+    finally: conn.close()
+
+def get_analytics(user_id: Optional[str] = None, start_day: Optional[str] = None, end_day: Optional[str] = None) -> Dict[str, Any]:
+    """Read pre-aggregated vote statistics, optionally for one user and an inclusive YYYY-MM-DD range.
+
+    The cost depends on the number of days and personas in range, not on how many
+    deliberations are stored.
+    """
+    clauses, params = [], []
+    if user_id is not None: clauses.append("user_id = ?"); params.append(user_id)
+    if start_day: clauses.append("day >= ?"); params.append(start_day)
+    if end_day: clauses.append("day <= ?"); params.append(end_day)
+    where = ("WHERE " + " AND ".join(clauses)) if clauses else ""
+    conn = _history_db()
+    try:
+        rows = conn.execute(f"SELECT day, persona, vote, SUM(count) FROM analytics_daily {where} GROUP BY day, persona, vote ORDER BY day", params).fetchall()
+    finally: conn.close()
+
+    score_map = {"是認": 100, "条件付是認": 50, "否認": 0}
+    votes = {"是認": 0, "条件付是認": 0, "否認": 0}
+    personas: Dict[str, Dict[str, int]] = {}
+    daily: Dict[str, Dict[str, int]] = {}
+    for day, persona, vote, count in rows:
+        votes[vote] = votes.get(vote, 0) + count
+        p = personas.setdefault(persona, {"score_sum": 0, "count": 0})
+        p["score_sum"] += score_map.get(vote, 0) * count; p["count"] += count
+        d = daily.setdefault(day, {"是認": 0, "条件付是認": 0, "否認": 0})
+        d[vote] = d.get(vote, 0) + count
+    return {"votes": votes, "personas": personas, "daily": daily}
 
 # --- 3. User Authentication & Session Management ---
 
+PASSWORD_SCHEME = "pbkdf2_sha256"
+HASH_PARALLEL_MIN = 8 # bulk hashing below this many passwords stays in-process
+AUTH_CACHE_TTL = 300 # seconds a successful verification is remembered
+AUTH_CACHE_MAX = 1024
+
+# Recent successful logins, keyed by an HMAC of (user, password, stored hash) under a
+# per-process secret, so the cache never holds anything that reveals the password.
+_AUTH_CACHE: "collections.OrderedDict[bytes, float]" = globals().get("_AUTH_CACHE", collections.OrderedDict())
+_AUTH_CACHE_LOCK = globals().get("_AUTH_CACHE_LOCK", threading.Lock())
+_AUTH_CACHE_SECRET: bytes = globals().get("_AUTH_CACHE_SECRET", os.urandom(32))
+
+def hash_iterations() -> int:
+    """PBKDF2 work factor for new hashes; raise it as hardware gets faster."""
+    return int(api_settings()["auth"].get("hash_iterations", 600000))
+
+def hash_password(password: str, iterations: Optional[int] = None) -> str:
+    """Derive a salted hash encoded as 'pbkdf2_sha256$iterations$salt$digest'."""
+    iterations = iterations or hash_iterations()
+    salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+    return f"{PASSWORD_SCHEME}${iterations}${salt.hex()}${digest.hex()}"
+
+def verify_password(password: str, encoded: str) -> bool:
+    """Check a password against an encoded hash in constant time."""
+    try:
+        scheme, iterations, salt, digest = encoded.split("$")
+        if scheme != PASSWORD_SCHEME: return False
+        derived = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), bytes.fromhex(salt), int(iterations))
+    except ValueError: return False
+    return hmac.compare_digest(derived.hex(), digest)
+
+def _hash_passwords_batch(passwords: List[str], iterations: int) -> List[str]:
+    """Worker: hash one slice of a bulk import."""
+    return [hash_password(p, iterations) for p in passwords]
+
+def hash_passwords(passwords: List[str]) -> List[str]:
+    """Hash many passwords in order, spreading the work over the process pool."""
+    iterations = hash_iterations()
+    workers = os.cpu_count() or 1
+    if len(passwords) < HASH_PARALLEL_MIN or workers <= 1: return _hash_passwords_batch(passwords, iterations)
+    step = math.ceil(len(passwords) / (workers * 4))
+    batches = [passwords[i:i + step] for i in range(0, len(passwords), step)]
+    return [h for hashed in _process_executor().map(_hash_passwords_batch, batches, [iterations] * len(batches)) for h in hashed]
+
+def _verify_cached(username: str, password: str, encoded: str) -> bool:
+    """verify_password, skipping the KDF for a login that succeeded within AUTH_CACHE_TTL."""
+    key = hmac.new(_AUTH_CACHE_SECRET, "\0".join((username, password, encoded)).encode("utf-8"), "sha256").digest()
+    now = time.monotonic()
+    with _AUTH_CACHE_LOCK:
+        if _AUTH_CACHE.get(key, 0) > now: return True
+    if not verify_password(password, encoded): return False # failures are never cached
+    with _AUTH_CACHE_LOCK:
+        _AUTH_CACHE[key] = now + AUTH_CACHE_TTL
+        _AUTH_CACHE.move_to_end(key)
+        while len(_AUTH_CACHE) > AUTH_CACHE_MAX: _AUTH_CACHE.popitem(last=False)
+    return True
+
+def _store_password_hash(username: str, encoded: str) -> None:
+    """Replace a user's stored credential (plaintext or outdated hash) with a new hash."""
+    with file_lock(USERS_PATH):
+        users_data = load_json(USERS_PATH, {"users": {}})
+        user = users_data["users"].get(username)
+        if user is None: return
+        user.pop("password", None)
+        user["password_hash"] = encoded
+        save_json(USERS_PATH, users_data)
+
 def authenticate_user(username: str, password: str) -> Optional[Dict[str, str]]:
-    """Verify user credentials against users.json."""
-    users_data = load_json(USERS_PATH, {"users": {}})
+    """Verify user credentials against users.json, upgrading plaintext or weaker hashes on success."""
+    users_data = read_json(USERS_PATH, {"users": {}})
     user = users_data.get("users", {}).get(username)
-    if user and user["password"] == password:
-        return {"username": username, "name": user["name"], "role": user["role"]}
-    return None
+    if not user: return None
+    encoded = user.get("password_hash")
+    if encoded is None: # legacy plaintext entry: migrate on first successful login
+        if not hmac.compare_digest(str(user.get("password", "")).encode("utf-8"), password.encode("utf-8")): return None
+        _store_password_hash(username, hash_password(password))
+    elif not _verify_cached(username, password, encoded): return None
+    elif encoded.split("$")[1] != str(hash_iterations()):
+        _store_password_hash(username, hash_password(password))
+    return {"username": username, "name": user["name"], "role": user["role"]}
 
-def add_user(username: str, password: str, name: str, role: str) -> bool:
-    """Register a new user."""
-    users_data = load_json(USERS_PATH, {"users": {}})
-    if username in users_data["users"]: return False
-    users_data["users"][username] = {"password": password, "name": name, "role": role}
-    save_json(USERS_PATH, users_data)
+def add_user(username: str, password: str, name: str, role: str, password_hash: Optional[str] = None) -> bool:
+    """Register a new user; pass password_hash to store a credential already hashed by hash_passwords."""
+    encoded = password_hash or hash_password(password)
+    with file_lock(USERS_PATH):
+        users_data = load_json(USERS_PATH, {"users": {}})
+        if username in users_data["users"]: return False
+        users_data["users"][username] = {"password_hash": encoded, "name": name, "role": role}
+        save_json(USERS_PATH, users_data)
     return True
 
+USER_CSV_FIELDS = ("id", "password", "name", "role")
+
+def bulk_add_users(lines: Iterable[str]) -> Dict[str, Any]:
+    """Import users from CSV text (id,password,name,role) in one all-or-nothing write.
+
+    Every row is validated first; if any fails, nothing is stored and the result lists
+    (line number, message) per bad row. Otherwise all passwords are hashed in the process
+    pool and users.json is rewritten once, so the cost is linear in the number of rows.
+    Raises OSError if that write fails.
+    """
+    reader = csv.DictReader(lines)
+    missing = [f for f in USER_CSV_FIELDS if f not in (reader.fieldnames or [])]
+    if missing: return {"added": 0, "errors": [(1, f"missing column(s): {', '.join(missing)}")]}
+    existing = set(get_all_users())
+    rows: List[Dict[str, str]] = []
+    seen: Dict[str, int] = {}
+    errors: List[Tuple[int, str]] = []
+    for row in reader:
+        line = reader.line_num
+        values = {f: (row.get(f) or "").strip() for f in USER_CSV_FIELDS}
+        values["password"] = row.get("password") or "" # passwords are taken verbatim
+        empty = [f for f in USER_CSV_FIELDS if not values[f]]
+        if empty: errors.append((line, f"empty field(s): {', '.join(empty)}"))
+        elif values["id"] in existing: errors.append((line, f"user '{values['id']}' already exists"))
+        elif values["id"] in seen: errors.append((line, f"duplicate id '{values['id']}' (first on line {seen[values['id']]})"))
+        else:
+            seen[values["id"]] = line
+            rows.append(values)
+    if errors or not rows: return {"added": 0, "errors": errors}
+    hashes = hash_passwords([r["password"] for r in rows])
+    with file_lock(USERS_PATH):
+        users_data = load_json(USERS_PATH, {"users": {}})
+        taken = [r["id"] for r in rows if r["id"] in users_data["users"]] # registered while we were hashing
+        if taken: return {"added": 0, "errors": [(seen[uid], f"user '{uid}' already exists") for uid in taken]}
+        for r, pw_hash in zip(rows, hashes):
+            users_data["users"][r["id"]] = {"password_hash": pw_hash, "name": r["name"], "role": r["role"]}
+        if not save_json(USERS_PATH, users_data): raise OSError(f"Could not write {USERS_PATH}; no users were added.")
+    return {"added": len(rows), "errors": []}
+
 def delete_user(username: str) -> bool:
     """Delete a user, preventing deletion of root admin."""
-    users_data = load_json(USERS_PATH, {"users": {}})
     if username == "nerv_admin": return False # Prevent deleting root
-    if username in users_data["users"]:
+    with file_lock(USERS_PATH):
+        users_data = load_json(USERS_PATH, {"users": {}})
+        if username not in users_data["users"]: return False
         del users_data["users"][username]
         save_json(USERS_PATH, users_data)
-        return True
-    return False
+    clear_user_sessions(username)
+    return True
 
 def get_all_users() -> Dict[str, Dict[str, str]]:
     """Retrieve all properly registered users."""
     return load_json(USERS_PATH, {"users": {}}).get("users", {})
 
+SESSION_PRUNE_INTERVAL = 600 # seconds between background sweeps of expired sessions
+SESSION_TOUCH_INTERVAL = 300 # sliding expiry is written back at most this often per token
+
+# Live sessions by token, filled from magi.db on demand so a lookup never scans stale
+# entries. The database stays authoritative for other processes and restarts: a cached
+# entry is re-checked against its row at least once per SESSION_TOUCH_INTERVAL.
+_SESSIONS: Dict[str, Dict[str, Any]] = globals().get("_SESSIONS", {})
+_SESSIONS_LOCK = globals().get("_SESSIONS_LOCK", threading.Lock())
+_SESSION_PRUNER: Dict[str, Any] = globals().get("_SESSION_PRUNER", {"future": None})
+
+def session_settings() -> Dict[str, int]:
+    """Session TTL (seconds, renewed on every validation) and per-user limit (0 = unlimited)."""
+    cfg = api_settings()["sessions"]
+    return {"ttl_seconds": int(cfg.get("ttl_seconds", 604800)), "max_per_user": int(cfg.get("max_per_user", 5))}
+
+def _session_db() -> sqlite3.Connection:
+    """Open the session table, importing a legacy sessions.json on first use."""
+    conn = db_connect(DB_PATH)
+    if ("sessions", DB_PATH) not in _DB_READY:
+        with _DB_INIT_LOCK:
+            if ("sessions", DB_PATH) not in _DB_READY:
+                conn.execute("""CREATE TABLE IF NOT EXISTS sessions (
+                    token TEXT PRIMARY KEY, username TEXT NOT NULL, user TEXT NOT NULL,
+                    created_at REAL NOT NULL, expires_at REAL NOT NULL)""")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions (username, expires_at)")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expiry ON sessions (expires_at)")
+                conn.commit()
+                if os.path.exists(SESSIONS_PATH):
+                    # Same order as the history import: lock, import, commit, then rename
+                    with file_lock(SESSIONS_PATH):
+                        if os.path.exists(SESSIONS_PATH):
+                            ttl, now = session_settings()["ttl_seconds"], time.time()
+                            for token, sess in load_json(SESSIONS_PATH, {}).items():
+                                try: created = datetime.datetime.fromisoformat(sess["created_at"]).timestamp()
+                                except (KeyError, TypeError, ValueError): created = now
+                                if created + ttl > now:
+                                    conn.execute("INSERT OR IGNORE INTO sessions VALUES (?, ?, ?, ?, ?)",
+                                                 (token, sess["user"].get("username", ""), json.dumps(sess["user"], ensure_ascii=False), created, created + ttl))
+                            conn.commit()
+                            os.replace(SESSIONS_PATH, SESSIONS_PATH + ".migrated")
+                _DB_READY.add(("sessions", DB_PATH))
+    _start_session_pruner()
+    return conn
+
+def _write_session(conn: sqlite3.Connection, token: str, sess: Dict[str, Any]) -> None:
+    conn.execute("INSERT INTO sessions VALUES (?, ?, ?, ?, ?)",
+                 (token, sess["user"].get("username", ""), json.dumps(sess["user"], ensure_ascii=False), sess["created_at"], sess["expires_at"]))
+
+def _touch_session(conn: sqlite3.Connection, token: str, sess: Dict[str, Any], now: float) -> bool:
+    """Write the sliding expiry back; False when the row is gone, i.e. another process revoked it."""
+    # UPDATE only: re-inserting here would resurrect a session logged out or deleted elsewhere
+    touched = conn.execute("UPDATE sessions SET expires_at = ? WHERE token = ? AND expires_at > ?",
+                           (sess["expires_at"], token, now)).rowcount
+    conn.commit()
+    return touched > 0
+
+def _drop_sessions(conn: sqlite3.Connection, tokens: List[str]) -> None:
+    with _SESSIONS_LOCK:
+        for t in tokens: _SESSIONS.pop(t, None)
+    conn.executemany("DELETE FROM sessions WHERE token = ?", [(t,) for t in tokens])
+    conn.commit()
+
 def create_session(user_info: Dict[str, str]) -> str:
-    """Create a new persistent session and return the token."""
+    """Create a new persistent session and return the token, evicting the user's oldest beyond the limit."""
     token = str(uuid.uuid4())
-    sessions = load_json(SESSIONS_PATH, {})
-    sessions[token] = {
-        "user": user_info,
-        "created_at": datetime.datetime.now().isoformat()
-    }
-    save_json(SESSIONS_PATH, sessions)
+    settings, now = session_settings(), time.time()
+    sess = {"user": user_info, "created_at": now, "expires_at": now + settings["ttl_seconds"], "touched_at": now}
+    conn = _session_db()
+    try:
+        _write_session(conn, token, sess)
+        conn.commit()
+        with _SESSIONS_LOCK: _SESSIONS[token] = sess
+        if settings["max_per_user"] > 0:
+            stale = [t for (t,) in conn.execute("SELECT token FROM sessions WHERE username = ? ORDER BY expires_at DESC LIMIT -1 OFFSET ?",
+                                                (user_info.get("username", ""), settings["max_per_user"]))]
+            if stale: _drop_sessions(conn, stale)
+    finally: conn.close()
     return token
 
 def validate_session(token: str) -> Optional[Dict[str, str]]:
-    """Validate a session token and return user info if valid."""
-    sessions = load_json(SESSIONS_PATH, {})
-    sess = sessions.get(token)
-    if sess:
-        # Optional: Add expiration check here logic in future
-        return sess["user"]
-    return None
+    """Validate a session token and return user info if valid, extending its expiry."""
+    if not token: return None
+    now = time.time()
+    with _SESSIONS_LOCK: sess = _SESSIONS.get(token)
+    conn = _session_db()
+    try:
+        if sess is None:
+            row = conn.execute("SELECT user, created_at, expires_at FROM sessions WHERE token = ?", (token,)).fetchone()
+            if row is None: return None
+            # touched_at 0 forces a renewal now: the stored expiry may be close, and a row swept
+            # before the next touch would read as a revocation
+            sess = {"user": json.loads(row[0]), "created_at": row[1], "expires_at": row[2], "touched_at": 0.0}
+            with _SESSIONS_LOCK: _SESSIONS[token] = sess
+        if sess["expires_at"] <= now:
+            _drop_sessions(conn, [token])
+            return None
+        ttl = session_settings()["ttl_seconds"]
+        sess["expires_at"] = now + ttl
+        # The cached entry is trusted for at most one touch interval; the touch doubles as the
+        # revocation check, and never outlives the row's own expiry on disk
+        if now - sess["touched_at"] >= min(SESSION_TOUCH_INTERVAL, ttl / 2):
+            sess["touched_at"] = now
+            if not _touch_session(conn, token, sess, now):
+                with _SESSIONS_LOCK: _SESSIONS.pop(token, None)
+                return None
+    finally: conn.close()
+    return sess["user"]
 
 def clear_session(token: str) -> None:
     """Invalidate a specific session token."""
-    sessions = load_json(SESSIONS_PATH, {})
-    if token in sessions:
-        del sessions[token]
-        save_json(SESSIONS_PATH, sessions)
+    conn = _session_db()
+    try: _drop_sessions(conn, [token])
+    finally: conn.close()
+
+def clear_user_sessions(username: str) -> None:
+    """Invalidate every session belonging to a user."""
+    conn = _session_db()
+    try: _drop_sessions(conn, [t for (t,) in conn.execute("SELECT token FROM sessions WHERE username = ?", (username,))])
+    finally: conn.close()
+
+def prune_sessions() -> int:
+    """Delete expired sessions from memory and disk, returning how many rows were removed."""
+    now = time.time()
+    with _SESSIONS_LOCK:
+        for t in [t for t, sess in _SESSIONS.items() if sess["expires_at"] <= now]: del _SESSIONS[t]
+    conn = _session_db()
+    try:
+        removed = conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,)).rowcount
+        conn.commit()
+    finally: conn.close()
+    return removed
+
+async def _prune_sessions_forever() -> None:
+    while True:
+        try: await asyncio.to_thread(prune_sessions)
+        except Exception as e: print(f"Session prune failed: {e}")
+        await asyncio.sleep(SESSION_PRUNE_INTERVAL)
+
+def _start_session_pruner() -> None:
+    """Run the expiry sweep on the background loop, once per process."""
+    future = _SESSION_PRUNER["future"]
+    if future is None or future.done(): _SESSION_PRUNER["future"] = submit_coroutine(_prune_sessions_forever())
+
+def get_session_stats() -> Dict[str, int]:
+    """Count unexpired sessions on disk and those currently held in memory."""
+    conn = _session_db()
+    try: active = conn.execute("SELECT COUNT(*) FROM sessions WHERE expires_at > ?", (time.time(),)).fetchone()[0]
+    finally: conn.close()
+    with _SESSIONS_LOCK: cached = len(_SESSIONS)
+    return {"active": active, "cached": cached}
 
 # --- 4. Client Management ---
 
+CLIENT_PROVIDERS = ["google", "groq", "openai", "anthropic", "local"]
+
+# Module state is looked up in globals() first so that the importlib.reload() in app.py
+# keeps the process-wide pool instead of discarding live connections on every rerun.
+_CLIENT_POOL: Dict[str, Any] = globals().get("_CLIENT_POOL", {"loop": None, "http": None, "clients": {}})
+_CLIENT_STATS: Dict[str, int] = globals().get("_CLIENT_STATS", {"clients_built": 0, "clients_reused": 0, "connections_opened": 0, "connections_reused": 0})
+_SEEN_CONNECTIONS: "weakref.WeakSet" = globals().get("_SEEN_CONNECTIONS", weakref.WeakSet())
+
+async def _track_connection(response: httpx.Response) -> None:
+    """httpx response hook: count whether the request went over a new or a kept-alive connection."""
+    stream = response.extensions.get("network_stream")
+    if stream is None: return
+    if stream in _SEEN_CONNECTIONS:
+        _CLIENT_STATS["connections_reused"] += 1
+    else:
+        _SEEN_CONNECTIONS.add(stream)
+        _CLIENT_STATS["connections_opened"] += 1
+
+def _provider_fingerprint(provider: str, cfg: Dict[str, Any]) -> str:
+    """Hash the settings a client is built from, so a rebuild happens only when they change."""
+    raw = json.dumps([provider, cfg.get("api_key", ""), cfg.get("base_url", "")])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+async def _close_with_loop(http: httpx.AsyncClient) -> AsyncIterator[None]:
+    """Parked on the pool's loop: asyncio.run() closes pending async generators before the
+    loop itself, so the finally block releases the pool's sockets while it still can."""
+    try: yield
+    finally: await http.aclose()
+
+def _client_pool() -> Dict[str, Any]:
+    """Return the shared pool, starting a fresh one if the event loop changed.
+
+    httpx connections belong to the loop that opened them, so clients cannot be
+    carried over from a loop that asyncio.run() has already closed. The old pool is
+    closed on its own loop if that loop is still alive, or when the loop shuts down.
+    """
+    try: loop = asyncio.get_running_loop()
+    except RuntimeError: loop = None
+    if _CLIENT_POOL["http"] is None or _CLIENT_POOL["loop"] is not loop:
+        old, old_loop = _CLIENT_POOL["http"], _CLIENT_POOL["loop"]
+        if old is not None and old_loop is not None and not old_loop.is_closed():
+            asyncio.run_coroutine_threadsafe(old.aclose(), old_loop)
+        http = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60.0),
+            timeout=httpx.Timeout(600.0, connect=10.0),
+            event_hooks={"response": [_track_connection]}
+        )
+        keeper = None
+        if loop is not None:
+            # Starting it registers the generator with the loop; the pool holds the only strong reference
+            keeper = _close_with_loop(http)
+            asyncio.ensure_future(keeper.__anext__())
+        _CLIENT_POOL.update(loop=loop, http=http, keeper=keeper)
+        _CLIENT_POOL["clients"] = {pid: entry for pid, entry in _CLIENT_POOL["clients"].items() if pid == "google"}
+    return _CLIENT_POOL
+
+def _build_client(provider: str, cfg: Dict[str, Any], http_client: httpx.AsyncClient) -> Any:
+    """Construct one provider client on top of the shared connection pool."""
+    if provider == "google":
+        genai.configure(api_key=cfg["api_key"]); return True
+    # SDK-internal retries are disabled: call_provider_with_retry classifies errors and retries itself
+    if provider == "groq": return AsyncGroq(api_key=cfg["api_key"], http_client=http_client, max_retries=0)
+    if provider == "openai": return AsyncOpenAI(api_key=cfg["api_key"], http_client=http_client, max_retries=0)
+    if provider == "anthropic": return AsyncAnthropic(api_key=cfg["api_key"], http_client=http_client, max_retries=0)
+    if provider == "local": return AsyncOpenAI(api_key=cfg.get("api_key") or "sk-xxx", base_url=cfg["base_url"], http_client=http_client, max_retries=0)
+    raise ValueError(f"Unknown provider: {provider}")
+
 def get_clients() -> Dict[str, Any]:
-    """Initialize and return AI clients based on configuration."""
-    api_config = load_api_config()
+    """Return pooled AI clients, rebuilding only providers whose key or base_url changed."""
+    api_config = api_settings()
     providers = api_config.get("providers", {})
-    clients = {"google": None, "groq": None, "openai": None, "anthropic": None, "local": None}
+    pool = _client_pool()
+    clients = {pid: None for pid in CLIENT_PROVIDERS}
     
-    if providers.get("google", {}).get("api_key"):
-        try: genai.configure(api_key=providers["google"]["api_key"]); clients["google"] = True
-        except Exception: pass
-    if providers.get("groq", {}).get("api_key"):
-        try: clients["groq"] = AsyncGroq(api_key=providers["groq"]["api_key"])
-        except Exception: pass
-    if providers.get("openai", {}).get("api_key"):
-        try: clients["openai"] = AsyncOpenAI(api_key=providers["openai"]["api_key"])
-        except Exception: pass
-    if providers.get("anthropic", {}).get("api_key"):
-        try: clients["anthropic"] = AsyncAnthropic(api_key=providers["anthropic"]["api_key"])
-        except Exception: pass
-    if providers.get("local", {}).get("base_url"):
-        try: clients["local"] = AsyncOpenAI(api_key=providers["local"].get("api_key", "sk-xxx"), base_url=providers["local"]["base_url"])
-        except Exception as e: print(f"Local client failed: {e}")
+    for pid in CLIENT_PROVIDERS:
+        cfg = providers.get(pid, {})
+        if not cfg.get("base_url" if pid == "local" else "api_key"):
+            pool["clients"].pop(pid, None); continue
+        fingerprint = _provider_fingerprint(pid, cfg)
+        entry = pool["clients"].get(pid)
+        if entry and entry[0] == fingerprint:
+            _CLIENT_STATS["clients_reused"] += 1
+            clients[pid] = entry[1]; continue
+        try:
+            clients[pid] = _build_client(pid, cfg, pool["http"])
+            pool["clients"][pid] = (fingerprint, clients[pid])
+            _CLIENT_STATS["clients_built"] += 1
+        except Exception as e: print(f"{pid} client failed: {e}")
     return clients
 
+def get_client_stats() -> Dict[str, int]:
+    """Counters for client construction and HTTP connection reuse since process start."""
+    return dict(_CLIENT_STATS)
+
 # --- 5. Model Fetching Utilities ---
 
+# The fetchers run on the background loop (admin Sync Models), so SDK clients borrow the
+# pooled connection pool rather than each opening one that is never closed.
+
 async def fetch_models_google(api_key: str) -> List[str]:
     try:
         genai.configure(api_key=api_key)
         await asyncio.sleep(0.5)
-        return sorted(list(set([m.name.replace("models/", "") for m in genai.list_models() if 'generateContent' in m.supported_generation_methods])))
+        # list_models() pages over blocking HTTP; run it off the shared loop so live streams keep flowing
+        models = await asyncio.to_thread(lambda: list(genai.list_models()))
+        return sorted(list(set([m.name.replace("models/", "") for m in models if 'generateContent' in m.supported_generation_methods])))
     except Exception: return ["gemini-1.5-flash", "gemini-1.5-pro", "gemini-2.0-flash-exp"]
 
 async def fetch_models_groq(api_key: str) -> List[str]:
     try:
-        client = AsyncGroq(api_key=api_key)
+        client = AsyncGroq(api_key=api_key, http_client=_client_pool()["http"])
         models = await client.models.list()
         return [m.id for m in models.data]
     except Exception: return ["llama3-8b-8192", "mixtral-8x7b-32768"]
 
 async def fetch_models_openai(api_key: str) -> List[str]:
     try:
-        client = AsyncOpenAI(api_key=api_key)
+        client = AsyncOpenAI(api_key=api_key, http_client=_client_pool()["http"])
         models = await client.models.list()
         return [m.id for m in models.data if "gpt" in m.id]
     except Exception: return ["gpt-4o", "gpt-4-turbo", "gpt-3.5-turbo"]
@@ -276,58 +844,585 @@ async def fetch_models_anthropic(api_key: str) -> List[str]:
 
 async def fetch_models_local(base_url: str, api_key: str = "sk-xxx") -> List[str]:
     try:
-        client = AsyncOpenAI(api_key=api_key, base_url=base_url)
+        client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=_client_pool()["http"])
         models = await client.models.list()
         return [m.id for m in models.data]
     except Exception as e:
-        print(f"Local model fetch failed: {e}")
+        logger.warning("Local model fetch failed: %s", e)
         return ["local-model-error"]
 
 # --- 6. File Analysis ---
 
-def extract_text_from_file(file_content: bytes, file_name: str) -> str:
+PDF_PARALLEL_MIN_PAGES = 32 # Below this, starting worker processes costs more than it saves
+PDF_PAGES_PER_TASK = 16
+EXTRACT_CACHE_MAX_FILES = 50
+
+_PROCESS_POOL: Dict[str, Any] = globals().get("_PROCESS_POOL", {"executor": None})
+
+def _process_executor() -> concurrent.futures.ProcessPoolExecutor:
+    """Shared worker pool for CPU-bound work (PDF pages, password hashing); spawned, since the UI process is multi-threaded."""
+    if _PROCESS_POOL["executor"] is None:
+        _PROCESS_POOL["executor"] = concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(4, os.cpu_count() or 1), mp_context=multiprocessing.get_context("spawn"))
+    return _PROCESS_POOL["executor"]
+
+def _extract_pdf_pages(pdf_path: str, pages: List[int]) -> List[Tuple[int, str]]:
+    """Worker: extract the text of the given zero-based pages."""
+    reader = PyPDF2.PdfReader(pdf_path)
+    return [(i, reader.pages[i].extract_text() or "") for i in pages]
+
+def parse_page_range(spec: str) -> Optional[Tuple[int, int]]:
+    """Parse '10-50', '10-' or '7' into an inclusive 1-based (first, last) pair; blank means all pages.
+
+    Raises ValueError with a message fit for the user on anything else, including reversed ranges.
+    """
+    if not (spec or "").strip(): return None
+    m = re.fullmatch(r"\s*(\d+)\s*(?:(-)\s*(\d*)\s*)?", spec)
+    if not m: raise ValueError(f"Invalid page range '{spec}': use e.g. 7, 10-50 or 10-.")
+    first = int(m.group(1))
+    last = int(m.group(3)) if m.group(3) else (10**9 if m.group(2) else first)
+    if first < 1: raise ValueError(f"Invalid page range '{spec}': pages start at 1.")
+    if last < first: raise ValueError(f"Invalid page range '{spec}': the last page comes before the first.")
+    return (first, last)
+
+def _extract_db() -> sqlite3.Connection:
+    conn = _cache_db()
+    if ("extract", CACHE_DB_PATH) not in _DB_READY:
+        conn.execute("CREATE TABLE IF NOT EXISTS extract_files (sha TEXT PRIMARY KEY, pages INTEGER NOT NULL, accessed_at REAL NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS extract_pages (sha TEXT NOT NULL, page INTEGER NOT NULL, text TEXT NOT NULL, PRIMARY KEY (sha, page))")
+        conn.commit()
+        _DB_READY.add(("extract", CACHE_DB_PATH))
+    return conn
+
+def _cache_pages(sha: str, num_pages: int, pages: List[Tuple[int, str]]) -> None:
+    conn = _extract_db()
+    try:
+        conn.execute("INSERT OR REPLACE INTO extract_files VALUES (?, ?, ?)", (sha, num_pages, time.time()))
+        conn.executemany("INSERT OR REPLACE INTO extract_pages VALUES (?, ?, ?)", [(sha, i, t) for i, t in pages])
+        stale = conn.execute("SELECT sha FROM extract_files ORDER BY accessed_at DESC LIMIT -1 OFFSET ?", (EXTRACT_CACHE_MAX_FILES,)).fetchall()
+        for (old,) in stale:
+            conn.execute("DELETE FROM extract_pages WHERE sha = ?", (old,)); conn.execute("DELETE FROM extract_files WHERE sha = ?", (old,))
+        conn.commit()
+    finally: conn.close()
+
+def iter_pdf_pages(file_content: bytes, page_range: Optional[Tuple[int, int]] = None) -> Iterator[Tuple[int, str]]:
+    """Yield (page_number, text) in page order as extraction finishes.
+
+    Pages already extracted from a file with the same SHA-256 come from the cache.
+    Large documents are split into page batches for the process pool, and each
+    batch is yielded as soon as it and its predecessors are done.
+    """
+    sha = hashlib.sha256(file_content).hexdigest()
+    conn = _extract_db()
+    try:
+        row = conn.execute("SELECT pages FROM extract_files WHERE sha = ?", (sha,)).fetchone()
+        if row: conn.execute("UPDATE extract_files SET accessed_at = ? WHERE sha = ?", (time.time(), sha)); conn.commit()
+    finally: conn.close()
+    num_pages = row[0] if row else len(PyPDF2.PdfReader(io.BytesIO(file_content)).pages)
+
+    first, last = page_range or (1, num_pages)
+    wanted = list(range(first - 1, min(last, num_pages)))
+    conn = _extract_db()
+    try:
+        cached = dict(conn.execute("SELECT page, text FROM extract_pages WHERE sha = ? AND page BETWEEN ? AND ?", (sha, first - 1, last - 1)).fetchall())
+    finally: conn.close()
+    missing = [i for i in wanted if i not in cached]
+    batches = [missing[i:i + PDF_PAGES_PER_TASK] for i in range(0, len(missing), PDF_PAGES_PER_TASK)]
+
+    # Workers read the document from disk rather than receiving a copy of the bytes per batch
+    fd, pdf_path = tempfile.mkstemp(suffix=".pdf")
+    futures: List[concurrent.futures.Future] = []
+    try:
+        with os.fdopen(fd, "wb") as f: f.write(file_content if missing else b"")
+        if len(missing) >= PDF_PARALLEL_MIN_PAGES and (os.cpu_count() or 1) > 1:
+            futures = [_process_executor().submit(_extract_pdf_pages, pdf_path, batch) for batch in batches]
+            results = (f.result() for f in futures)
+        else:
+            results = (_extract_pdf_pages(pdf_path, batch) for batch in batches)
+        extracted: Dict[int, str] = {}
+        for page in wanted:
+            if page in cached:
+                yield page + 1, cached.pop(page); continue
+            if page not in extracted:
+                batch = next(results)
+                _cache_pages(sha, num_pages, batch)
+                extracted.update(batch)
+            yield page + 1, extracted.pop(page)
+    finally:
+        # Closed early: drop batches not started yet and let running workers finish with the file before it goes
+        for f in futures: f.cancel()
+        concurrent.futures.wait(futures)
+        os.remove(pdf_path)
+
+def extract_text_from_file(file_content: bytes, file_name: str, page_range: Optional[Tuple[int, int]] = None) -> str:
     """Extract text from PDF or TXT files."""
     if file_name.endswith('.pdf'):
         try:
-            reader = PyPDF2.PdfReader(io.BytesIO(file_content))
-            return "\n".join([page.extract_text() for page in reader.pages if page.extract_text()])
+            return "\n".join(text for _, text in iter_pdf_pages(file_content, page_range) if text)
         except Exception: return "[Error extracting PDF text]"
     elif file_name.endswith('.txt'):
         return file_content.decode('utf-8', errors='ignore')
     return ""
 
+# Context budgeting: large attachments are cut into chunks, ranked against the
+# question with BM25, and only the best chunks that fit a persona's budget are sent.
+DEFAULT_CONTEXT_BUDGET = 8000 # tokens
+CONTEXT_CHUNK_TOKENS = 300 # sized in tokens, not characters: Japanese runs ~1 token per character
+_CJK = "\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff"
+
+_CONTEXT_INDEXES: "collections.OrderedDict[str, ContextIndex]" = globals().get("_CONTEXT_INDEXES", collections.OrderedDict())
+_CONTEXT_LOCK = globals().get("_CONTEXT_LOCK", threading.Lock())
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count without a tokenizer: about one per CJK character, four ASCII characters per token."""
+    cjk = len(re.findall(f"[{_CJK}]", text))
+    return cjk + (len(text) - cjk) // 4
+
+def _terms(text: str) -> List[str]:
+    """Lexical terms for ranking: lowercase words plus character bigrams for CJK runs (no spaces to split on)."""
+    terms = re.findall(r"[a-z0-9]+", text.lower())
+    for run in re.findall(f"[{_CJK}]+", text):
+        terms.extend([run] if len(run) == 1 else [run[i:i + 2] for i in range(len(run) - 1)])
+    return terms
+
+def _token_prefix(text: str, max_tokens: int) -> int:
+    """Length of the longest prefix of text that estimate_tokens keeps within max_tokens."""
+    cost = 0.0
+    for i, ch in enumerate(text):
+        cost += 1 if re.match(f"[{_CJK}]", ch) else 0.25
+        if cost > max_tokens: return i
+    return len(text)
+
+def _split_chunks(text: str, size: int = CONTEXT_CHUNK_TOKENS) -> List[str]:
+    """Split on line boundaries into chunks of at most `size` estimated tokens."""
+    chunks, current, length = [], [], 0
+    for line in text.splitlines():
+        while estimate_tokens(line) > size: # Hard-wrap lines with no natural break
+            if current: chunks.append("\n".join(current)); current, length = [], 0
+            cut = max(1, _token_prefix(line, size))
+            chunks.append(line[:cut]); line = line[cut:]
+        cost = estimate_tokens(line) + 1 # the newline, and rounding across joined lines
+        if length + cost > size and current:
+            chunks.append("\n".join(current)); current, length = [], 0
+        current.append(line); length += cost
+    if current: chunks.append("\n".join(current))
+    return [c for c in chunks if c.strip()]
+
+class ContextIndex:
+    """BM25 index over the chunks of one attached document."""
+    K1, B = 1.5, 0.75
+
+    def __init__(self, text: str):
+        self.chunks = _split_chunks(text)
+        self.tokens = [estimate_tokens(c) for c in self.chunks]
+        self.tfs = [collections.Counter(_terms(c)) for c in self.chunks]
+        self.lengths = [sum(tf.values()) for tf in self.tfs]
+        self.avg_len = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0
+        self.df: collections.Counter = collections.Counter()
+        for tf in self.tfs: self.df.update(tf.keys())
+
+    def scores(self, query: str) -> List[float]:
+        n = len(self.chunks)
+        q_terms = set(_terms(query))
+        idf = {t: math.log(1 + (n - self.df[t] + 0.5) / (self.df[t] + 0.5)) for t in q_terms if self.df[t]}
+        out = []
+        for tf, length in zip(self.tfs, self.lengths):
+            norm = self.K1 * (1 - self.B + self.B * length / (self.avg_len or 1))
+            out.append(sum(w * tf[t] * (self.K1 + 1) / (tf[t] + norm) for t, w in idf.items() if t in tf))
+        return out
+
+    def select(self, query: str, budget_tokens: int) -> str:
+        """Best-scoring chunks that fit the budget, in document order."""
+        scores = self.scores(query)
+        ranked = sorted(range(len(self.chunks)), key=lambda i: (-scores[i], i))
+        chosen, used = [], 0
+        for i in ranked:
+            if used + self.tokens[i] <= budget_tokens:
+                chosen.append(i); used += self.tokens[i]
+        if not chosen and ranked:
+            # A budget below one chunk still gets the best passage, cut to fit, rather than nothing
+            best = self.chunks[ranked[0]]
+            return best[:_token_prefix(best, budget_tokens)]
+        return "\n[...]\n".join(self.chunks[i] for i in sorted(chosen))
+
+def context_index(text: str) -> ContextIndex:
+    """Return the index for a document, building it once per upload."""
+    key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    with _CONTEXT_LOCK:
+        if key in _CONTEXT_INDEXES:
+            _CONTEXT_INDEXES.move_to_end(key)
+        else:
+            _CONTEXT_INDEXES[key] = ContextIndex(text)
+            while len(_CONTEXT_INDEXES) > 8: _CONTEXT_INDEXES.popitem(last=False)
+        return _CONTEXT_INDEXES[key]
+
+def select_context(text: str, question: str, budget_tokens: int = DEFAULT_CONTEXT_BUDGET) -> str:
+    """Fit attached material into a token budget; documents already within budget pass through unchanged."""
+    if not text or estimate_tokens(text) <= budget_tokens: return text
+    return context_index(text).select(question, budget_tokens)
+
 # --- 7. Core AI Logic (Retry & Execution) ---
 
+MAGI_UNITS = ["MELCHIOR", "BALTHASAR", "CASPER"]
+
 class RateLimitError(Exception): pass
+class ProviderConfigError(Exception): pass
+class CircuitOpenError(Exception): pass
+
+# Network-level failures that are worth another attempt
+_TRANSIENT_ERRORS = (asyncio.TimeoutError, TimeoutError, ConnectionError, httpx.TransportError,
+                     OpenAIConnectionError, AnthropicConnectionError, GroqConnectionError)
+# Transport errors raised before anything is sent: a bad URL fails the same way on every attempt
+_INVALID_REQUEST_ERRORS = (httpx.UnsupportedProtocol, httpx.InvalidURL, httpx.LocalProtocolError)
+
+def _status_code(e: Exception) -> Optional[int]:
+    """HTTP status of a provider error (OpenAI-style SDKs expose status_code, google.api_core exposes code)."""
+    for attr in ("status_code", "code"):
+        code = getattr(e, attr, None)
+        if isinstance(code, int) and 100 <= code < 600: return code
+    return None
 
-@retry(
+# Message patterns, used only for errors that carry no HTTP status; whole-number matches, so "14290 tokens" is not a 429
+_RATE_LIMIT_TEXT = re.compile(r"\b429\b|rate[ _-]?limit|quota|resource[ _]?exhausted|too many requests", re.IGNORECASE)
+_TRANSIENT_TEXT = re.compile(r"timed out|timeout|overloaded|\b50[023]\b", re.IGNORECASE)
+
+def classify_error(e: BaseException) -> str:
+    """Return 'retryable' for 429s, 5xx and timeouts; 'fatal' for auth, other 4xx and configuration errors."""
+    if isinstance(e, (ProviderConfigError, CircuitOpenError, *_INVALID_REQUEST_ERRORS)): return "fatal"
+    if isinstance(e, (RateLimitError, *_TRANSIENT_ERRORS)): return "retryable"
+    code = _status_code(e)
+    if code is not None:
+        return "retryable" if code in (408, 409, 429) or code >= 500 else "fatal"
+    text = str(e)
+    if _RATE_LIMIT_TEXT.search(text) or _TRANSIENT_TEXT.search(text): return "retryable"
+    return "fatal"
+
+def is_retryable(e: BaseException) -> bool:
+    return classify_error(e) == "retryable"
+
+_BACKOFF = wait_exponential(multiplier=1, min=2, max=10)
+
+def _retry_wait(retry_state: Any) -> float:
+    """Exponential backoff, stretched to any Retry-After the provider asked for."""
+    exc = retry_state.outcome.exception() if retry_state.outcome else None
+    return max(_BACKOFF(retry_state), getattr(exc, "retry_after", None) or 0)
+
+# Shared by the blocking and the streaming call paths
+RETRY_POLICY = dict(
     stop=stop_after_attempt(5),
-    wait=wait_exponential(multiplier=1, min=2, max=10),
-    retry=retry_if_exception_type((RateLimitError, Exception)),
+    wait=_retry_wait,
+    retry=retry_if_exception(is_retryable),
     reraise=True
 )
-async def call_provider_with_retry(provider: str, model: str, sys_prompt: str, user_prompt: str, temp: float, clients: Dict, max_tokens: int = 4096, top_p: float = 1.0) -> str:
-    """Call an AI provider with robust error handling and retry logic."""
+
+# Errors another target can serve right away: with a fallback configured, waiting out a
+# rate limit's backoff or a dead endpoint's timeouts only delays the answer
+_HANDOFF_ERRORS = (RateLimitError, *_TRANSIENT_ERRORS)
+
+def _retry_policy(hand_off: bool) -> Dict[str, Any]:
+    """RETRY_POLICY, or with hand_off (a later failover target exists) at most one retry and none for _HANDOFF_ERRORS."""
+    if not hand_off: return RETRY_POLICY
+    return {**RETRY_POLICY, "stop": stop_after_attempt(2), "retry": retry_if_exception(lambda e: is_retryable(e) and not isinstance(e, _HANDOFF_ERRORS))}
+
+def _retry_after(e: Exception) -> Optional[float]:
+    """Seconds the provider asked us to wait, from Retry-After headers or Gemini's 'retry in Ns' message."""
+    headers = getattr(getattr(e, "response", None), "headers", None)
+    if headers:
+        if headers.get("retry-after-ms"):
+            try: return float(headers["retry-after-ms"]) / 1000
+            except ValueError: pass
+        if headers.get("retry-after"):
+            try: return float(headers["retry-after"])
+            except ValueError:
+                try: return max(0.0, email.utils.parsedate_to_datetime(headers["retry-after"]).timestamp() - time.time())
+                except (TypeError, ValueError): pass
+    m = re.search(r"retry in ([\d.]+)\s*s", str(e), re.IGNORECASE)
+    return float(m.group(1)) if m else None
+
+def _wrap_provider_error(e: Exception, scheduler: Optional["ProviderScheduler"] = None) -> Exception:
+    """Map provider quota errors onto RateLimitError and pause the provider for any Retry-After."""
+    retry_after = _retry_after(e)
+    if retry_after and scheduler: scheduler.block_for(retry_after)
+    code = _status_code(e)
+    if code == 429 or (code is None and _RATE_LIMIT_TEXT.search(str(e))):
+        err = RateLimitError(str(e))
+        err.retry_after = retry_after
+        return err
+    return e
+
+def _usage_tokens(usage: Any) -> Optional[Tuple[int, int]]:
+    """(prompt, completion) tokens from an SDK usage object: OpenAI/Groq, Anthropic or Gemini field names."""
+    if usage is None: return None
+    for p_attr, c_attr in (("prompt_tokens", "completion_tokens"), ("input_tokens", "output_tokens"), ("prompt_token_count", "candidates_token_count")):
+        p, c = getattr(usage, p_attr, None), getattr(usage, c_attr, None)
+        if p is not None or c is not None:
+            # Anthropic's input_tokens leaves out the cached part of the prompt
+            if p_attr == "input_tokens": p = int(p or 0) + sum(_cache_tokens(usage))
+            return int(p or 0), int(c or 0)
+    return None
+
+def _cache_tokens(usage: Any) -> Tuple[int, int]:
+    """(read from, written to) the provider's prompt cache: Anthropic, OpenAI-style or Gemini field names."""
+    if usage is None: return 0, 0
+    read = getattr(usage, "cache_read_input_tokens", None)
+    if read is None: read = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None)
+    if read is None: read = getattr(usage, "cached_content_token_count", None)
+    return int(read or 0), int(getattr(usage, "cache_creation_input_tokens", None) or 0)
+
+def _prompt_cache_enabled(sys_prompt: str) -> bool:
+    """Whether a system prompt is worth marking for the provider's prefix cache (providers ignore short prefixes)."""
+    cfg = api_settings().get("prompt_cache", {})
+    return bool(cfg.get("enabled", True)) and estimate_tokens(sys_prompt) >= int(cfg.get("min_tokens", 1024))
+
+def _anthropic_system(sys_prompt: str) -> Any:
+    """The system parameter for Anthropic, with a cache breakpoint after the shared prefix when enabled."""
+    if not _prompt_cache_enabled(sys_prompt): return sys_prompt
+    return [{"type": "text", "text": sys_prompt, "cache_control": {"type": "ephemeral"}}]
+
+def _openai_cache_args(provider: str, sys_prompt: str) -> Dict[str, Any]:
+    """OpenAI caches prefixes automatically; a key per shared prefix routes the three units to the same cache."""
+    if provider != "openai" or not _prompt_cache_enabled(sys_prompt): return {}
+    return {"prompt_cache_key": "magi-" + hashlib.sha256(sys_prompt.encode("utf-8")).hexdigest()[:32]}
+
+async def _call_provider_once(provider: str, model: str, sys_prompt: str, user_prompt: str, temp: float, clients: Dict, max_tokens: int, top_p: float, attempt: int) -> str:
+    """One attempt of call_provider_with_retry, recorded in the provider metrics."""
+    scheduler, breaker = provider_scheduler(provider), circuit_breaker(provider)
+    requested = started = time.perf_counter()
+    status = "cancelled"
     try:
         client = clients.get(provider)
-        if not client: raise Exception(f"Provider {provider} not configured.")
-
-        if provider == "google":
-            m = genai.GenerativeModel(model)
-            response = await asyncio.to_thread(m.generate_content, sys_prompt + "\n\n" + user_prompt, 
-                                             generation_config=genai.types.GenerationConfig(temperature=temp, top_p=top_p, max_output_tokens=max_tokens))
-            return response.text
-        elif provider in ["groq", "openai", "local"]:
-            completion = await client.chat.completions.create(model=model, messages=[{"role": "system", "content": sys_prompt}, {"role": "user", "content": user_prompt}], temperature=temp, top_p=top_p, max_tokens=max_tokens)
-            return completion.choices[0].message.content
-        elif provider == "anthropic":
-            message = await client.messages.create(model=model, max_tokens=max_tokens, system=sys_prompt, messages=[{"role": "user", "content": user_prompt}], temperature=temp, top_p=top_p)
-            return message.content[0].text
-        else: raise ValueError(f"Unknown provider: {provider}")
+        if not client: raise ProviderConfigError(f"Provider {provider} not configured.")
+        breaker.before_call()
+
+        async with scheduler.slot(estimate_tokens(sys_prompt) + estimate_tokens(user_prompt)):
+            started = time.perf_counter() # queueing for a slot is not provider latency
+            if provider == "google":
+                m = genai.GenerativeModel(model)
+                response = await asyncio.to_thread(m.generate_content, sys_prompt + "\n\n" + user_prompt, 
+                                                 generation_config=genai.types.GenerationConfig(temperature=temp, top_p=top_p, max_output_tokens=max_tokens))
+                text, usage = response.text, getattr(response, "usage_metadata", None)
+            elif provider in ["groq", "openai", "local"]:
+                completion = await client.chat.completions.create(model=model, messages=[{"role": "system", "content": sys_prompt}, {"role": "user", "content": user_prompt}], temperature=temp, top_p=top_p, max_tokens=max_tokens,
+                                                                  **_openai_cache_args(provider, sys_prompt))
+                text, usage = completion.choices[0].message.content, completion.usage
+            elif provider == "anthropic":
+                message = await client.messages.create(model=model, max_tokens=max_tokens, system=_anthropic_system(sys_prompt), messages=[{"role": "user", "content": user_prompt}], temperature=temp, top_p=top_p)
+                text, usage = message.content[0].text, message.usage
+            else: raise ProviderConfigError(f"Unknown provider: {provider}")
+        elapsed = time.perf_counter() - started
+        scheduler.debit(estimate_tokens(text or ""))
+        breaker.record_success()
+        tokens = _usage_tokens(usage) or (estimate_tokens(sys_prompt) + estimate_tokens(user_prompt), estimate_tokens(text or ""))
+        record_provider_call(provider, model, attempt, elapsed, elapsed, tokens, cache=_cache_tokens(usage))
+        status = "ok"
+        return text
     except Exception as e:
-        if "429" in str(e) or "quota" in str(e).lower():
-            raise RateLimitError(str(e))
-        raise e
+        err = _wrap_provider_error(e, scheduler)
+        breaker.record_failure(err)
+        record_provider_call(provider, model, attempt, time.perf_counter() - started, error=err)
+        status = f"error: {type(err).__name__}"
+        raise err
+    finally:
+        trace_attempt(provider, model, attempt, requested, started, status)
+
+async def call_provider_with_retry(provider: str, model: str, sys_prompt: str, user_prompt: str, temp: float, clients: Dict, max_tokens: int = 4096, top_p: float = 1.0,
+                                   hand_off: bool = False) -> str:
+    """Call an AI provider with robust error handling and retry logic (see _retry_policy for hand_off)."""
+    async for attempt in AsyncRetrying(**_retry_policy(hand_off)):
+        with attempt:
+            return await _call_provider_once(provider, model, sys_prompt, user_prompt, temp, clients, max_tokens, top_p, attempt.retry_state.attempt_number)
+
+def _google_chunk_text(chunk: Any) -> str:
+    """Read the text of a Gemini stream chunk (chunks without parts raise on .text)."""
+    try: return chunk.text or ""
+    except ValueError: return ""
+
+async def _open_provider_stream(provider: str, model: str, sys_prompt: str, user_prompt: str, temp: float, clients: Dict, max_tokens: int, top_p: float, attempt: int = 1) -> AsyncIterator[str]:
+    """Yield raw text chunks from a single streaming completion, recording the attempt in the provider metrics."""
+    scheduler, breaker = provider_scheduler(provider), circuit_breaker(provider)
+    produced = 0
+    requested = started = time.perf_counter()
+    first_at, usage, status = None, None, "cancelled"
+    try:
+        client = clients.get(provider)
+        if not client: raise ProviderConfigError(f"Provider {provider} not configured.")
+        breaker.before_call()
+
+        # The slot is held for the whole stream so max_concurrency counts open streams
+        async with scheduler.slot(estimate_tokens(sys_prompt) + estimate_tokens(user_prompt)):
+            started = time.perf_counter()
+            if provider == "google":
+                m = genai.GenerativeModel(model)
+                response = await asyncio.to_thread(m.generate_content, sys_prompt + "\n\n" + user_prompt, stream=True,
+                                                 generation_config=genai.types.GenerationConfig(temperature=temp, top_p=top_p, max_output_tokens=max_tokens))
+                # The Gemini SDK streams through a blocking iterator; pull each chunk off-loop
+                chunks = iter(response)
+                while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+                    usage = getattr(chunk, "usage_metadata", None) or usage
+                    text = _google_chunk_text(chunk)
+                    if text:
+                        first_at = first_at or time.perf_counter()
+                        produced += estimate_tokens(text); yield text
+            elif provider in ["groq", "openai", "local"]:
+                # Only OpenAI is known to accept stream_options; Groq reports usage under x_groq regardless
+                extra = {"stream_options": {"include_usage": True}, **_openai_cache_args(provider, sys_prompt)} if provider == "openai" else {}
+                stream = await client.chat.completions.create(model=model, messages=[{"role": "system", "content": sys_prompt}, {"role": "user", "content": user_prompt}], temperature=temp, top_p=top_p, max_tokens=max_tokens, stream=True, **extra)
+                async for chunk in stream:
+                    usage = getattr(chunk, "usage", None) or getattr(getattr(chunk, "x_groq", None), "usage", None) or usage
+                    text = chunk.choices[0].delta.content if chunk.choices else None
+                    if text:
+                        first_at = first_at or time.perf_counter()
+                        produced += estimate_tokens(text); yield text
+            elif provider == "anthropic":
+                async with client.messages.stream(model=model, max_tokens=max_tokens, system=_anthropic_system(sys_prompt), messages=[{"role": "user", "content": user_prompt}], temperature=temp, top_p=top_p) as stream:
+                    async for text in stream.text_stream:
+                        if text:
+                            first_at = first_at or time.perf_counter()
+                            produced += estimate_tokens(text); yield text
+                    usage = (await stream.get_final_message()).usage
+            else: raise ProviderConfigError(f"Unknown provider: {provider}")
+        breaker.record_success()
+        elapsed = time.perf_counter() - started
+        tokens = _usage_tokens(usage) or (estimate_tokens(sys_prompt) + estimate_tokens(user_prompt), produced)
+        record_provider_call(provider, model, attempt, elapsed, (first_at or time.perf_counter()) - started, tokens, cache=_cache_tokens(usage))
+        status = "ok"
+    except Exception as e:
+        err = _wrap_provider_error(e, scheduler)
+        breaker.record_failure(err)
+        record_provider_call(provider, model, attempt, time.perf_counter() - started, error=err)
+        status = f"error: {type(err).__name__}"
+        raise err
+    finally:
+        scheduler.debit(produced)
+        trace_attempt(provider, model, attempt, requested, started, status)
+
+async def stream_provider_with_retry(provider: str, model: str, sys_prompt: str, user_prompt: str, temp: float, clients: Dict, max_tokens: int = 4096, top_p: float = 1.0,
+                                     hand_off: bool = False) -> AsyncIterator[str]:
+    """Streaming variant of call_provider_with_retry.
+
+    Retries apply until the first chunk arrives; once text has been yielded a
+    failure is raised to the caller, since the partial output cannot be taken back.
+    """
+    stream, first = None, None
+    async for attempt in AsyncRetrying(**_retry_policy(hand_off)):
+        with attempt:
+            stream = _open_provider_stream(provider, model, sys_prompt, user_prompt, temp, clients, max_tokens, top_p, attempt.retry_state.attempt_number)
+            try:
+                first = await stream.__anext__()
+            except StopAsyncIteration:
+                first = None
+            except BaseException:
+                await stream.aclose()
+                raise
+    if first is None: return
+    try:
+        yield first
+        async for chunk in stream: yield chunk
+    finally:
+        await stream.aclose()
+
+async def provider_chunks(provider: str, model: str, sys_prompt: str, user_prompt: str, temp: float, clients: Dict, max_tokens: int = 4096, top_p: float = 1.0, stream: bool = True, use_cache: bool = True,
+                          hand_off: bool = False) -> AsyncIterator[str]:
+    """Yield completion text, consulting the response cache when it is enabled.
+
+    A cache hit is replayed as a single chunk. With stream=False the provider is
+    called in one shot and its answer is likewise yielded once. hand_off shortens
+    retries because a failover target is waiting (see _retry_policy).
+    """
+    cache_cfg = api_settings().get("response_cache", {})
+    key = response_cache_key(provider, model, sys_prompt, user_prompt, temp, top_p, max_tokens) if use_cache and cache_cfg.get("enabled") else None
+    if key:
+        cached = await asyncio.to_thread(cache_get, key, int(cache_cfg.get("ttl_seconds", 86400)))
+        if cached is not None:
+            yield cached
+            return
+
+    started = time.perf_counter()
+    if stream:
+        parts = []
+        async for chunk in stream_provider_with_retry(provider, model, sys_prompt, user_prompt, temp, clients, max_tokens, top_p, hand_off):
+            parts.append(chunk)
+            yield chunk
+        text = "".join(parts)
+    else:
+        text = await call_provider_with_retry(provider, model, sys_prompt, user_prompt, temp, clients, max_tokens, top_p, hand_off)
+        yield text
+    if key and text:
+        await asyncio.to_thread(cache_put, key, text, time.perf_counter() - started, int(cache_cfg.get("max_entries", 1000)))
+
+# Time to first output per (provider, model), for p95-based hedging
+HEDGE_DEFAULT_SECONDS = 8.0
+HEDGE_MIN_SAMPLES = 5
+_FIRST_OUTPUT_SAMPLES: Dict[Tuple[str, str], "collections.deque"] = globals().get("_FIRST_OUTPUT_SAMPLES", {})
+
+def record_first_output(provider: str, model: str, seconds: float) -> None:
+    _FIRST_OUTPUT_SAMPLES.setdefault((provider, model), collections.deque(maxlen=100)).append(seconds)
+
+def hedge_threshold(provider: str, model: str) -> float:
+    """p95 time to first output for a target, or a default until enough samples exist."""
+    samples = sorted(_FIRST_OUTPUT_SAMPLES.get((provider, model), ()))
+    if len(samples) < HEDGE_MIN_SAMPLES: return HEDGE_DEFAULT_SECONDS
+    return samples[min(len(samples) - 1, int(0.95 * len(samples)))]
+
+async def _next_chunk(gen: AsyncIterator[str]) -> Optional[str]:
+    try: return await gen.__anext__()
+    except StopAsyncIteration: return None
+
+async def failover_chunks(targets: List[Tuple[str, str]], sys_prompt: str, user_prompt: str, temp: float, clients: Dict, max_tokens: int = 4096, top_p: float = 1.0,
+                          stream: bool = True, use_cache: bool = True, hedge: bool = False, hedge_after: Optional[float] = None) -> AsyncIterator[str]:
+    """Yield chunks from the first (provider, model) target that produces output.
+
+    A target that fails before producing anything hands over to the next one; every
+    target but the last hands over on a rate limit or connection error without retrying.
+    With hedge=True, a target that is still silent after hedge_after seconds
+    (default: its p95 time to first output) gets the next target raced against it;
+    the first to produce output wins and the other request is cancelled.
+    """
+    pending: Dict[asyncio.Task, Tuple[AsyncIterator[str], int, float]] = {}
+    errors: List[Exception] = []
+    launched = 0
+
+    def launch() -> None:
+        nonlocal launched
+        provider, model = targets[launched]
+        gen = provider_chunks(provider, model, sys_prompt, user_prompt, temp, clients, max_tokens, top_p, stream=stream, use_cache=use_cache,
+                              hand_off=launched < len(targets) - 1)
+        pending[asyncio.ensure_future(_next_chunk(gen))] = (gen, launched, time.monotonic())
+        launched += 1
+
+    winner = None
+    launch()
+    try:
+        while pending and not winner:
+            timeout = None
+            if hedge and launched < len(targets):
+                timeout = hedge_after or hedge_threshold(*targets[launched - 1])
+            done, _ = await asyncio.wait(list(pending), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                launch(); continue
+            for task in done:
+                gen, idx, started = pending.pop(task)
+                if task.exception() is None:
+                    winner = (gen, task.result())
+                    record_first_output(*targets[idx], time.monotonic() - started)
+                    break
+                errors.append(task.exception())
+                await gen.aclose()
+            if not winner and not pending and launched < len(targets): launch()
+    finally:
+        # Cancel and close every request that lost the race (or all of them, if we were cancelled)
+        for task in pending: task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        for gen, _, _ in pending.values(): await gen.aclose()
+
+    if not winner: raise errors[-1]
+    gen, first = winner
+    try:
+        if first is not None:
+            yield first
+            async for chunk in gen: yield chunk
+    finally:
+        await gen.aclose()
 
 def parse_response(name: str, text: str) -> Tuple[str, str, str, str]:
     """Parse the raw AI response into structured data."""
@@ -343,65 +1438,930 @@ def parse_response(name: str, text: str) -> Tuple[str, str, str, str]:
         if condition.lower() in ["なし", "none", "無し", "特になし", ""]: condition = ""
     return name, clean_text, vote, condition
 
-async def ask_philosopher(philosopher_id: str, question: str, context: str = "", other_opinions: str = "", debate: bool = False, delay: float = 0) -> Tuple[str, str, str, str]:
-    """Execute a deliberation sequence for a single MAGI unit."""
-    if delay > 0: await asyncio.sleep(delay)
-    
-    config = load_persona_config().get(philosopher_id)
-    if not config: return (philosopher_id, "Config Missing", "否認", "設定不足")
+def build_persona_prompts(config: Dict[str, Any], question: str, context: str = "", other_opinions: str = "", debate: bool = False) -> Tuple[str, str]:
+    """Assemble the (system, user) prompt pair for one MAGI unit.
 
-    sys_prompt = config['prompt'] + OUTPUT_INSTRUCTION
-    prompt_with_context = f"【参考資料】\n{context}\n\n審議事項: {question}\n{OUTPUT_INSTRUCTION}" if context else f"審議事項: {question}\n{OUTPUT_INSTRUCTION}"
-    
-    user_prompt = prompt_with_context
+    The system prompt holds only what all three units and both rounds share (material,
+    question, output format), so provider prefix caches can reuse it; the persona and
+    the other opinions come last, in the user prompt.
+    """
+    material = f"【参考資料】\n{context}\n\n" if context else ""
+    sys_prompt = f"{MAGI_PREAMBLE}\n\n{material}審議事項: {question}\n{OUTPUT_INSTRUCTION}"
+
+    user_prompt = f"【あなたの役割】\n{config['prompt']}\n\n"
     if debate and other_opinions:
-        user_prompt = f"以下の他者の意見を読み込み、議論を深めた上であなたの最終結論を出してください。\n\n【他者の第一回意見】\n{other_opinions}\n\n{prompt_with_context}"
+        user_prompt += f"以下の他者の意見を読み込み、議論を深めた上であなたの最終結論を出してください。\n\n【他者の第一回意見】\n{other_opinions}\n\n"
+    return sys_prompt, user_prompt + "上記の審議事項について、この役割として出力形式に従い回答してください。"
+
+async def ask_philosopher_stream(philosopher_id: str, question: str, context: str = "", other_opinions: str = "", debate: bool = False, delay: float = 0, stream: bool = True) -> AsyncIterator[Tuple[str, Any]]:
+    """Stream a single MAGI unit: ("chunk", text) events followed by one ("result", parsed) event.
+
+    With stream=False the provider is called in one shot and the whole answer
+    arrives as a single chunk.
+    """
+    if delay > 0: await asyncio.sleep(delay)
     
-    clients = get_clients()
+    config = persona_settings().get(philosopher_id)
+    if not config:
+        yield ("result", (philosopher_id, "Config Missing", "否認", "設定不足"))
+        return
+
+    parts = []
     try:
-        raw_res = await call_provider_with_retry(
-            config["model_provider"], config["model_name"], sys_prompt, user_prompt, 
-            config.get("temperature", 0.7), clients, int(config.get("max_tokens", 4096)), config.get("top_p", 1.0)
-        )
-        return parse_response(config["name"], raw_res)
+        # Setup is inside the try too: a broken persona config ends as an error result, never as no result
+        if context:
+            context = await asyncio.to_thread(select_context, context, question, int(config.get("context_budget", DEFAULT_CONTEXT_BUDGET)))
+        sys_prompt, user_prompt = build_persona_prompts(config, question, context, other_opinions, debate)
+        clients = get_clients()
+        targets = [(config["model_provider"], config["model_name"])] + [(f["provider"], f["model"]) for f in config.get("fallbacks", []) if f.get("provider") and f.get("model")]
+        hedge_ms = float(config.get("hedge_threshold_ms", 0) or 0)
+        with metric_persona(philosopher_id), trace_span(philosopher_id, "debate" if debate else "round 1"):
+            async for chunk in failover_chunks(targets, sys_prompt, user_prompt, config.get("temperature", 0.7), clients, int(config.get("max_tokens", 4096)), config.get("top_p", 1.0),
+                                               stream=stream, use_cache=not config.get("bypass_cache", False),
+                                               hedge=bool(config.get("hedge", False)), hedge_after=hedge_ms / 1000 if hedge_ms else None):
+                parts.append(chunk)
+                yield ("chunk", chunk)
     except Exception as e:
-        return (config["name"], f"AI Error: {str(e)}", "否認", "エラー発生")
+        yield ("result", (config.get("name", philosopher_id), f"AI Error: {str(e)}", "否認", "エラー発生"))
+        return
+    yield ("result", parse_response(config.get("name", philosopher_id), "".join(parts)))
 
-async def ask_magi_system(question: str, context: str = "", debate: bool = False, synthesis: bool = True, file_name: str = "") -> Dict[str, Any]:
-    """Orchestrate the entire MAGI deliberation process (3 Magi + Seele)."""
-    tasks = [
-        ask_philosopher("MELCHIOR", question, context, delay=0),
-        ask_philosopher("BALTHASAR", question, context, delay=0.5),
-        ask_philosopher("CASPER", question, context, delay=1.0)
-    ]
-    results = list(await asyncio.gather(*tasks))
-    
-    if debate:
-        opinions_str = "\n---\n".join([f"{r[0]}: {r[1]}" for r in results])
-        tasks_round2 = [
-            ask_philosopher("MELCHIOR", question, context, opinions_str, debate=True, delay=0),
-            ask_philosopher("BALTHASAR", question, context, opinions_str, debate=True, delay=0.5),
-            ask_philosopher("CASPER", question, context, opinions_str, debate=True, delay=1.0)
-        ]
-        results = list(await asyncio.gather(*tasks_round2))
-
-    score_map = {"是認": 1, "条件付是認": 0, "否認": -1}
-    final_score = sum([score_map.get(r[2], -1) for r in results])
-    
-    summary = ""
-    if synthesis:
+async def ask_philosopher(philosopher_id: str, question: str, context: str = "", other_opinions: str = "", debate: bool = False, delay: float = 0) -> Tuple[str, str, str, str]:
+    """Execute a deliberation sequence for a single MAGI unit."""
+    result = None
+    async for kind, payload in ask_philosopher_stream(philosopher_id, question, context, other_opinions, debate, delay, stream=False):
+        if kind == "result": result = payload
+    return result
+
+async def _merge_streams(streams: List[AsyncIterator[Any]]) -> AsyncIterator[Tuple[int, Any]]:
+    """Interleave several async generators, yielding (index, item) as items arrive.
+
+    An exception raised by one of the streams is re-raised here, after the items it produced before failing.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    finished = object()
+
+    async def pump(i: int, s: AsyncIterator[Any]) -> None:
+        error = None
         try:
-            api_config = load_api_config()
-            seele_cfg = api_config.get("seele_model", {"provider": "google", "name": "gemini-2.0-flash"})
-            o_str = { "m": results[0][1], "b": results[1][1], "c": results[2][1] }
-            user_p = SEELE_PROMPT.format(question=question, m_opinion=o_str["m"], b_opinion=o_str["b"], c_opinion=o_str["c"])
-            clients = get_clients()
-            summary = await call_provider_with_retry(seele_cfg["provider"], seele_cfg["name"], "SEELE SYSTEM ACTIVE.", user_p, 0.4, clients)
-        except Exception as e:
-            summary = f"【警告】ゼーレの介入に失敗しました（{str(e)}）。三賢者の個別判断を確認してください。"
+            async for item in s: await queue.put((i, item, None))
+        except Exception as e: error = e
+        finally:
+            queue.put_nowait((i, finished, error))
+
+    tasks = [asyncio.create_task(pump(i, s)) for i, s in enumerate(streams)]
+    remaining = len(tasks)
+    try:
+        while remaining:
+            i, item, error = await queue.get()
+            if error is not None: raise error
+            if item is finished: remaining -= 1; continue
+            yield i, item
+    finally:
+        for t in tasks: t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+async def _stream_round(round_no: int, results: List[Any], question: str, context: str, opinions: List[str], debate: bool, stream: bool) -> AsyncIterator[Dict[str, Any]]:
+    """Run the three MAGI units concurrently, filling `results` and yielding UI events; opinions[i] is what unit i reads."""
+    # No fixed stagger: pacing comes from the per-provider scheduler
+    streams = [ask_philosopher_stream(pid, question, context, opinions[i], debate=debate, stream=stream) for i, pid in enumerate(MAGI_UNITS)]
+    yield {"type": "round", "round": round_no}
+    async for i, (kind, payload) in _merge_streams(streams):
+        if kind == "chunk":
+            yield {"type": "chunk", "round": round_no, "index": i, "text": payload}
+        else:
+            results[i] = payload
+            yield {"type": "result", "round": round_no, "index": i, "result": payload}
+
+# Characters of condition and reasoning per opinion in digest mode. Opinions are mostly
+# Japanese, about one token per character, so this stays well under a full answer.
+DEBATE_DIGEST_CHARS = 160
+
+def opinion_digest(text: str, max_chars: int) -> str:
+    """The reasoning of a parsed opinion without its condition and conclusion lines, cut to max_chars."""
+    m = re.search(r"(?:理由|Reason)[:：]\s*(.*?)(?=(?:条件|Condition|結論|Conclusion)[:：]|\Z)", text, re.S)
+    body = " ".join((m.group(1) if m else text).split())
+    return body if len(body) <= max_chars else body[:max_chars].rstrip() + "…"
+
+def exchange_opinions(results: List[Any], policy: Dict[str, Any]) -> List[str]:
+    """Round-one opinions as each unit reads them in the debate round, under a debate_exchange policy.
+
+    mode "full" passes every opinion verbatim; "digest" passes the vote plus at most
+    digest_chars of condition and reasoning together. exclude_self leaves out a unit's own opinion.
+    """
+    digest, max_chars = policy.get("mode", "full") == "digest", int(policy.get("digest_chars", DEBATE_DIGEST_CHARS) or DEBATE_DIGEST_CHARS)
+
+    def brief(r: Any) -> str:
+        condition = opinion_digest(r[3], max_chars) if r[3] else ""
+        reasoning = opinion_digest(r[1], max(0, max_chars - len(condition))) if len(condition) < max_chars else ""
+        return f"{r[0]}: 結論【{r[2]}】" + (f"\n条件: {condition}" if condition else "") + (f"\n要旨: {reasoning}" if reasoning else "")
+
+    rendered = [brief(r) if digest else f"{r[0]}: {r[1]}" for r in results]
+    return ["\n---\n".join(t for j, t in enumerate(rendered) if not (policy.get("exclude_self") and i == j)) for i in range(len(results))]
+
+SCORE_MAP = {"是認": 1, "条件付是認": 0, "否認": -1}
+
+def vote_score(results: List[Any]) -> int:
+    return sum(SCORE_MAP.get(r[2], -1) for r in results if r)
+
+def vote_decided(results: List[Any]) -> bool:
+    """True once the votes still outstanding can no longer change the sign of the final score."""
+    known = [r for r in results if r]
+    return abs(vote_score(known)) > len(MAGI_UNITS) - len(known)
+
+def debate_skip_reason(results: List[Any], policy: Dict[str, Any]) -> str:
+    """Why round two can be skipped under the early-exit policy, or "" if it must run."""
+    if not policy.get("enabled"): return ""
+    if policy.get("skip_debate_unanimous", True) and len({r[2] for r in results}) == 1: return "unanimous"
+    threshold = int(policy.get("skip_debate_score", 0) or 0)
+    if threshold and abs(vote_score(results)) >= threshold: return f"score {vote_score(results):+d}"
+    return ""
+
+def _estimate_round_tokens(question: str, context: str, opinions: List[str], results: List[Any]) -> int:
+    """Approximate prompt + completion tokens of a debate round that was not run."""
+    personas = persona_settings()
+    base = estimate_tokens(MAGI_PREAMBLE) + estimate_tokens(question) + estimate_tokens(OUTPUT_INSTRUCTION)
+    ctx = estimate_tokens(context) if context else 0
+    total = 0
+    for pid, r, o in zip(MAGI_UNITS, results, opinions):
+        cfg = personas.get(pid, {})
+        total += base + estimate_tokens(o) + estimate_tokens(cfg.get("prompt", "")) + min(ctx, int(cfg.get("context_budget", DEFAULT_CONTEXT_BUDGET))) + estimate_tokens(r[1])
+    return total
+
+async def _seele_stream(question: str, results: List[Any], stream: bool) -> AsyncIterator[Dict[str, Any]]:
+    """SEELE synthesis as "seele_chunk" events, closed by one "seele_done" event with the summary.
+
+    A unit whose result is still None is marked as pending in the prompt.
+    """
+    try:
+        api_config = api_settings()
+        seele_cfg = api_config.get("seele_model", {"provider": "google", "name": "gemini-2.0-flash"})
+        o = [r[1] if r else "（審議継続中：多数決が確定したため本意見を待たずに総括）" for r in results]
+        user_p = SEELE_PROMPT.format(question=question, m_opinion=o[0], b_opinion=o[1], c_opinion=o[2])
+        clients = get_clients()
+        parts = []
+        with metric_persona("SEELE"), trace_span("SEELE", "synthesis"):
+            async for chunk in provider_chunks(seele_cfg["provider"], seele_cfg["name"], "SEELE SYSTEM ACTIVE.", user_p, 0.4, clients,
+                                               stream=stream, use_cache=not seele_cfg.get("bypass_cache", False)):
+                parts.append(chunk)
+                if stream: yield {"type": "seele_chunk", "text": chunk}
+        summary = "".join(parts)
+    except Exception as e:
+        summary = f"【警告】ゼーレの介入に失敗しました（{str(e)}）。三賢者の個別判断を確認してください。"
+    yield {"type": "seele_done", "summary": summary}
+
+async def _deferred_seele(trigger: "asyncio.Future", question: str, stream: bool) -> AsyncIterator[Dict[str, Any]]:
+    """Stay idle until the final round is decided early, then run SEELE on the results known so far."""
+    snapshot = await trigger
+    if snapshot is None: return
+    async for event in _seele_stream(question, snapshot, stream): yield event
+
+async def ask_magi_system_stream(question: str, context: str = "", debate: bool = False, synthesis: bool = True, file_name: str = "", stream: bool = True,
+                                 early_exit: Optional[Dict[str, Any]] = None, exchange: Optional[Dict[str, Any]] = None,
+                                 trace: Optional["Trace"] = None) -> AsyncIterator[Dict[str, Any]]:
+    """Orchestrate a deliberation, yielding events as the MAGI units and SEELE produce text.
+
+    Event types: "round", "chunk", "result" (per unit), "seele_chunk", and a
+    final "done" event carrying the same payload as ask_magi_system, including
+    the timing trace. Pass trace to add the deliberation's spans to one the caller
+    already opened (e.g. with an extraction span); otherwise each call starts its own.
+
+    early_exit (default: the "early_exit" block of api_keys.json) can skip the
+    debate round when round one is unanimous or past skip_debate_score, and with
+    early_synthesis start SEELE as soon as the final round's majority is settled.
+    The "done" event reports what was skipped and an estimate of the time saved,
+    and of the tokens saved by a skipped debate round.
+
+    exchange (default: the "debate_exchange" block) decides how round-one opinions
+    are passed to round two; "done" then carries a "debate" report comparing the
+    opinion tokens sent with what the full text would have cost, and each round's time.
+    """
+    trace = trace or Trace()
+    # Installed only while this deliberation runs, so a later one in the same task starts clean
+    token = _TRACE.set(trace)
+    events = _deliberation_events(question, context, debate, synthesis, stream, early_exit, exchange, trace)
+    try:
+        async for event in events: yield event
+    finally:
+        await events.aclose()
+        with contextlib.suppress(ValueError): _TRACE.reset(token) # closed from another context, e.g. by the garbage collector
+
+async def _deliberation_events(question: str, context: str, debate: bool, synthesis: bool, stream: bool, early_exit: Optional[Dict[str, Any]],
+                               exchange: Optional[Dict[str, Any]], trace: "Trace") -> AsyncIterator[Dict[str, Any]]:
+    policy = early_exit if early_exit is not None else api_settings().get("early_exit", {})
+    report: Dict[str, Any] = {"debate_skipped": "", "early_synthesis": False, "saved_seconds": 0.0, "saved_tokens": 0}
+    debate_report: Dict[str, Any] = {}
+    results: List[Any] = [None] * len(MAGI_UNITS)
+    summary = None
+    final_round = 2 if debate else 1 # early synthesis only applies to the last round that runs for sure
+
+    async def run_round(round_no: int, opinions: List[str]) -> AsyncIterator[Dict[str, Any]]:
+        nonlocal summary
+        early = synthesis and policy.get("enabled") and policy.get("early_synthesis") and round_no == final_round
+        if not early:
+            async for event in _stream_round(round_no, results, question, context, opinions, round_no > 1, stream): yield event
+            return
+        trigger = asyncio.get_running_loop().create_future()
+        pending, seele_started, last_result, seele_finished = None, 0.0, 0.0, 0.0
+        async for src, event in _merge_streams([_stream_round(round_no, results, question, context, opinions, round_no > 1, stream),
+                                                _deferred_seele(trigger, question, stream)]):
+            if src == 1:
+                if event["type"] == "seele_done": summary, seele_finished = event["summary"], time.perf_counter()
+                else: yield event
+                continue
+            yield event
+            if event["type"] != "result": continue
+            if all(results):
+                last_result = time.perf_counter()
+                if not trigger.done(): trigger.set_result(None) # no early majority: release the idle SEELE stream
+            elif not trigger.done() and vote_decided(results):
+                pending = results.index(None)
+                trigger.set_result(list(results)); seele_started = time.perf_counter()
+        if pending is not None:
+            # Time saved is the part of SEELE that overlapped the last unit still answering. No tokens
+            # are saved: that unit's opinion is still generated and billed, only not waited for
+            report.update(early_synthesis=True, saved_seconds=round(report["saved_seconds"] + max(0.0, min(last_result, seele_finished) - seele_started), 3))
+
+    round_started = time.perf_counter()
+    async for event in run_round(1, [""] * len(MAGI_UNITS)):
+        yield event
+    round_seconds = time.perf_counter() - round_started
+
+    if debate:
+        ex = exchange if exchange is not None else api_settings().get("debate_exchange", {})
+        opinions = exchange_opinions(results, ex)
+        debate_report = {"exchange": ex.get("mode", "full"), "exclude_self": bool(ex.get("exclude_self")),
+                         "opinion_tokens": sum(estimate_tokens(o) for o in opinions),
+                         "full_text_opinion_tokens": sum(estimate_tokens(o) for o in exchange_opinions(results, {"mode": "full"})),
+                         "round_seconds": [round(round_seconds, 3)]}
+        reason = debate_skip_reason(results, policy)
+        if reason:
+            # A skipped round would have taken about as long as round one
+            report.update(debate_skipped=reason, saved_seconds=round(report["saved_seconds"] + round_seconds, 3),
+                          saved_tokens=report["saved_tokens"] + _estimate_round_tokens(question, context, opinions, results))
+        else:
+            results = [None] * len(MAGI_UNITS)
+            round_started = time.perf_counter()
+            async for event in run_round(2, opinions):
+                yield event
+            debate_report["round_seconds"].append(round(time.perf_counter() - round_started, 3))
+
+    final_score = vote_score(results)
+
+    if synthesis and summary is None:
+        async for event in _seele_stream(question, results, stream):
+            if event["type"] == "seele_done": summary = event["summary"]
+            else: yield event
+
+    yield {"type": "done", "magi_results": results, "final_score": final_score, "seele_summary": summary or "", "early_exit": report, "debate": debate_report, "trace": trace.to_dict()}
+
+async def ask_magi_system(question: str, context: str = "", debate: bool = False, synthesis: bool = True, file_name: str = "",
+                          early_exit: Optional[Dict[str, Any]] = None, exchange: Optional[Dict[str, Any]] = None,
+                          trace: Optional["Trace"] = None) -> Dict[str, Any]:
+    """Orchestrate the entire MAGI deliberation process (3 Magi + Seele)."""
+    final: Dict[str, Any] = {}
+    async for event in ask_magi_system_stream(question, context, debate, synthesis, file_name, stream=False, early_exit=early_exit, exchange=exchange, trace=trace):
+        if event["type"] == "done": final = event
     
     # Legacy support, though add_history_with_user is preferred in implementation
     # This prevents errors if called directly.
     # add_history(question, results, final_score, summary, file_name)
     
-    return {"magi_results": results, "final_score": final_score, "seele_summary": summary}
\ No newline at end of file
+    return {"magi_results": final["magi_results"], "final_score": final["final_score"], "seele_summary": final["seele_summary"], "early_exit": final["early_exit"], "debate": final["debate"], "trace": final["trace"]}
+
+# --- 8. Background Execution ---
+
+# One long-lived loop per process: pooled clients stay bound to it, and Streamlit
+# script threads only submit work and poll, instead of running asyncio.run() per click.
+_BACKGROUND: Dict[str, Any] = globals().get("_BACKGROUND", {"loop": None, "thread": None})
+_BACKGROUND_LOCK = globals().get("_BACKGROUND_LOCK", threading.Lock())
+
+def _run_background_loop(loop: asyncio.AbstractEventLoop) -> None:
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+def get_background_loop() -> asyncio.AbstractEventLoop:
+    """Return the process-wide event loop, starting its thread on first use."""
+    with _BACKGROUND_LOCK:
+        if _BACKGROUND["loop"] is None or not _BACKGROUND["thread"].is_alive():
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_run_background_loop, args=(loop,), name="magi-event-loop", daemon=True)
+            thread.start()
+            _BACKGROUND.update(loop=loop, thread=thread)
+        return _BACKGROUND["loop"]
+
+def submit_coroutine(coro: Any) -> concurrent.futures.Future:
+    """Schedule a coroutine on the background loop and return a thread-safe future."""
+    return asyncio.run_coroutine_threadsafe(coro, get_background_loop())
+
+def run_coroutine(coro: Any, timeout: Optional[float] = None) -> Any:
+    """Run a coroutine on the background loop and wait for its result."""
+    return submit_coroutine(coro).result(timeout)
+
+class DeliberationJob:
+    """Live state of a deliberation running on the background loop.
+
+    The loop thread applies stream events; the UI polls the fields and the
+    future, so a rerun or page switch does not interrupt the deliberation.
+    """
+    def __init__(self, question: str, file_name: str = ""):
+        self.question = question
+        self.file_name = file_name
+        self.round = 0
+        self.texts = [""] * len(MAGI_UNITS)
+        self.results: List[Any] = [None] * len(MAGI_UNITS)
+        self.seele_text = ""
+        self.version = 0 # Bumped on every event so pollers can skip redundant redraws
+        self.future: Optional[concurrent.futures.Future] = None
+
+    def apply(self, event: Dict[str, Any]) -> None:
+        kind = event["type"]
+        if kind == "round":
+            self.round = event["round"]
+            self.texts = [""] * len(MAGI_UNITS); self.results = [None] * len(MAGI_UNITS)
+        elif kind == "chunk": self.texts[event["index"]] += event["text"]
+        elif kind == "result": self.results[event["index"]] = event["result"]
+        elif kind == "seele_chunk": self.seele_text += event["text"]
+        self.version += 1
+
+    def done(self) -> bool:
+        return self.future is not None and self.future.done()
+
+    def result(self, timeout: Optional[float] = None) -> Dict[str, Any]:
+        return self.future.result(timeout)
+
+def submit_deliberation(user_id: str, question: str, context: str = "", debate: bool = False, synthesis: bool = True, file_name: str = "",
+                        file_content: Optional[bytes] = None, page_range: Optional[Tuple[int, int]] = None) -> DeliberationJob:
+    """Start a streaming deliberation in the background and record it to history when it completes.
+
+    An attachment passed as file_content is extracted inside the job, off the UI thread.
+    """
+    job = DeliberationJob(question, file_name)
+
+    async def run() -> Dict[str, Any]:
+        nonlocal context
+        trace = Trace()
+        if file_content is not None:
+            with trace.span("SYSTEM", "extract"):
+                context = await asyncio.to_thread(extract_text_from_file, file_content, file_name, page_range)
+        final: Dict[str, Any] = {}
+        async for event in ask_magi_system_stream(question, context, debate, synthesis, file_name, trace=trace):
+            job.apply(event)
+            if event["type"] == "done": final = event
+        res = {"magi_results": final["magi_results"], "final_score": final["final_score"], "seele_summary": final["seele_summary"], "early_exit": final["early_exit"], "debate": final["debate"]}
+        await asyncio.to_thread(add_history_with_user, user_id, question, res["magi_results"], res["final_score"], res["seele_summary"], file_name, trace)
+        return res
+
+    job.future = submit_coroutine(run())
+    return job
+
+# --- 9. Response Cache ---
+
+# Hit/miss counters are per process; the entries themselves persist in CACHE_DB_PATH.
+_CACHE_STATS: Dict[str, float] = globals().get("_CACHE_STATS", {"hits": 0, "misses": 0, "saved_seconds": 0.0})
+
+def _cache_db() -> sqlite3.Connection:
+    conn = db_connect(CACHE_DB_PATH)
+    if CACHE_DB_PATH not in _DB_READY:
+        conn.execute("CREATE TABLE IF NOT EXISTS response_cache (key TEXT PRIMARY KEY, response TEXT NOT NULL, latency REAL NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_accessed ON response_cache (accessed_at)")
+        conn.commit()
+        _DB_READY.add(CACHE_DB_PATH)
+    return conn
+
+def response_cache_key(provider: str, model: str, sys_prompt: str, user_prompt: str, temp: float, top_p: float, max_tokens: int) -> str:
+    """Content address of a completion request."""
+    raw = json.dumps([provider, model, sys_prompt, user_prompt, float(temp), float(top_p), int(max_tokens)], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def cache_get(key: str, ttl_seconds: int) -> Optional[str]:
+    """Return a cached response if present and younger than the TTL."""
+    now = time.time()
+    conn = _cache_db()
+    try:
+        row = conn.execute("SELECT response, latency, created_at FROM response_cache WHERE key = ?", (key,)).fetchone()
+        if row and now - row[2] > ttl_seconds:
+            conn.execute("DELETE FROM response_cache WHERE key = ?", (key,)); conn.commit()
+            row = None
+        if not row:
+            _CACHE_STATS["misses"] += 1
+            return None
+        conn.execute("UPDATE response_cache SET accessed_at = ? WHERE key = ?", (now, key)); conn.commit()
+        _CACHE_STATS["hits"] += 1
+        _CACHE_STATS["saved_seconds"] += row[1]
+        return row[0]
+    finally: conn.close()
+
+def cache_put(key: str, response: str, latency: float, max_entries: int) -> None:
+    """Store a response and evict least recently used entries beyond max_entries."""
+    now = time.time()
+    conn = _cache_db()
+    try:
+        conn.execute("INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?, ?)", (key, response, latency, now, now))
+        conn.execute("DELETE FROM response_cache WHERE key IN (SELECT key FROM response_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)", (max_entries,))
+        conn.commit()
+    finally: conn.close()
+
+def clear_response_cache() -> None:
+    """Drop every cached response."""
+    conn = _cache_db()
+    try:
+        conn.execute("DELETE FROM response_cache"); conn.commit()
+    finally: conn.close()
+
+def get_cache_stats() -> Dict[str, float]:
+    """Hit/miss counts and latency saved since process start, plus the current entry count."""
+    conn = _cache_db()
+    try: entries = conn.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+    finally: conn.close()
+    return {**_CACHE_STATS, "entries": entries}
+
+# --- 10. Provider Scheduling ---
+
+# Limits live under providers.<id>.limits in api_keys.json; 0 means unlimited.
+DEFAULT_PROVIDER_LIMITS = {"rpm": 0, "tpm": 0, "max_concurrency": 8}
+
+_SCHEDULERS: Dict[str, Any] = globals().get("_SCHEDULERS", {})
+
+class ProviderScheduler:
+    """Requests/min and tokens/min token buckets plus an in-flight cap, shared by every caller of one provider."""
+    def __init__(self, rpm: int = 0, tpm: int = 0, max_concurrency: int = 0):
+        self.rpm, self.tpm = rpm, tpm
+        self.requests, self.tokens = float(rpm), float(tpm)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.in_flight = 0
+        self.semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency > 0 else None
+        self.lock = asyncio.Lock() # Waiters are served in arrival order
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed, self.updated = now - self.updated, now
+        if self.rpm: self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        if self.tpm: self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+    def _wait_time(self, tokens: int) -> float:
+        wait = self.blocked_until - time.monotonic()
+        if self.rpm and self.requests < 1: wait = max(wait, (1 - self.requests) * 60 / self.rpm)
+        if self.tpm and self.tokens < tokens: wait = max(wait, (tokens - self.tokens) * 60 / self.tpm)
+        return wait
+
+    async def acquire(self, tokens: int) -> None:
+        tokens = min(tokens, self.tpm) if self.tpm else 0 # A single oversized request must still get through
+        async with self.lock:
+            while True:
+                self._refill()
+                wait = self._wait_time(tokens)
+                if wait <= 0: break
+                await asyncio.sleep(wait)
+            if self.rpm: self.requests -= 1
+            if self.tpm: self.tokens -= tokens
+
+    def debit(self, tokens: int) -> None:
+        """Charge completion tokens once they are known; the bucket may go negative."""
+        if self.tpm and tokens: self._refill(); self.tokens -= tokens
+
+    def block_for(self, seconds: float) -> None:
+        """Hold all new requests to this provider, e.g. for a Retry-After."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, tokens: int) -> AsyncIterator[None]:
+        if self.semaphore: await self.semaphore.acquire()
+        try:
+            await self.acquire(tokens)
+            self.in_flight += 1
+            try: yield
+            finally: self.in_flight -= 1
+        finally:
+            if self.semaphore: self.semaphore.release()
+
+def provider_limits(provider: str) -> Dict[str, int]:
+    """Configured limits for a provider, filled in with the defaults."""
+    cfg = api_settings().get("providers", {}).get(provider, {}).get("limits", {})
+    return {k: int(cfg.get(k, v) or 0) for k, v in DEFAULT_PROVIDER_LIMITS.items()}
+
+def provider_scheduler(provider: str) -> ProviderScheduler:
+    """Return the provider's shared scheduler, replacing it when its limits or event loop change."""
+    limits = provider_limits(provider)
+    try: loop = asyncio.get_running_loop()
+    except RuntimeError: loop = None
+    entry = _SCHEDULERS.get(provider)
+    if not entry or entry[0] is not loop or entry[1] != limits:
+        _SCHEDULERS[provider] = entry = (loop, limits, ProviderScheduler(**limits))
+    return entry[2]
+
+# --- 11. Circuit Breakers ---
+
+CIRCUIT_FAILURE_THRESHOLD = 5 # Consecutive transient failures before a provider is considered down
+CIRCUIT_COOLDOWN_SECONDS = 30.0
+
+_BREAKERS: Dict[str, "CircuitBreaker"] = globals().get("_BREAKERS", {})
+
+class CircuitBreaker:
+    """Per-provider breaker: closed -> open after repeated 5xx/timeouts -> half-open trial after a cooldown.
+
+    Rate limits and fatal errors do not count; they say nothing about whether the provider is up.
+    """
+    def __init__(self, provider: str):
+        self.provider = provider
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.last_error = ""
+
+    def before_call(self) -> None:
+        if self.state == "closed": return
+        remaining = self.opened_at + CIRCUIT_COOLDOWN_SECONDS - time.monotonic()
+        if remaining > 0:
+            raise CircuitOpenError(f"Provider {self.provider} circuit open ({self.last_error}); retry in {remaining:.0f}s.")
+        # Let one trial call through per cooldown window
+        self.state, self.opened_at = "half_open", time.monotonic()
+
+    def record_success(self) -> None:
+        self.state, self.failures = "closed", 0
+
+    def record_failure(self, e: BaseException) -> None:
+        if isinstance(e, (RateLimitError, CircuitOpenError)) or not is_retryable(e): return
+        self.failures += 1
+        self.last_error = str(e)[:200]
+        if self.state == "half_open" or self.failures >= CIRCUIT_FAILURE_THRESHOLD:
+            self.state, self.opened_at = "open", time.monotonic()
+
+    def status(self) -> Dict[str, Any]:
+        remaining = max(0.0, self.opened_at + CIRCUIT_COOLDOWN_SECONDS - time.monotonic()) if self.state != "closed" else 0.0
+        return {"state": self.state, "failures": self.failures, "last_error": self.last_error, "retry_in": remaining}
+
+def circuit_breaker(provider: str) -> CircuitBreaker:
+    if provider not in _BREAKERS: _BREAKERS[provider] = CircuitBreaker(provider)
+    return _BREAKERS[provider]
+
+def get_circuit_states() -> Dict[str, Dict[str, Any]]:
+    """Breaker status for every provider, for the admin console."""
+    return {pid: circuit_breaker(pid).status() for pid in CLIENT_PROVIDERS}
+
+def reset_circuit(provider: str) -> None:
+    """Manually close a provider's breaker."""
+    circuit_breaker(provider).record_success()
+
+# --- 12. Webhook Delivery ---
+
+# Deliveries are queued in magi.db and sent by a worker on the background loop, so the
+# page never waits on Slack/Discord and a failed send is retried instead of lost.
+WEBHOOK_TIMEOUT = 10.0
+WEBHOOK_MAX_ATTEMPTS = 6 # then the delivery moves to the dead-letter list
+WEBHOOK_BACKOFF_BASE = 2.0 # seconds before the first retry, doubled per attempt
+WEBHOOK_BACKOFF_MAX = 300.0
+WEBHOOK_BATCH = 20 # due deliveries sent concurrently per pass
+WEBHOOK_IDLE_POLL = 30.0
+WEBHOOK_CLAIM_TIMEOUT = 120.0 # a 'sending' row older than this was orphaned by a crash
+
+_WEBHOOK_WORKER: Dict[str, Any] = globals().get("_WEBHOOK_WORKER", {"future": None, "wake": None})
+_WEBHOOK_LOCK = globals().get("_WEBHOOK_LOCK", threading.Lock())
+
+def _webhook_db() -> sqlite3.Connection:
+    conn, resume = db_connect(DB_PATH), False
+    if ("webhooks", DB_PATH) not in _DB_READY:
+        with _DB_INIT_LOCK:
+            if ("webhooks", DB_PATH) not in _DB_READY:
+                conn.execute("""CREATE TABLE IF NOT EXISTS webhook_deliveries (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, webhook_id TEXT NOT NULL, title TEXT NOT NULL, payload TEXT NOT NULL,
+                    status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, last_error TEXT NOT NULL DEFAULT '',
+                    created_at REAL NOT NULL, updated_at REAL NOT NULL, next_attempt_at REAL NOT NULL)""")
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_webhook_due ON webhook_deliveries (status, next_attempt_at)")
+                conn.commit()
+                _DB_READY.add(("webhooks", DB_PATH))
+                # Deliveries left queued by a previous run are resumed without waiting for a new event
+                resume = conn.execute("SELECT 1 FROM webhook_deliveries WHERE status IN ('pending', 'sending') LIMIT 1").fetchone() is not None
+    if resume: _start_webhook_worker()
+    return conn
+
+def resume_webhook_deliveries() -> None:
+    """Open the delivery queue once per process, restarting the worker if deliveries are still pending."""
+    if ("webhooks", DB_PATH) not in _DB_READY: _webhook_db().close()
+
+def _start_webhook_worker() -> None:
+    """Run the delivery worker on the background loop, once per process."""
+    with _WEBHOOK_LOCK:
+        future = _WEBHOOK_WORKER["future"]
+        if future is None or future.done(): _WEBHOOK_WORKER["future"] = submit_coroutine(_deliver_webhooks_forever())
+
+def _wake_webhook_worker() -> None:
+    _start_webhook_worker()
+    wake = _WEBHOOK_WORKER["wake"]
+    if wake is not None: get_background_loop().call_soon_threadsafe(wake.set)
+
+def enqueue_webhooks(webhook_ids: List[str], title: str, text: str) -> List[int]:
+    """Queue one delivery per webhook and return their ids; the worker sends them concurrently."""
+    payload = json.dumps({"text": f"【MAGI SYSTEM DECISION】\n*Topic*: {title}\n\n{text}"}, ensure_ascii=False)
+    now = time.time()
+    conn = _webhook_db()
+    try:
+        ids = [conn.execute("""INSERT INTO webhook_deliveries (webhook_id, title, payload, status, created_at, updated_at, next_attempt_at)
+                               VALUES (?, ?, ?, 'pending', ?, ?, ?)""", (wid, title[:200], payload, now, now, now)).lastrowid for wid in webhook_ids]
+        conn.commit()
+    finally: conn.close()
+    _wake_webhook_worker()
+    return ids
+
+def execute_webhook_action(webhook_id: str, title: str, text: str) -> bool:
+    """Queue an external webhook action (Slack/Discord); False if the webhook has no URL."""
+    cfg = load_json(WEBHOOKS_PATH, {"webhooks": {}}).get("webhooks", {}).get(webhook_id)
+    if not cfg or not cfg.get("url"): return False
+    enqueue_webhooks([webhook_id], title, text)
+    return True
+
+def broadcast_webhook(title: str, text: str) -> List[str]:
+    """Queue the decision for every active webhook with a URL, returning the ids it was queued for."""
+    webhooks = load_json(WEBHOOKS_PATH, {"webhooks": {}}).get("webhooks", {})
+    targets = [wid for wid, cfg in webhooks.items() if cfg.get("active") and cfg.get("url")]
+    if targets: enqueue_webhooks(targets, title, text)
+    return targets
+
+def _claim_due_webhooks(limit: int) -> List[Tuple[int, str, str, int]]:
+    """Mark up to `limit` due deliveries as 'sending' and return (id, webhook_id, payload, attempts)."""
+    now = time.time()
+    conn = _webhook_db()
+    try:
+        rows = conn.execute("SELECT id, webhook_id, payload, attempts FROM webhook_deliveries WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+                            (now, limit)).fetchall()
+        # The status check makes the claim safe against a worker in another process
+        claimed = [r for r in rows if conn.execute("UPDATE webhook_deliveries SET status = 'sending', updated_at = ? WHERE id = ? AND status = 'pending'", (now, r[0])).rowcount]
+        conn.commit()
+    finally: conn.close()
+    return claimed
+
+def _next_webhook_due() -> Optional[float]:
+    """Seconds until the earliest pending delivery is due, or None if the queue is empty."""
+    conn = _webhook_db()
+    try: row = conn.execute("SELECT MIN(next_attempt_at) FROM webhook_deliveries WHERE status = 'pending'").fetchone()
+    finally: conn.close()
+    return None if row[0] is None else max(0.0, row[0] - time.time())
+
+def _release_stale_claims() -> None:
+    conn = _webhook_db()
+    try:
+        conn.execute("UPDATE webhook_deliveries SET status = 'pending' WHERE status = 'sending' AND updated_at < ?", (time.time() - WEBHOOK_CLAIM_TIMEOUT,))
+        conn.commit()
+    finally: conn.close()
+
+def _finish_delivery(delivery_id: int, attempts: int, outcome: str, error: str, retry_after: float) -> None:
+    """Record one attempt: delivered, rescheduled with exponential backoff, or dead-lettered."""
+    if outcome == "retry" and attempts >= WEBHOOK_MAX_ATTEMPTS: outcome = "dead"
+    now = time.time()
+    status = {"delivered": "delivered", "retry": "pending", "dead": "dead"}[outcome]
+    next_at = now + max(min(WEBHOOK_BACKOFF_MAX, WEBHOOK_BACKOFF_BASE * 2 ** (attempts - 1)), retry_after) if status == "pending" else now
+    conn = _webhook_db()
+    try:
+        conn.execute("UPDATE webhook_deliveries SET status = ?, attempts = ?, last_error = ?, updated_at = ?, next_attempt_at = ? WHERE id = ?",
+                     (status, attempts, error[:500], now, next_at, delivery_id))
+        conn.commit()
+    finally: conn.close()
+
+async def _send_webhook(http: httpx.AsyncClient, url: str, payload: str) -> Tuple[str, str, float]:
+    """POST one payload, returning (outcome, error, retry_after) with outcome 'delivered', 'retry' or 'dead'."""
+    try:
+        res = await http.post(url, content=payload.encode("utf-8"), headers={"Content-Type": "application/json"}, timeout=WEBHOOK_TIMEOUT)
+    except Exception as e:
+        return ("retry" if is_retryable(e) else "dead"), f"{type(e).__name__}: {e}", 0.0
+    if res.status_code < 300: return "delivered", "", 0.0
+    try: retry_after = float(res.headers.get("retry-after", 0))
+    except ValueError: retry_after = 0.0
+    retryable = res.status_code in (408, 409, 429) or res.status_code >= 500
+    return ("retry" if retryable else "dead"), f"HTTP {res.status_code}: {res.text[:200]}", retry_after
+
+async def _deliver_webhook(http: httpx.AsyncClient, delivery: Tuple[int, str, str, int]) -> None:
+    delivery_id, webhook_id, payload, attempts = delivery
+    # The URL is resolved at send time, so fixing a webhook's config rescues its retries
+    url = load_json(WEBHOOKS_PATH, {"webhooks": {}}).get("webhooks", {}).get(webhook_id, {}).get("url")
+    outcome, error, retry_after = await _send_webhook(http, url, payload) if url else ("dead", f"Webhook {webhook_id} has no URL.", 0.0)
+    await asyncio.to_thread(_finish_delivery, delivery_id, attempts + 1, outcome, error, retry_after)
+
+async def _deliver_webhooks_forever() -> None:
+    wake = _WEBHOOK_WORKER["wake"] = asyncio.Event()
+    await asyncio.to_thread(_release_stale_claims)
+    while True:
+        wake.clear()
+        try:
+            batch = await asyncio.to_thread(_claim_due_webhooks, WEBHOOK_BATCH)
+            if batch:
+                http = _client_pool()["http"]
+                await asyncio.gather(*(_deliver_webhook(http, d) for d in batch))
+                continue
+            due = await asyncio.to_thread(_next_webhook_due)
+        except Exception as e:
+            print(f"Webhook delivery failed: {e}"); due = None
+        try: await asyncio.wait_for(wake.wait(), timeout=WEBHOOK_IDLE_POLL if due is None else min(due, WEBHOOK_IDLE_POLL))
+        except asyncio.TimeoutError: pass
+
+def get_webhook_stats() -> Dict[str, int]:
+    """Delivery counts by status: pending, sending, delivered and dead."""
+    conn = _webhook_db()
+    try: counts = dict(conn.execute("SELECT status, COUNT(*) FROM webhook_deliveries GROUP BY status").fetchall())
+    finally: conn.close()
+    return {s: counts.get(s, 0) for s in ("pending", "sending", "delivered", "dead")}
+
+def list_webhook_deliveries(status: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
+    """Most recently updated deliveries, optionally with one status."""
+    where, params = ("WHERE status = ?", [status]) if status else ("", [])
+    conn = _webhook_db()
+    try:
+        rows = conn.execute(f"SELECT id, webhook_id, title, status, attempts, last_error, created_at, updated_at FROM webhook_deliveries {where} ORDER BY updated_at DESC, id DESC LIMIT ?",
+                            params + [limit]).fetchall()
+    finally: conn.close()
+    keys = ("id", "webhook_id", "title", "status", "attempts", "last_error", "created_at", "updated_at")
+    return [dict(zip(keys, r)) for r in rows]
+
+def retry_dead_webhooks() -> int:
+    """Move every dead-lettered delivery back onto the queue with a fresh attempt budget."""
+    now = time.time()
+    conn = _webhook_db()
+    try:
+        count = conn.execute("UPDATE webhook_deliveries SET status = 'pending', attempts = 0, next_attempt_at = ?, updated_at = ? WHERE status = 'dead'", (now, now)).rowcount
+        conn.commit()
+    finally: conn.close()
+    if count: _wake_webhook_worker()
+    return count
+
+def clear_webhook_deliveries(status: str) -> int:
+    """Delete delivered or dead deliveries from the log."""
+    conn = _webhook_db()
+    try:
+        count = conn.execute("DELETE FROM webhook_deliveries WHERE status = ?", (status,)).rowcount
+        conn.commit()
+    finally: conn.close()
+    return count
+
+# --- 13. Metrics ---
+
+# Per-attempt provider metrics for this process, labelled by provider, model and the
+# persona that made the call (set through _METRIC_PERSONA by the deliberation code).
+LATENCY_BUCKETS = (0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+METRIC_SAMPLES = 1000 # recent successful attempts kept per persona for percentiles
+METRICS_PATH = os.path.join(BASE_DIR, "metrics.prom")
+
+_METRIC_PERSONA: "contextvars.ContextVar[str]" = globals().get("_METRIC_PERSONA", contextvars.ContextVar("magi_metric_persona", default=""))
+_METRICS_LOCK = globals().get("_METRICS_LOCK", threading.Lock())
+_METRICS: Dict[str, Any] = globals().get("_METRICS", {
+    "latency": {}, "ttft": {}, # (provider, model, persona) -> Histogram
+    "tokens": collections.Counter(), # (provider, model, persona, kind)
+    "attempts": collections.Counter(), # (provider, model, persona, outcome)
+    "errors": collections.Counter(), # (provider, model, error_class, error_type)
+    "success_attempt": collections.Counter(), # (provider, model, attempt number)
+    "samples": {}, # persona -> deque of (latency, ttft, prompt_tokens, completion_tokens, cached_prompt_tokens)
+})
+
+class Histogram:
+    """Cumulative-bucket latency histogram in the Prometheus layout."""
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum, self.count = 0.0, 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value; self.count += 1
+
+@contextlib.contextmanager
+def metric_persona(name: str) -> Iterator[None]:
+    """Attribute provider calls made inside the block (and tasks it starts) to a persona."""
+    token = _METRIC_PERSONA.set(name)
+    try: yield
+    finally:
+        # An async generator finalised outside its task cannot reset; the value then dies with that task
+        with contextlib.suppress(ValueError): _METRIC_PERSONA.reset(token)
+
+def record_provider_call(provider: str, model: str, attempt: int, seconds: float, ttft: Optional[float] = None,
+                         tokens: Optional[Tuple[int, int]] = None, error: Optional[BaseException] = None, cache: Optional[Tuple[int, int]] = None) -> None:
+    """Record one provider attempt: its outcome, latency, time to first token and token usage.
+
+    cache is (read, written) prompt-cache tokens, already included in the prompt count.
+    """
+    persona = _METRIC_PERSONA.get() or "-"
+    key = (provider, model, persona)
+    with _METRICS_LOCK:
+        if error is not None:
+            cls = classify_error(error)
+            _METRICS["attempts"][key + (cls,)] += 1
+            _METRICS["errors"][(provider, model, cls, type(error).__name__)] += 1
+            return
+        _METRICS["attempts"][key + ("success",)] += 1
+        _METRICS["success_attempt"][(provider, model, attempt)] += 1
+        _METRICS["latency"].setdefault(key, Histogram()).observe(seconds)
+        if ttft is not None: _METRICS["ttft"].setdefault(key, Histogram()).observe(ttft)
+        prompt, completion = tokens or (0, 0)
+        _METRICS["tokens"][key + ("prompt",)] += prompt
+        _METRICS["tokens"][key + ("completion",)] += completion
+        cache_read, cache_write = cache or (0, 0)
+        if cache_read: _METRICS["tokens"][key + ("cache_read",)] += cache_read
+        if cache_write: _METRICS["tokens"][key + ("cache_write",)] += cache_write
+        _METRICS["samples"].setdefault(persona, collections.deque(maxlen=METRIC_SAMPLES)).append((seconds, ttft if ttft is not None else seconds, prompt, completion, cache_read))
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values: return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def get_persona_metrics() -> Dict[str, Dict[str, float]]:
+    """p50/p95/p99 latency and time to first token per persona over its recent successful attempts."""
+    with _METRICS_LOCK:
+        samples = {p: list(d) for p, d in _METRICS["samples"].items()}
+        attempts = dict(_METRICS["attempts"])
+    out = {}
+    for persona, rows in sorted(samples.items()):
+        lat, ttft = [r[0] for r in rows], [r[1] for r in rows]
+        failed = sum(n for (_, _, p, outcome), n in attempts.items() if p == persona and outcome != "success")
+        out[persona] = {"calls": len(rows), "failed_attempts": failed,
+                        **{f"latency_p{q}": _percentile(lat, q / 100) for q in (50, 95, 99)},
+                        **{f"ttft_p{q}": _percentile(ttft, q / 100) for q in (50, 95, 99)},
+                        "prompt_tokens": sum(r[2] for r in rows), "completion_tokens": sum(r[3] for r in rows), "cached_tokens": sum(r[4] for r in rows)}
+    return out
+
+def _labels(**labels: Any) -> str:
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels.items()) + "}"
+
+def render_prometheus() -> str:
+    """All provider metrics in the Prometheus text exposition format."""
+    lines: List[str] = []
+    with _METRICS_LOCK:
+        for name, source, help_text in (("magi_provider_request_seconds", "latency", "Provider call latency per successful attempt."),
+                                        ("magi_provider_ttft_seconds", "ttft", "Time to first token per successful attempt.")):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+            for (provider, model, persona), h in sorted(_METRICS[source].items(), key=lambda kv: kv[0]):
+                base = dict(provider=provider, model=model, persona=persona)
+                cumulative = 0
+                for bound, n in zip(list(LATENCY_BUCKETS) + ["+Inf"], h.counts):
+                    cumulative += n
+                    lines.append(f"{name}_bucket{_labels(**base, le=bound)} {cumulative}")
+                lines.append(f"{name}_sum{_labels(**base)} {h.sum:.6f}")
+                lines.append(f"{name}_count{_labels(**base)} {h.count}")
+        lines += ["# HELP magi_provider_tokens_total Tokens reported by the provider (estimated when it reports none); cache_read/cache_write are part of prompt.", "# TYPE magi_provider_tokens_total counter"]
+        lines += [f"magi_provider_tokens_total{_labels(provider=p, model=m, persona=pe, type=k)} {n}" for (p, m, pe, k), n in sorted(_METRICS["tokens"].items())]
+        lines += ["# HELP magi_provider_attempts_total Provider attempts by outcome (success, retryable, fatal).", "# TYPE magi_provider_attempts_total counter"]
+        lines += [f"magi_provider_attempts_total{_labels(provider=p, model=m, persona=pe, outcome=o)} {n}" for (p, m, pe, o), n in sorted(_METRICS["attempts"].items())]
+        lines += ["# HELP magi_provider_errors_total Failed attempts by error class and exception type.", "# TYPE magi_provider_errors_total counter"]
+        lines += [f"magi_provider_errors_total{_labels(provider=p, model=m, error_class=c, error_type=t)} {n}" for (p, m, c, t), n in sorted(_METRICS["errors"].items())]
+        lines += ["# HELP magi_provider_success_attempt_total Calls by the attempt number that succeeded (1 = no retry).", "# TYPE magi_provider_success_attempt_total counter"]
+        lines += [f"magi_provider_success_attempt_total{_labels(provider=p, model=m, attempt=a)} {n}" for (p, m, a), n in sorted(_METRICS["success_attempt"].items())]
+    return "\n".join(lines) + "\n"
+
+def write_metrics_file(path: str = METRICS_PATH) -> None:
+    """Write render_prometheus() atomically, e.g. for a node_exporter textfile collector."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".metrics.", suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f: f.write(render_prometheus())
+    os.replace(tmp, path)
+
+def reset_metrics() -> None:
+    with _METRICS_LOCK:
+        for v in _METRICS.values(): v.clear()
+
+# --- 14. Tracing ---
+
+# A Trace collects timed spans for one deliberation. It is found through a context
+# variable, so the unit tasks and provider attempts started under it add to the same trace.
+_TRACE: "contextvars.ContextVar[Optional[Trace]]" = globals().get("_TRACE", contextvars.ContextVar("magi_trace", default=None))
+
+class Trace:
+    """Spans of one deliberation, timed with perf_counter and reported relative to its start."""
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.spans: List[Dict[str, Any]] = []
+        self.lock = threading.Lock() # extraction and history writes add spans from worker threads
+
+    def add(self, lane: str, name: str, start: float, end: float, status: str = "ok") -> None:
+        with self.lock: self.spans.append({"lane": lane, "name": name, "start": start, "end": end, "status": status})
+
+    @contextlib.contextmanager
+    def span(self, lane: str, name: str) -> Iterator[None]:
+        start, status = time.perf_counter(), "ok"
+        try: yield
+        except BaseException as e:
+            status = "cancelled" if isinstance(e, (asyncio.CancelledError, GeneratorExit)) else f"error: {type(e).__name__}"
+            raise
+        finally: self.add(lane, name, start, time.perf_counter(), status)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self.lock: spans = sorted(self.spans, key=lambda s: s["start"])
+        rel = lambda t: round(t - self.t0, 3)
+        return {"total": rel(max([s["end"] for s in spans], default=self.t0)),
+                "spans": [{**s, "start": rel(s["start"]), "end": rel(s["end"])} for s in spans]}
+
+def current_trace() -> Optional[Trace]:
+    return _TRACE.get()
+
+@contextlib.contextmanager
+def trace_span(lane: str, name: str) -> Iterator[None]:
+    """Time a block into the current trace; a no-op when nothing is being traced."""
+    trace = _TRACE.get()
+    if trace is None:
+        yield
+        return
+    with trace.span(lane, name): yield
+
+def trace_attempt(provider: str, model: str, attempt: int, requested: float, started: float, status: str) -> None:
+    """Add one provider attempt, and any wait for a scheduler slot before it, to the current trace."""
+    trace = _TRACE.get()
+    if trace is None: return
+    lane = _METRIC_PERSONA.get() or "-"
+    if started - requested > 0.005: trace.add(lane, f"wait {provider}", requested, started)
+    trace.add(lane, f"{provider}:{model} #{attempt}", started, time.perf_counter(), status)
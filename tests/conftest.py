@@ -0,0 +1,14 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench import scenarios
+
+@pytest.fixture
+def workspace():
+    """Every magi_core store in a temp dir; providers point at a closed port unless a test starts the mock LLM."""
+    with scenarios.isolated_workspace("http://127.0.0.1:9/v1") as workdir:
+        yield workdir
@@ -0,0 +1,122 @@
+"""HTTP API against the bench mock provider: auth, backpressure and Server-Sent Events."""
+import asyncio
+import base64
+import contextlib
+import json
+
+from aiohttp.test_utils import TestClient, TestServer
+
+import magi_api
+import magi_core
+from bench import mock_llm, scenarios
+
+@contextlib.asynccontextmanager
+async def api(workers=1, queue_size=4, **mock_settings):
+    """A client for a fresh API app whose personas and SEELE talk to an in-process mock LLM."""
+    mock = mock_llm.MockLLMServer(**{"ttft_ms": 5, "ttft_sigma": 0, "tokens_per_sec": 5000, "completion_tokens": 20, "seed": 1, **mock_settings})
+    base_url = await mock.start()
+    try:
+        with scenarios.isolated_workspace(base_url):
+            config = magi_core.load_api_config()
+            config["auth"]["hash_iterations"] = 1000
+            magi_core.save_api_config(config)
+            magi_core.add_user("shinji", "unit01", "Shinji Ikari", "Pilot")
+            magi_core.add_user("asuka", "unit02", "Asuka Langley", "Pilot")
+            app = magi_api.create_app(workers, queue_size)
+            async with TestClient(TestServer(app)) as client:
+                yield client
+    finally:
+        await mock.stop()
+
+async def login(client, username="shinji", password="unit01"):
+    res = await client.post("/v1/sessions", json={"username": username, "password": password})
+    assert res.status == 200
+    return {"Authorization": f"Bearer {(await res.json())['token']}"}
+
+async def wait_status(client, headers, job_id, statuses, timeout=20.0):
+    for _ in range(int(timeout / 0.05)):
+        body = await (await client.get(f"/v1/deliberations/{job_id}", headers=headers)).json()
+        if body["status"] in statuses: return body
+        await asyncio.sleep(0.05)
+    raise AssertionError(f"job {job_id} never reached {statuses}")
+
+def parse_sse(text):
+    events = []
+    for block in text.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((int(fields["id"]), fields["event"], json.loads(fields["data"])))
+    return events
+
+def test_login_rejects_bad_credentials_and_bodies():
+    async def scenario():
+        async with api() as client:
+            assert (await client.post("/v1/sessions", json={"username": "shinji", "password": "wrong"})).status == 401
+            assert (await client.post("/v1/sessions", data="not json")).status == 400
+            assert (await client.post("/v1/sessions", json=["shinji", "unit01"])).status == 400
+            assert (await client.post("/v1/sessions", json="shinji")).status == 400
+    asyncio.run(scenario())
+
+def test_endpoints_require_a_session():
+    async def scenario():
+        async with api() as client:
+            assert (await client.post("/v1/deliberations", json={"question": "q"})).status == 401
+            bad = {"Authorization": "Bearer not-a-token"}
+            assert (await client.post("/v1/deliberations", json={"question": "q"}, headers=bad)).status == 401
+            assert (await client.get("/v1/deliberations/x", headers=bad)).status == 401
+            assert (await client.get("/v1/deliberations/x/events", headers=bad)).status == 401
+    asyncio.run(scenario())
+
+def test_submit_validates_the_body():
+    async def scenario():
+        async with api() as client:
+            headers = await login(client)
+            for body in ([1, 2], "question", {"question": "  "}, {"question": "q", "pages": "50-10"}, {"question": "q", "file_base64": "!!"}):
+                assert (await client.post("/v1/deliberations", json=body, headers=headers)).status == 400
+    asyncio.run(scenario())
+
+def test_deliberation_streams_events_and_records_the_result():
+    async def scenario():
+        async with api() as client:
+            headers = await login(client)
+            upload = base64.b64encode("第3新東京市の防衛計画".encode("utf-8")).decode()
+            res = await client.post("/v1/deliberations", json={"question": "使徒を迎撃すべきか", "file_name": "plan.txt", "file_base64": upload}, headers=headers)
+            assert res.status == 202
+            job_id = (await res.json())["id"]
+
+            res = await client.get(f"/v1/deliberations/{job_id}/events", headers=headers)
+            assert res.headers["Content-Type"].startswith("text/event-stream")
+            events = parse_sse(await res.text())
+            assert [i for i, _, _ in events] == list(range(len(events)))
+            kinds = [kind for _, kind, _ in events]
+            assert kinds[0] == "round" and kinds[-1] == "done" and "result" in kinds
+
+            body = await wait_status(client, headers, job_id, ("done", "error"))
+            assert body["status"] == "done"
+            assert len(body["result"]["magi_results"]) == 3
+            assert body["result"]["final_score"] == events[-1][2]["final_score"]
+            # The upload is dropped once its text has been extracted
+            assert client.server.app["jobs"][job_id].params["file_content"] is None
+
+            # Last-Event-ID resumes after the given event
+            res = await client.get(f"/v1/deliberations/{job_id}/events", headers={**headers, "Last-Event-ID": str(len(events) - 2)})
+            assert [kind for _, kind, _ in parse_sse(await res.text())] == ["done"]
+
+            # Another user cannot see the job
+            other = await login(client, "asuka", "unit02")
+            assert (await client.get(f"/v1/deliberations/{job_id}", headers=other)).status == 404
+    asyncio.run(scenario())
+
+def test_full_queue_answers_429():
+    async def scenario():
+        async with api(workers=1, queue_size=1, ttft_ms=3000) as client:
+            headers = await login(client)
+            first = await client.post("/v1/deliberations", json={"question": "first"}, headers=headers)
+            assert first.status == 202
+            await wait_status(client, headers, (await first.json())["id"], ("running",))
+            assert (await client.post("/v1/deliberations", json={"question": "queued"}, headers=headers)).status == 202
+            rejected = await client.post("/v1/deliberations", json={"question": "rejected"}, headers=headers)
+            assert rejected.status == 429
+            assert rejected.headers["Retry-After"] == "30"
+            health = await (await client.get("/health")).json()
+            assert health["queued"] == 1 and health["queue_size"] == 1
+    asyncio.run(scenario())
@@ -0,0 +1,30 @@
+"""Context budgeting for attached material."""
+import magi_core
+
+# Japanese prose: about one token per character, the app's usual material
+FILLER = "第3新東京市の防衛計画に関する検討資料であり、予算と人員の配分を記述する。"
+KEY = "使徒迎撃にはエヴァンゲリオン初号機と零号機の同時展開が必要である。"
+
+def japanese_document(paragraphs=400, key_at=237):
+    lines = [FILLER * 3 for _ in range(paragraphs)]
+    lines[key_at] = KEY * 2
+    return "\n".join(lines)
+
+def test_chunks_fit_the_token_size():
+    chunks = magi_core._split_chunks(japanese_document() + "\n" + "長" * 5000)
+    assert chunks and all(magi_core.estimate_tokens(c) <= magi_core.CONTEXT_CHUNK_TOKENS for c in chunks)
+
+def test_japanese_document_at_the_minimum_budget():
+    doc = japanese_document()
+    budget = 500 # the lowest context_budget the admin panel accepts
+    assert magi_core.estimate_tokens(doc) > 40 * budget
+    selected = magi_core.select_context(doc, "使徒迎撃の初号機展開", budget)
+    assert KEY in selected
+    assert budget // 2 < magi_core.estimate_tokens(selected) <= budget
+
+def test_budget_below_one_chunk_keeps_the_best_passage():
+    selected = magi_core.ContextIndex(japanese_document()).select("使徒迎撃の初号機展開", 50)
+    assert selected and magi_core.estimate_tokens(selected) <= 50
+
+def test_small_documents_pass_through():
+    assert magi_core.select_context("short note", "question", 500) == "short note"
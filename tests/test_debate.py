@@ -0,0 +1,44 @@
+"""Opinion exchange between debate rounds."""
+import magi_core
+
+REASON = "理由: " + "初号機の同時展開が必要である。" * 40
+RESULTS = [
+    ("MELCHIOR-1", REASON + "\n条件: なし\n結論: 【是認】", "是認", ""),
+    ("BALTHASAR-2", REASON + "\n条件: 予算を確保すること\n結論: 【条件付是認】", "条件付是認", "予算を確保すること"),
+    ("CASPER-3", "理由: 危険すぎる。\n条件: なし\n結論: 【否認】", "否認", ""),
+]
+
+def brief_parts(opinion):
+    """(condition, reasoning) characters of one digest entry."""
+    lines = dict(line.split(": ", 1) for line in opinion.splitlines()[1:])
+    return lines.get("条件", ""), lines.get("要旨", "")
+
+def test_full_mode_passes_opinions_verbatim():
+    opinions = magi_core.exchange_opinions(RESULTS, {"mode": "full"})
+    assert len(opinions) == 3
+    assert all(o == "\n---\n".join(f"{r[0]}: {r[1]}" for r in RESULTS) for o in opinions)
+
+def test_exclude_self_leaves_out_the_units_own_opinion():
+    opinions = magi_core.exchange_opinions(RESULTS, {"mode": "full", "exclude_self": True})
+    for i, opinion in enumerate(opinions):
+        assert RESULTS[i][0] + ":" not in opinion
+        assert all(r[0] + ":" in opinion for j, r in enumerate(RESULTS) if j != i)
+
+def test_digest_is_capped_at_digest_chars():
+    for cap in (40, 100, magi_core.DEBATE_DIGEST_CHARS):
+        for entry in magi_core.exchange_opinions(RESULTS, {"mode": "digest", "digest_chars": cap})[0].split("\n---\n"):
+            condition, reasoning = brief_parts(entry)
+            assert len(condition) + len(reasoning.rstrip("…")) <= cap
+
+def test_digest_keeps_the_vote_and_condition():
+    entries = magi_core.exchange_opinions(RESULTS, {"mode": "digest"})[0].split("\n---\n")
+    assert entries[0].startswith("MELCHIOR-1: 結論【是認】")
+    assert "条件: 予算を確保すること" in entries[1]
+    assert "条件" not in entries[0] # no condition line for an opinion without one
+    assert brief_parts(entries[2])[1] == "危険すぎる。" # short reasoning passes through whole
+    assert "結論: 【" not in "".join(entries) # the raw conclusion line is not repeated
+
+def test_digest_is_much_shorter_than_the_full_text():
+    full = sum(magi_core.estimate_tokens(o) for o in magi_core.exchange_opinions(RESULTS, {"mode": "full"}))
+    digest = sum(magi_core.estimate_tokens(o) for o in magi_core.exchange_opinions(RESULTS, {"mode": "digest"}))
+    assert digest < full / 2
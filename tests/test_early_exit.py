@@ -0,0 +1,20 @@
+"""Early decision: settled votes and skipped debate rounds."""
+import magi_core
+
+YES, COND, NO = ("A", "", "是認", ""), ("B", "", "条件付是認", ""), ("C", "", "否認", "")
+
+def test_vote_decided():
+    assert not magi_core.vote_decided([None, None, None])
+    assert not magi_core.vote_decided([YES, None, None])
+    assert magi_core.vote_decided([YES, YES, None]) # +2 cannot be undone by one vote
+    assert not magi_core.vote_decided([YES, NO, None])
+    assert not magi_core.vote_decided([YES, COND, None]) # the last vote still decides the sign
+    assert magi_core.vote_decided([NO, NO, None])
+    assert not magi_core.vote_decided([YES, COND, NO]) # a tie at 0 is settled but never "decided"
+
+def test_debate_skip_reason():
+    policy = {"enabled": True, "skip_debate_unanimous": True, "skip_debate_score": 0}
+    assert magi_core.debate_skip_reason([YES, YES, YES], policy) == "unanimous"
+    assert magi_core.debate_skip_reason([YES, YES, NO], policy) == ""
+    assert magi_core.debate_skip_reason([YES, YES, COND], {**policy, "skip_debate_score": 2}) == "score +2"
+    assert magi_core.debate_skip_reason([YES, YES, YES], {**policy, "enabled": False}) == ""
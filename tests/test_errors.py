@@ -0,0 +1,45 @@
+"""Provider error classification and rate-limit wrapping."""
+import asyncio
+
+import httpx
+import pytest
+
+import magi_core
+
+class ApiError(Exception):
+    """Shaped like the SDK errors: a message plus an HTTP status."""
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+@pytest.mark.parametrize("error, expected", [
+    (ApiError("Too Many Requests", 429), "retryable"),
+    (ApiError("Internal Server Error", 500), "retryable"),
+    (ApiError("Service Unavailable", 503), "retryable"),
+    (ApiError("Request Timeout", 408), "retryable"),
+    (ApiError("Invalid API key", 401), "fatal"),
+    (ApiError("Not found", 404), "fatal"),
+    (ApiError("This model's maximum context length is 8192 tokens, however your messages resulted in 14290 tokens", 400), "fatal"),
+    (magi_core.RateLimitError("429"), "retryable"),
+    (magi_core.ProviderConfigError("Provider groq not configured."), "fatal"),
+    (magi_core.CircuitOpenError("open"), "fatal"),
+    (asyncio.TimeoutError(), "retryable"),
+    (ConnectionError("refused"), "retryable"),
+    (httpx.ConnectError("refused"), "retryable"),
+    (httpx.UnsupportedProtocol("Request URL is missing an 'http://' or 'https://' protocol."), "fatal"),
+    (Exception("429 Resource has been exhausted (e.g. check quota)."), "retryable"),
+    (Exception("The model is overloaded"), "retryable"),
+    (Exception("Invalid argument: temperature"), "fatal"),
+    (Exception("prompt resulted in 14290 tokens"), "fatal"),
+])
+def test_classify_error(error, expected):
+    assert magi_core.classify_error(error) == expected
+
+def test_status_code_decides_before_the_message():
+    context_error = ApiError("messages resulted in 14290 tokens; quota for context exceeded", 400)
+    assert magi_core._wrap_provider_error(context_error) is context_error
+    assert not magi_core.is_retryable(magi_core._wrap_provider_error(context_error))
+
+def test_rate_limits_are_wrapped():
+    assert isinstance(magi_core._wrap_provider_error(ApiError("slow down", 429)), magi_core.RateLimitError)
+    assert isinstance(magi_core._wrap_provider_error(Exception("Rate limit reached for model")), magi_core.RateLimitError)
@@ -0,0 +1,46 @@
+"""Failover between persona targets when the primary provider is rate limited."""
+import asyncio
+import time
+
+import pytest
+from openai import AsyncOpenAI
+
+import magi_core
+from bench import mock_llm
+
+async def collect(gen):
+    return "".join([chunk async for chunk in gen])
+
+def run_with_mocks(scenario):
+    """Run scenario(limited_client, healthy_client, limited_mock) against a 429-only mock and a healthy one."""
+    async def main():
+        limited = mock_llm.MockLLMServer(ttft_ms=1, ttft_sigma=0, tokens_per_sec=5000, completion_tokens=10, error_rate=1.0, retry_after=5, seed=1)
+        healthy = mock_llm.MockLLMServer(ttft_ms=1, ttft_sigma=0, tokens_per_sec=5000, completion_tokens=10, seed=1)
+        urls = [await limited.start(), await healthy.start()]
+        clients = [AsyncOpenAI(api_key="x", base_url=url, max_retries=0) for url in urls]
+        try: return await scenario(*clients, limited)
+        finally:
+            for c in clients: await c.close()
+            await limited.stop(); await healthy.stop()
+            for provider in ("local", "openai"): magi_core.reset_circuit(provider)
+    return asyncio.run(main())
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_rate_limited_primary_hands_over_without_backoff(workspace, stream):
+    async def scenario(limited, healthy, limited_mock):
+        started = time.perf_counter()
+        text = await collect(magi_core.failover_chunks([("local", "mock-model"), ("openai", "mock-model")], "system", "user", 0.5,
+                                                       {"local": limited, "openai": healthy}, stream=stream, use_cache=False))
+        return text, time.perf_counter() - started, limited_mock.stats["requests"]
+    text, elapsed, primary_requests = run_with_mocks(scenario)
+    assert "結論" in text
+    assert primary_requests == 1
+    assert elapsed < 2 # the 429 asked for 5 s; RETRY_POLICY would wait far longer
+
+def test_last_target_keeps_the_full_retry_policy():
+    policy = magi_core._retry_policy(False)
+    assert policy is magi_core.RETRY_POLICY
+    shortened = magi_core._retry_policy(True)
+    assert not shortened["retry"].predicate(magi_core.RateLimitError("429"))
+    assert not shortened["retry"].predicate(ConnectionError("refused"))
+    assert shortened["retry"].predicate(Exception("HTTP 503 Service Unavailable"))
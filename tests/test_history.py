@@ -0,0 +1,51 @@
+"""History store: paging, per-user queries and the analytics date filters."""
+import pytest
+
+import magi_core
+
+def entry(n, day, user, votes):
+    return {"id": f"e{n}", "timestamp": f"{day}T12:00:{n % 60:02d}", "user_id": user, "question": f"q{n}", "file_name": "",
+            "results": [{"name": name, "reason": "", "vote": vote, "condition": ""} for name, vote in zip(("MELCHIOR-1", "BALTHASAR-2", "CASPER-3"), votes)],
+            "final_score": 0, "seele_summary": ""}
+
+@pytest.fixture
+def history(workspace):
+    rows = [entry(1, "2026-01-01", "shinji", ("是認", "是認", "否認")),
+            entry(2, "2026-01-15", "asuka", ("否認", "否認", "否認")),
+            entry(3, "2026-02-01", "shinji", ("是認", "条件付是認", "是認")),
+            entry(4, "2026-02-28", "rei", ("条件付是認", "是認", "否認"))]
+    conn = magi_core._history_db()
+    try:
+        for row in rows: magi_core._insert_history(conn, row)
+        conn.commit()
+    finally: conn.close()
+    return rows
+
+def test_query_history_is_newest_first_and_pages(history):
+    assert [e["id"] for e in magi_core.query_history()] == ["e4", "e3", "e2", "e1"]
+    assert [e["id"] for e in magi_core.query_history(limit=2, offset=1)] == ["e3", "e2"]
+    assert [e["id"] for e in magi_core.query_history(limit=None)] == ["e4", "e3", "e2", "e1"]
+
+def test_query_history_for_one_user(history):
+    assert [e["id"] for e in magi_core.query_history("shinji")] == ["e3", "e1"]
+    assert magi_core.query_history("nobody") == []
+
+def test_analytics_all_time(history):
+    stats = magi_core.get_analytics()
+    assert stats["votes"] == {"是認": 5, "条件付是認": 2, "否認": 5}
+    assert sorted(stats["daily"]) == ["2026-01-01", "2026-01-15", "2026-02-01", "2026-02-28"]
+    assert stats["personas"]["MELCHIOR"]["count"] == 4
+
+def test_analytics_date_range_is_inclusive(history):
+    stats = magi_core.get_analytics(start_day="2026-01-15", end_day="2026-02-01")
+    assert sorted(stats["daily"]) == ["2026-01-15", "2026-02-01"]
+    assert stats["votes"] == {"是認": 2, "条件付是認": 1, "否認": 3}
+
+def test_analytics_open_ended_ranges(history):
+    assert sorted(magi_core.get_analytics(start_day="2026-02-01")["daily"]) == ["2026-02-01", "2026-02-28"]
+    assert sorted(magi_core.get_analytics(end_day="2026-01-01")["daily"]) == ["2026-01-01"]
+    assert magi_core.get_analytics(start_day="2027-01-01")["votes"] == {"是認": 0, "条件付是認": 0, "否認": 0}
+
+def test_analytics_for_one_user_and_range(history):
+    stats = magi_core.get_analytics("shinji", start_day="2026-02-01")
+    assert stats["votes"] == {"是認": 2, "条件付是認": 1, "否認": 0}
@@ -0,0 +1,23 @@
+"""JSON stores: the shared read cache."""
+import json
+import os
+
+import magi_core
+
+def test_same_size_write_within_one_mtime_tick_is_seen(workspace):
+    path = os.path.join(workspace, "users.json")
+    magi_core.save_json(path, {"hash": "aaaa"})
+    assert magi_core.read_json(path, {}) == {"hash": "aaaa"}
+    stamp = os.stat(path).st_mtime_ns
+    # Another process rewrites it with the same size, and the clock has not ticked
+    tmp = path + ".other"
+    with open(tmp, "w", encoding="utf-8") as f: json.dump({"hash": "bbbb"}, f, indent=4, ensure_ascii=False)
+    os.utime(tmp, ns=(stamp, stamp))
+    os.replace(tmp, path)
+    assert magi_core.read_json(path, {}) == {"hash": "bbbb"}
+
+def test_load_json_returns_a_private_copy(workspace):
+    path = os.path.join(workspace, "templates.json")
+    magi_core.save_json(path, {"templates": {}})
+    magi_core.load_json(path, {})["templates"]["x"] = 1
+    assert magi_core.read_json(path, {}) == {"templates": {}}
@@ -0,0 +1,25 @@
+"""Page ranges for attached PDFs."""
+import pytest
+
+import magi_core
+from bench import scenarios
+
+@pytest.mark.parametrize("spec, expected", [
+    ("", None), ("   ", None), (None, None),
+    ("7", (7, 7)), ("10-50", (10, 50)), (" 10 - 50 ", (10, 50)), ("3-3", (3, 3)), ("10-", (10, 10**9)),
+])
+def test_parse_page_range(spec, expected):
+    assert magi_core.parse_page_range(spec) == expected
+
+@pytest.mark.parametrize("spec, message", [
+    ("50-10", "before the first"), ("0", "start at 1"), ("0-5", "start at 1"),
+    ("abc", "Invalid page range"), ("1,3", "Invalid page range"), ("-5", "Invalid page range"), ("1-2-3", "Invalid page range"),
+])
+def test_invalid_page_ranges_are_rejected(spec, message):
+    with pytest.raises(ValueError, match=message):
+        magi_core.parse_page_range(spec)
+
+def test_extract_honours_the_range(workspace):
+    text = magi_core.extract_text_from_file(scenarios.make_pdf(6, lines_per_page=2), "doc.pdf", magi_core.parse_page_range("2-3"))
+    assert "Page 2." in text and "Page 3." in text
+    assert "Page 1." not in text and "Page 4." not in text
@@ -0,0 +1,30 @@
+"""Session store shared through magi.db."""
+import sqlite3
+import time
+
+import magi_core
+
+def stored_expiry(token):
+    conn = sqlite3.connect(magi_core.DB_PATH)
+    try: return conn.execute("SELECT expires_at FROM sessions WHERE token = ?", (token,)).fetchone()
+    finally: conn.close()
+
+def test_session_loaded_from_disk_is_renewed_at_once(workspace):
+    token = magi_core.create_session({"username": "shinji", "role": "Pilot"})
+    # Another process (or a restart) sees the row close to its stored expiry
+    conn = sqlite3.connect(magi_core.DB_PATH)
+    conn.execute("UPDATE sessions SET expires_at = ? WHERE token = ?", (time.time() + 5, token)); conn.commit(); conn.close()
+    magi_core._SESSIONS.pop(token, None)
+
+    assert magi_core.validate_session(token)["username"] == "shinji"
+    assert stored_expiry(token)[0] > time.time() + magi_core.session_settings()["ttl_seconds"] - 60
+
+def test_session_revoked_elsewhere_is_rejected_and_not_recreated(workspace, monkeypatch):
+    monkeypatch.setattr(magi_core, "SESSION_TOUCH_INTERVAL", 0)
+    token = magi_core.create_session({"username": "shinji", "role": "Pilot"})
+    assert magi_core.validate_session(token)
+    conn = sqlite3.connect(magi_core.DB_PATH)
+    conn.execute("DELETE FROM sessions WHERE token = ?", (token,)); conn.commit(); conn.close()
+
+    assert magi_core.validate_session(token) is None
+    assert stored_expiry(token) is None
@@ -0,0 +1,40 @@
+"""Bulk user import from CSV."""
+import pytest
+
+import magi_core
+
+@pytest.fixture
+def fast_hashing(workspace):
+    config = magi_core.load_api_config()
+    config["auth"]["hash_iterations"] = 1000
+    magi_core.save_api_config(config)
+
+def csv_lines(*rows):
+    return ["id,password,name,role\n"] + [row + "\n" for row in rows]
+
+def test_import_adds_every_valid_row(fast_hashing):
+    report = magi_core.bulk_add_users(csv_lines("rei,unit00,Rei Ayanami,Pilot", "misato,pen2,Misato Katsuragi,Operations"))
+    assert report == {"added": 2, "errors": []}
+    assert magi_core.authenticate_user("rei", "unit00")["name"] == "Rei Ayanami"
+
+def test_duplicate_and_malformed_rows_abort_the_import(fast_hashing):
+    report = magi_core.bulk_add_users(csv_lines("rei,unit00,Rei Ayanami,Pilot",
+                                                "rei,again,Rei Two,Pilot",
+                                                "kaworu,,Kaworu Nagisa",
+                                                "toji,unit03,Toji Suzuhara,Pilot"))
+    assert report["added"] == 0
+    assert [line for line, _ in report["errors"]] == [3, 4]
+    assert "duplicate id 'rei'" in report["errors"][0][1]
+    assert "empty field(s): password, role" in report["errors"][1][1]
+    assert not {"rei", "toji"} & set(magi_core.get_all_users())
+
+def test_missing_columns_are_reported(workspace):
+    report = magi_core.bulk_add_users(["id,password,name\n", "rei,unit00,Rei\n"])
+    assert report == {"added": 0, "errors": [(1, "missing column(s): role")]}
+
+def test_failed_write_is_raised_not_reported_as_success(fast_hashing, monkeypatch):
+    monkeypatch.setattr(magi_core, "save_json", lambda path, data: False)
+    with pytest.raises(OSError):
+        magi_core.bulk_add_users(csv_lines("rei,unit00,Rei Ayanami,Pilot"))
+    monkeypatch.undo()
+    assert "rei" not in magi_core.get_all_users()
@@ -0,0 +1,129 @@
+"""Webhook delivery queue, exercised against a local HTTP stand-in for Slack/Discord."""
+import json
+import sqlite3
+import time
+
+import pytest
+from aiohttp import web
+
+import magi_core
+
+class Receiver:
+    """Local stand-in receiver that answers with queued statuses (200 once they run out)."""
+    def __init__(self):
+        self.statuses = []
+        self.received = []
+        self.runner = None
+        self.url = ""
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.received.append((request.path, await request.json()))
+        status = self.statuses.pop(0) if self.statuses else 200
+        return web.Response(status=status, text="ok" if status < 300 else "nope")
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.add_routes([web.post("/{name}", self.handle)])
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+@pytest.fixture
+def receiver(workspace, monkeypatch):
+    monkeypatch.setattr(magi_core, "WEBHOOK_BACKOFF_BASE", 0.05)
+    monkeypatch.setattr(magi_core, "WEBHOOK_MAX_ATTEMPTS", 3)
+    rcv = Receiver()
+    magi_core.run_coroutine(rcv.start(), timeout=10)
+    yield rcv
+    magi_core.run_coroutine(rcv.runner.cleanup(), timeout=10)
+
+def configure(webhooks):
+    magi_core.save_json(magi_core.WEBHOOKS_PATH, {"webhooks": webhooks})
+
+def wait_for(predicate, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate(): return True
+        time.sleep(0.02)
+    return False
+
+def settled():
+    stats = magi_core.get_webhook_stats()
+    return stats["pending"] == 0 and stats["sending"] == 0
+
+def test_delivers_payload(receiver):
+    configure({"slack": {"url": receiver.url + "/slack", "active": True}})
+    assert magi_core.execute_webhook_action("slack", "Topic", "承認")
+    assert wait_for(lambda: magi_core.get_webhook_stats()["delivered"] == 1)
+    path, body = receiver.received[0]
+    assert path == "/slack"
+    assert "Topic" in body["text"] and "承認" in body["text"]
+
+def test_missing_url_is_not_queued(receiver):
+    configure({"slack": {"url": "", "active": True}})
+    assert not magi_core.execute_webhook_action("slack", "Topic", "text")
+    assert magi_core.get_webhook_stats() == {"pending": 0, "sending": 0, "delivered": 0, "dead": 0}
+
+def test_server_errors_are_retried(receiver):
+    receiver.statuses = [503, 500]
+    configure({"slack": {"url": receiver.url + "/slack", "active": True}})
+    magi_core.execute_webhook_action("slack", "Topic", "text")
+    assert wait_for(lambda: magi_core.get_webhook_stats()["delivered"] == 1)
+    assert len(receiver.received) == 3
+    assert magi_core.list_webhook_deliveries("delivered")[0]["attempts"] == 3
+
+def test_exhausted_retries_go_to_dead_letters(receiver):
+    receiver.statuses = [500] * 3
+    configure({"slack": {"url": receiver.url + "/slack", "active": True}})
+    magi_core.execute_webhook_action("slack", "Topic", "text")
+    assert wait_for(lambda: magi_core.get_webhook_stats()["dead"] == 1)
+    dead = magi_core.list_webhook_deliveries("dead")[0]
+    assert dead["attempts"] == 3 and dead["last_error"].startswith("HTTP 500")
+
+    assert magi_core.retry_dead_webhooks() == 1
+    assert wait_for(lambda: magi_core.get_webhook_stats()["delivered"] == 1)
+
+def test_client_errors_are_permanent(receiver):
+    receiver.statuses = [404]
+    configure({"slack": {"url": receiver.url + "/slack", "active": True}})
+    magi_core.execute_webhook_action("slack", "Topic", "text")
+    assert wait_for(lambda: magi_core.get_webhook_stats()["dead"] == 1)
+    assert len(receiver.received) == 1
+
+@pytest.mark.parametrize("url", ["hooks.slack.com/services/x", "ftp://127.0.0.1/hook", "http://"])
+def test_invalid_urls_are_permanent(receiver, url):
+    configure({"slack": {"url": url, "active": True}})
+    magi_core.execute_webhook_action("slack", "Topic", "text")
+    assert wait_for(lambda: magi_core.get_webhook_stats()["dead"] == 1)
+    assert magi_core.list_webhook_deliveries("dead")[0]["attempts"] == 1
+
+def test_broadcast_fans_out_to_active_webhooks(receiver):
+    configure({"slack": {"url": receiver.url + "/slack", "active": True},
+               "discord": {"url": receiver.url + "/discord", "active": True},
+               "teams": {"url": receiver.url + "/teams", "active": False}})
+    assert sorted(magi_core.broadcast_webhook("Topic", "text")) == ["discord", "slack"]
+    assert wait_for(lambda: magi_core.get_webhook_stats()["delivered"] == 2)
+    assert sorted(path for path, _ in receiver.received) == ["/discord", "/slack"]
+
+def test_pending_deliveries_resume_when_the_queue_opens(receiver):
+    # A delivery left behind by a previous process, written before this one opened the queue
+    configure({"slack": {"url": receiver.url + "/slack", "active": True}})
+    now = time.time()
+    conn = sqlite3.connect(magi_core.DB_PATH)
+    conn.execute("""CREATE TABLE webhook_deliveries (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, webhook_id TEXT NOT NULL, title TEXT NOT NULL, payload TEXT NOT NULL,
+        status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, last_error TEXT NOT NULL DEFAULT '',
+        created_at REAL NOT NULL, updated_at REAL NOT NULL, next_attempt_at REAL NOT NULL)""")
+    conn.execute("INSERT INTO webhook_deliveries (webhook_id, title, payload, status, created_at, updated_at, next_attempt_at) VALUES (?, ?, ?, 'pending', ?, ?, ?)",
+                 ("slack", "Topic", json.dumps({"text": "left over"}), now, now, now))
+    conn.commit(); conn.close()
+    with magi_core._WEBHOOK_LOCK:
+        worker = magi_core._WEBHOOK_WORKER["future"]
+    if worker is not None: worker.cancel()
+    wait_for(lambda: worker is None or worker.done())
+
+    magi_core.resume_webhook_deliveries()
+    assert wait_for(lambda: len(receiver.received) == 1)
+    assert receiver.received[0][1] == {"text": "left over"}
@@ -1,6 +1,5 @@
 import streamlit as st
 import time
-import asyncio
 import csv
 import io
 import os
@@ -39,7 +38,21 @@ def render_admin():
                 cur_model = d.get("model_name", "gemini-1.5-flash")
                 if cur_model not in m_list: m_list.append(cur_model)
                 d["model_name"] = st.selectbox("Model", m_list, index=m_list.index(cur_model), key=f"m_{pid}")
+
+                # Fallback chain, tried in the order selected
+                fb_current = [f"{f['provider']}:{f['model']}" for f in d.get("fallbacks", [])]
+                fb_options = [f"{p}:{m}" for p, p_cfg in api_config["providers"].items() for m in p_cfg.get("models", [])]
+                fb_options += [o for o in fb_current if o not in fb_options]
+                fb_selected = st.multiselect("Fallback Models (in order)", fb_options, default=fb_current, key=f"fb_{pid}")
+                d["fallbacks"] = [{"provider": o.split(":", 1)[0], "model": o.split(":", 1)[1]} for o in fb_selected]
+                h_cols = st.columns(2)
+                d["hedge"] = h_cols[0].toggle("Hedged Requests", bool(d.get("hedge", False)), key=f"hg_{pid}", disabled=not fb_selected,
+                                              help="If the current model is silent past the threshold, also ask the next fallback and keep whichever answers first.")
+                d["hedge_threshold_ms"] = int(h_cols[1].number_input("Hedge After (ms, 0 = auto p95)", min_value=0, value=int(d.get("hedge_threshold_ms", 0)), step=500, key=f"ht_{pid}"))
                 d["temperature"] = st.slider("Temp", 0.0, 1.0, float(d.get("temperature", 0.7)), key=f"t_{pid}")
+                d["context_budget"] = int(st.number_input("Context Budget (tokens)", min_value=max(500, magi_core.CONTEXT_CHUNK_TOKENS), value=int(d.get("context_budget", magi_core.DEFAULT_CONTEXT_BUDGET)), step=500, key=f"cb_{pid}",
+                                                          help="Attached material beyond this size is reduced to the passages most relevant to the topic."))
+                d["bypass_cache"] = st.toggle("Bypass Response Cache", bool(d.get("bypass_cache", False)), key=f"bc_{pid}", help="Always query the provider, even when the response cache is enabled.")
                 d["prompt"] = st.text_area("System Prompt", d.get("prompt", ""), height=250, key=f"sp_{pid}")
                 if st.button(f"Save {pid} Settings"):
                     magi_core.save_persona_config(config); st.success("Updated.")
@@ -53,39 +66,146 @@ def render_admin():
             s_models = api_config["providers"].get(api_config["seele_model"]["provider"], {}).get("models", ["gemini-2.0-flash"])
             if api_config["seele_model"]["name"] not in s_models: s_models.append(api_config["seele_model"]["name"])
             api_config["seele_model"]["name"] = st.selectbox("Model (SEELE)", s_models, index=s_models.index(api_config["seele_model"]["name"]))
+        api_config["seele_model"]["bypass_cache"] = st.toggle("Bypass Response Cache (SEELE)", bool(api_config["seele_model"].get("bypass_cache", False)))
         if st.button("Save SEELE Config"): magi_core.save_api_config(api_config); st.success("SEELE updated.")
 
         st.markdown("<br><hr>", unsafe_allow_html=True)
         st.markdown("### 🔌 API PROVIDER CONNECTIONS")
         p_info = {"google": "GOOGLE GEMINI", "groq": "GROQ", "openai": "OPENAI", "anthropic": "ANTHROPIC", "local": "LOCAL (Ollama etc.)"}
+        circuits = magi_core.get_circuit_states()
         for pid, label in p_info.items():
             providers = api_config["providers"]
             is_active = bool(providers[pid].get("api_key") or providers[pid].get("base_url"))
             status = f'<span class="status-badge status-active">ACTIVE</span>' if is_active else f'<span class="status-badge status-inactive">INACTIVE</span>'
             st.markdown(f'<div class="provider-section"><h4>{label} {status}</h4>', unsafe_allow_html=True)
+            cb = circuits[pid]
+            if cb["state"] != "closed" or cb["failures"]:
+                cb_cols = st.columns([4, 1])
+                cb_cols[0].warning(f"CIRCUIT {cb['state'].upper()} — {cb['failures']} consecutive failures"
+                                   + (f", retry in {cb['retry_in']:.0f}s" if cb["retry_in"] else "") + (f"\n\n{cb['last_error']}" if cb["last_error"] else ""))
+                if cb_cols[1].button("Reset Circuit", key=f"cb_reset_{pid}"): magi_core.reset_circuit(pid); st.rerun()
             if pid == "local":
                 url = st.text_input(f"BASE URL", providers[pid].get("base_url", ""), key=f"url_{pid}")
                 key = st.text_input(f"API KEY (Optional)", providers[pid].get("api_key", ""), type="password", key=f"ak_{pid}")
                 if st.button(f"Sync Models {pid.upper()}"):
-                    models = asyncio.run(magi_core.fetch_models_local(url, key))
-                    providers[pid] = {"base_url": url, "api_key": key, "models": models}
+                    models = magi_core.run_coroutine(magi_core.fetch_models_local(url, key))
+                    providers[pid].update({"base_url": url, "api_key": key, "models": models})
                     magi_core.save_api_config(api_config); st.success("Synced."); st.rerun()
             else:
                 key = st.text_input(f"API KEY", providers[pid].get("api_key", ""), type="password", key=f"ak_{pid}")
                 if st.button(f"Sync Models {pid.upper()}"):
                     fetch_map = {"google": magi_core.fetch_models_google, "groq": magi_core.fetch_models_groq, "openai": magi_core.fetch_models_openai, "anthropic": magi_core.fetch_models_anthropic}
-                    models = asyncio.run(fetch_map[pid](key))
-                    providers[pid] = {"api_key": key, "models": models}
+                    models = magi_core.run_coroutine(fetch_map[pid](key))
+                    providers[pid].update({"api_key": key, "models": models})
                     magi_core.save_api_config(api_config); st.success("Synced."); st.rerun()
+            limits = magi_core.provider_limits(pid)
+            l_cols = st.columns(4)
+            rpm = l_cols[0].number_input("Requests / min", min_value=0, value=limits["rpm"], key=f"rpm_{pid}", help="0 = unlimited")
+            tpm = l_cols[1].number_input("Tokens / min", min_value=0, value=limits["tpm"], step=1000, key=f"tpm_{pid}", help="0 = unlimited")
+            conc = l_cols[2].number_input("Max In-Flight", min_value=0, value=limits["max_concurrency"], key=f"conc_{pid}", help="0 = unlimited")
+            l_cols[3].markdown('<div style="padding-top:28px;"></div>', unsafe_allow_html=True)
+            if l_cols[3].button("Save Limits", key=f"lim_{pid}"):
+                providers[pid]["limits"] = {"rpm": int(rpm), "tpm": int(tpm), "max_concurrency": int(conc)}
+                magi_core.save_api_config(api_config); st.success("Limits updated.")
             st.markdown('</div>', unsafe_allow_html=True)
 
     with t_sys:
+        st.markdown("### 🔗 CLIENT POOL")
+        cs = magi_core.get_client_stats()
+        m_cols = st.columns(4)
+        m_cols[0].metric("Clients Built", cs["clients_built"])
+        m_cols[1].metric("Clients Reused", cs["clients_reused"])
+        m_cols[2].metric("Connections Opened", cs["connections_opened"])
+        m_cols[3].metric("Connections Reused", cs["connections_reused"])
+        st.markdown("<br><hr>", unsafe_allow_html=True)
+
+        st.markdown("### 📈 PROVIDER LATENCY")
+        pm = magi_core.get_persona_metrics()
+        if pm:
+            st.dataframe([{"persona": p, "calls": v["calls"], "failed attempts": v["failed_attempts"],
+                           **{f"latency p{q} (s)": round(v[f"latency_p{q}"], 2) for q in (50, 95, 99)},
+                           **{f"ttft p{q} (s)": round(v[f"ttft_p{q}"], 2) for q in (50, 95, 99)},
+                           "prompt tokens": v["prompt_tokens"], "cached prompt tokens": v["cached_tokens"], "completion tokens": v["completion_tokens"]} for p, v in pm.items()],
+                         use_container_width=True, hide_index=True)
+        else: st.caption("No provider calls recorded in this process yet.")
+        b1, b2 = st.columns(2)
+        b1.download_button("Download Metrics (Prometheus)", magi_core.render_prometheus(), file_name="magi_metrics.prom", mime="text/plain")
+        if b2.button("Reset Metrics"): magi_core.reset_metrics(); st.rerun()
+        st.markdown("<br><hr>", unsafe_allow_html=True)
+
+        st.markdown("### 🗄️ RESPONSE CACHE")
+        rc = api_config["response_cache"]
+        c1, c2, c3 = st.columns(3)
+        rc["enabled"] = c1.toggle("Enable Cache", bool(rc.get("enabled", False)))
+        rc["ttl_seconds"] = int(c2.number_input("TTL (sec)", min_value=60, value=int(rc.get("ttl_seconds", 86400)), step=3600))
+        rc["max_entries"] = int(c3.number_input("Max Entries (LRU)", min_value=10, value=int(rc.get("max_entries", 1000)), step=100))
+        cache = magi_core.get_cache_stats()
+        lookups = cache["hits"] + cache["misses"]
+        m_cols = st.columns(4)
+        m_cols[0].metric("Hits", int(cache["hits"]))
+        m_cols[1].metric("Misses", int(cache["misses"]))
+        m_cols[2].metric("Hit Rate", f"{cache['hits'] / lookups:.0%}" if lookups else "-")
+        m_cols[3].metric("Latency Saved", f"{cache['saved_seconds']:.1f}s")
+        st.caption(f"Cached responses: {cache['entries']}")
+        b1, b2 = st.columns(2)
+        if b1.button("Save Cache Config"): magi_core.save_api_config(api_config); st.success("Cache updated.")
+        if b2.button("Clear Cache"): magi_core.clear_response_cache(); st.rerun()
+        st.markdown("<br><hr>", unsafe_allow_html=True)
+
+        st.markdown("### 🧩 PROMPT PREFIX CACHE")
+        pc = api_config["prompt_cache"]
+        c1, c2 = st.columns(2)
+        pc["enabled"] = c1.toggle("Mark Shared Prefix For Caching", bool(pc.get("enabled", True)),
+                                  help="Adds an Anthropic cache breakpoint and an OpenAI prompt_cache_key to the prefix the three units share (material + question).")
+        pc["min_tokens"] = int(c2.number_input("Min Prefix Tokens", min_value=0, value=int(pc.get("min_tokens", 1024)), step=256,
+                                               help="Shorter prefixes are sent unmarked; providers do not cache them anyway."))
+        st.caption("Units with different context budgets receive different material and cannot share a cached prefix.")
+        if st.button("Save Prompt Cache Config"): magi_core.save_api_config(api_config); st.success("Prompt cache updated.")
+        st.markdown("<br><hr>", unsafe_allow_html=True)
+
+        st.markdown("### 🔐 SESSIONS & CREDENTIALS")
+        sc = api_config["sessions"]
+        ss = magi_core.get_session_stats()
+        c1, c2, c3, c4 = st.columns(4)
+        sc["ttl_seconds"] = int(c1.number_input("Idle Timeout (hours)", min_value=1, value=int(sc.get("ttl_seconds", 604800)) // 3600, step=24)) * 3600
+        sc["max_per_user"] = int(c2.number_input("Max Sessions / User (0 = unlimited)", min_value=0, value=int(sc.get("max_per_user", 5)), step=1))
+        api_config["auth"]["hash_iterations"] = int(c3.number_input("Password Hash Iterations", min_value=100000, value=int(api_config["auth"].get("hash_iterations", 600000)), step=100000,
+                                                                    help="PBKDF2-SHA256 cost for new and re-hashed passwords. Existing users are upgraded at their next login."))
+        c4.metric("Active Sessions", ss["active"])
+        if st.button("Save Session Config"): magi_core.save_api_config(api_config); st.success("Session policy updated.")
+        st.markdown("<br><hr>", unsafe_allow_html=True)
+
+        st.markdown("### ⏩ EARLY DECISION")
+        ee = api_config["early_exit"]
+        c1, c2, c3, c4 = st.columns(4)
+        ee["enabled"] = c1.toggle("Enable Early Exit", bool(ee.get("enabled", False)))
+        ee["skip_debate_unanimous"] = c2.toggle("Skip Debate If Unanimous", bool(ee.get("skip_debate_unanimous", True)), disabled=not ee["enabled"])
+        ee["skip_debate_score"] = int(c3.number_input("Skip Debate At |Score| ≥ (0 = off)", min_value=0, max_value=len(magi_core.MAGI_UNITS), value=int(ee.get("skip_debate_score", 0)), disabled=not ee["enabled"]))
+        ee["early_synthesis"] = c4.toggle("Early SEELE Synthesis", bool(ee.get("early_synthesis", False)), disabled=not ee["enabled"],
+                                          help="Start SEELE once the majority is settled, without waiting for the slowest unit's opinion.")
+        if st.button("Save Early Decision Config"): magi_core.save_api_config(api_config); st.success("Early decision policy updated.")
+        st.markdown("<br><hr>", unsafe_allow_html=True)
+
+        st.markdown("### 🗣️ DEBATE EXCHANGE")
+        dx = api_config["debate_exchange"]
+        modes = ["full", "digest"]
+        c1, c2, c3 = st.columns(3)
+        dx["mode"] = c1.selectbox("Opinions Sent To Round 2", modes, index=modes.index(dx.get("mode", "full")) if dx.get("mode") in modes else 0,
+                                  help="full: round-one opinions verbatim. digest: the vote plus a short excerpt of the condition and reasoning.")
+        dx["digest_chars"] = int(c2.number_input("Digest Length (chars)", min_value=40, value=int(dx.get("digest_chars", magi_core.DEBATE_DIGEST_CHARS)), step=20,
+                                                 disabled=dx["mode"] != "digest", help="Condition and reasoning characters kept per opinion."))
+        dx["exclude_self"] = c3.toggle("Exclude Own Opinion", bool(dx.get("exclude_self", False)), help="Each unit reads only the other two opinions.")
+        if st.button("Save Debate Exchange Config"): magi_core.save_api_config(api_config); st.success("Debate exchange updated.")
+        st.markdown("<br><hr>", unsafe_allow_html=True)
+
         tn = st.text_input("Template Name to Save:")
         if st.button("Save Current Personas") and tn:
-            tps = magi_core.load_json(magi_core.TEMPLATES_PATH, {})
-            tps[tn] = magi_core.load_persona_config()
-            magi_core.save_json(magi_core.TEMPLATES_PATH, tps); st.success("Saved.")
-        if st.button("Clear History"): magi_core.save_json(magi_core.HISTORY_PATH, []); st.rerun()
+            with magi_core.file_lock(magi_core.TEMPLATES_PATH):
+                tps = magi_core.load_json(magi_core.TEMPLATES_PATH, {})
+                tps[tn] = magi_core.load_persona_config()
+                magi_core.save_json(magi_core.TEMPLATES_PATH, tps)
+            st.success("Saved.")
+        if st.button("Clear History"): magi_core.clear_history(); st.rerun()
 
     with t_int:
         st.markdown("### 🛰️ EXTERNAL INTEGRATIONS (WEBHOOKS)")
@@ -95,10 +215,38 @@ def render_admin():
         for wid, cfg in wh.items():
             with st.expander(f"{wid.upper()} - {cfg['name']}", expanded=True):
                 new_url = st.text_input("WEBHOOK URL", value=cfg['url'], key=f"wh_url_{wid}")
-                if st.button(f"SAVE {wid.upper()} CONFIG"):
-                    wh[wid]["url"] = new_url
-                    magi_core.save_json(magi_core.WEBHOOKS_PATH, webhooks_data)
+                new_active = st.toggle("ACTIVE (include in broadcast)", bool(cfg.get("active", False)), key=f"wh_act_{wid}")
+                w_cols = st.columns(2)
+                if w_cols[0].button(f"SAVE {wid.upper()} CONFIG"):
+                    # Re-read under the lock so a concurrent edit to the other webhook isn't lost
+                    with magi_core.file_lock(magi_core.WEBHOOKS_PATH):
+                        latest = magi_core.load_json(magi_core.WEBHOOKS_PATH, {"webhooks": {}})
+                        latest.setdefault("webhooks", {}).setdefault(wid, dict(cfg)).update(url=new_url, active=new_active)
+                        magi_core.save_json(magi_core.WEBHOOKS_PATH, latest)
                     st.success("CONFIGURATION UPDATED.")
+                if w_cols[1].button("SEND TEST", key=f"wh_test_{wid}"):
+                    if magi_core.execute_webhook_action(wid, "CONNECTION TEST", "MAGI SYSTEM: link check."): st.success("TEST QUEUED.")
+                    else: st.error("NO URL CONFIGURED.")
+
+        st.markdown("<br><hr>", unsafe_allow_html=True)
+        st.markdown("### 📨 DELIVERY QUEUE")
+        ws = magi_core.get_webhook_stats()
+        m_cols = st.columns(4)
+        m_cols[0].metric("Pending", ws["pending"])
+        m_cols[1].metric("Sending", ws["sending"])
+        m_cols[2].metric("Delivered", ws["delivered"])
+        m_cols[3].metric("Dead Letters", ws["dead"])
+        b1, b2, b3, b4 = st.columns(4)
+        if b1.button("Refresh Queue"): st.rerun()
+        if b2.button("Retry Dead Letters", disabled=not ws["dead"]): magi_core.retry_dead_webhooks(); st.rerun()
+        if b3.button("Clear Dead Letters", disabled=not ws["dead"]): magi_core.clear_webhook_deliveries("dead"); st.rerun()
+        if b4.button("Clear Delivered", disabled=not ws["delivered"]): magi_core.clear_webhook_deliveries("delivered"); st.rerun()
+        deliveries = magi_core.list_webhook_deliveries(limit=50)
+        if deliveries:
+            fmt = lambda ts: time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts))
+            st.dataframe([{"id": d["id"], "webhook": d["webhook_id"], "topic": d["title"], "status": d["status"].upper(), "attempts": d["attempts"],
+                           "updated": fmt(d["updated_at"]), "last error": d["last_error"]} for d in deliveries], use_container_width=True, hide_index=True)
+        else: st.caption("No deliveries queued yet.")
 
     with t_usr:
         st.markdown("### 👥 NERV PERSONNEL MANAGEMENT")
@@ -127,9 +275,9 @@ def render_admin():
                 all_users = magi_core.get_all_users()
                 output = io.StringIO()
                 writer = csv.writer(output)
-                writer.writerow(["id", "password", "name", "role"])
+                writer.writerow(["id", "name", "role"]) # credentials never leave the server
                 for uid, info in all_users.items():
-                    writer.writerow([uid, info.get("password", ""), info.get("name", ""), info.get("role", "")])
+                    writer.writerow([uid, info.get("name", ""), info.get("role", "")])
                 st.download_button("DOWNLOAD CSV", output.getvalue(), file_name="magi_personnel.csv", mime="text/csv")
             
             with c2:
@@ -138,14 +286,14 @@ def render_admin():
                 if uploaded_csv:
                     if st.button("EXECUTE IMPORT"):
                         try:
-                            stream = io.StringIO(uploaded_csv.getvalue().decode("utf-8"))
-                            reader = csv.DictReader(stream)
-                            count = 0
-                            for row in reader:
-                                if magi_core.add_user(row["id"], row["password"], row["name"], row["role"]):
-                                    count += 1
-                            st.success(f"Imported {count} users.")
-                            time.sleep(1); st.rerun()
+                            uploaded_csv.seek(0)
+                            report = magi_core.bulk_add_users(io.TextIOWrapper(uploaded_csv, encoding="utf-8-sig", newline=""))
+                            if report["errors"]:
+                                st.error(f"Import aborted: {len(report['errors'])} invalid row(s). No users were added.")
+                                st.dataframe([{"line": line, "error": msg} for line, msg in report["errors"][:200]], use_container_width=True)
+                            else:
+                                st.success(f"Imported {report['added']} users.")
+                                time.sleep(1); st.rerun()
                         except Exception as e:
                             st.error(f"Import failed: {e}")
 
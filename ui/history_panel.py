@@ -1,4 +1,5 @@
 import streamlit as st
+import datetime
 import os
 import sys
 from streamlit_echarts import st_echarts
@@ -6,25 +7,50 @@ from streamlit_echarts import st_echarts
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import magi_core
 
+PAGE_SIZE = 20
+PERIODS = {"ALL TIME": 0, "LAST 7 DAYS": 7, "LAST 30 DAYS": 30, "LAST 90 DAYS": 90}
+
+LANE_COLORS = {"SYSTEM": "#888888", "SEELE": "#FF4500"}
+
+def render_waterfall(trace, key):
+    """Draw a deliberation's spans as a horizontal timeline, one row per span."""
+    spans = trace["spans"]
+    labels = [f"{s['lane']} · {s['name']}" for s in spans]
+    bars = [{"value": round(s["end"] - s["start"], 3),
+             "itemStyle": {"color": "#FF0000" if s["status"].startswith("error") else ("#555555" if s["status"] == "cancelled" or s["name"].startswith("wait") else LANE_COLORS.get(s["lane"], "#FF8C00"))}}
+            for s in spans]
+    options = {
+        "backgroundColor": "transparent",
+        "title": {"text": f"TIMING WATERFALL ({trace['total']:.1f}s)", "left": "center", "textStyle": {"color": "#FF8C00", "fontSize": 12}},
+        "tooltip": {"trigger": "axis", "axisPointer": {"type": "shadow"}},
+        "grid": {"left": 230, "right": 30, "top": 30, "bottom": 25},
+        "xAxis": {"type": "value", "name": "s", "axisLabel": {"color": "#FF8C00"}, "splitLine": {"lineStyle": {"color": "#FF8C00", "opacity": 0.2}}},
+        "yAxis": {"type": "category", "data": labels, "inverse": True, "axisLabel": {"color": "#FF8C00", "fontSize": 10}},
+        "series": [
+            # Transparent offset bar stacked under the duration bar gives each span its start time
+            {"type": "bar", "stack": "t", "data": [s["start"] for s in spans], "itemStyle": {"color": "transparent"}, "tooltip": {"show": False}},
+            {"type": "bar", "stack": "t", "name": "duration (s)", "data": bars},
+        ]
+    }
+    st_echarts(options=options, height=f"{max(160, 22 * len(spans) + 60)}px", key=key)
+
 def render_history():
     t_list, t_dash = st.tabs(["📜 LOGS", "📊 ANALYTICS"])
     
-    history = magi_core.load_json(magi_core.HISTORY_PATH, [])
     # History Isolation
     is_privileged = st.session_state.user["role"] in ["Commander", "Sub-Commander"]
     user_id = st.session_state.user["username"]
-    filtered_history = [item for item in history if is_privileged or item.get("user_id") == user_id]
+    scope = None if is_privileged else user_id
 
     with t_dash:
-        if not filtered_history:
+        period = st.selectbox("PERIOD", list(PERIODS.keys()), key="analytics_period")
+        start_day = (datetime.date.today() - datetime.timedelta(days=PERIODS[period] - 1)).isoformat() if PERIODS[period] else None
+        stats = magi_core.get_analytics(scope, start_day=start_day)
+        votes = stats["votes"]
+        if not sum(votes.values()):
             st.info("No data for analytics.")
         else:
             # 1. Approval Rate (Pie Chart)
-            votes = [r["vote"] for item in filtered_history for r in item.get("results", [])]
-            approval = votes.count("是認")
-            conditional = votes.count("条件付是認")
-            denial = votes.count("否認")
-            
             pie_options = {
                 "backgroundColor": "transparent",
                 "title": {"text": "TOTAL DECISION RATIO", "left": "center", "textStyle": {"color": "#FF8C00"}},
@@ -34,9 +60,9 @@ def render_history():
                     "type": "pie",
                     "radius": "50%",
                     "data": [
-                        {"value": approval, "name": "是認", "itemStyle": {"color": "#00FF00"}},
-                        {"value": conditional, "name": "条件付是認", "itemStyle": {"color": "#FFFF00"}},
-                        {"value": denial, "name": "否認", "itemStyle": {"color": "#FF0000"}},
+                        {"value": votes["是認"], "name": "是認", "itemStyle": {"color": "#00FF00"}},
+                        {"value": votes["条件付是認"], "name": "条件付是認", "itemStyle": {"color": "#FFFF00"}},
+                        {"value": votes["否認"], "name": "否認", "itemStyle": {"color": "#FF0000"}},
                     ],
                     "label": {"color": "#FF8C00"}
                 }]
@@ -44,22 +70,11 @@ def render_history():
             st_echarts(options=pie_options, height="300px")
             
             # 2. Magi Bias (Radar Chart)
-            # Calculate 'strictness' average score per Magi (Melchior, Balthasar, Casper)
-            magi_scores = {"MELCHIOR": [], "BALTHASAR": [], "CASPER": []}
-            score_map = {"是認": 100, "条件付是認": 50, "否認": 0}
-            
-            for item in filtered_history:
-                for r in item.get("results", []):
-                    name = r["name"].upper() # Ensure upper case matching
-                    vote = r.get("vote", "否認")
-                    # Try to match name to key
-                    for key in magi_scores:
-                        if key in name: magi_scores[key].append(score_map.get(vote, 0))
-            
+            # Average 'strictness' score per Magi from the running score sums
+            personas = stats["personas"]
             avg_scores = [
-                sum(magi_scores["MELCHIOR"])/len(magi_scores["MELCHIOR"]) if magi_scores["MELCHIOR"] else 0,
-                sum(magi_scores["BALTHASAR"])/len(magi_scores["BALTHASAR"]) if magi_scores["BALTHASAR"] else 0,
-                sum(magi_scores["CASPER"])/len(magi_scores["CASPER"]) if magi_scores["CASPER"] else 0
+                personas[k]["score_sum"] / personas[k]["count"] if personas.get(k, {}).get("count") else 0
+                for k in magi_core.MAGI_UNITS
             ]
             
             radar_options = {
@@ -78,12 +93,33 @@ def render_history():
             }
             st_echarts(options=radar_options, height="300px")
 
+            # 3. Daily Trend (Stacked Bars)
+            days = list(stats["daily"].keys())
+            trend_options = {
+                "backgroundColor": "transparent",
+                "title": {"text": "DAILY DECISIONS", "left": "center", "textStyle": {"color": "#FF8C00"}},
+                "tooltip": {"trigger": "axis"},
+                "xAxis": {"type": "category", "data": days, "axisLabel": {"color": "#FF8C00"}},
+                "yAxis": {"type": "value", "axisLabel": {"color": "#FF8C00"}, "splitLine": {"lineStyle": {"color": "#FF8C00", "opacity": 0.2}}},
+                "series": [
+                    {"name": v, "type": "bar", "stack": "votes", "data": [stats["daily"][d].get(v, 0) for d in days], "itemStyle": {"color": c}}
+                    for v, c in [("是認", "#00FF00"), ("条件付是認", "#FFFF00"), ("否認", "#FF0000")]
+                ]
+            }
+            st_echarts(options=trend_options, height="300px")
+
     with t_list:
-        if not filtered_history:
+        total = magi_core.count_history(scope)
+        if not total:
             st.info("No authorized records found.")
             return
 
-        for i, item in enumerate(reversed(filtered_history)): # Newest first
+        pages = (total + PAGE_SIZE - 1) // PAGE_SIZE
+        page = st.number_input(f"PAGE (1-{pages}, {total} records)", min_value=1, max_value=pages, value=1, step=1)
+        page_items = magi_core.query_history(scope, limit=PAGE_SIZE, offset=(page - 1) * PAGE_SIZE)
+        traces = magi_core.get_history_traces([item["id"] for item in page_items])
+
+        for i, item in enumerate(page_items): # Newest first
             u_label = f" | Op: {item.get('user_id', 'Unknown')}" if is_privileged else ""
             with st.expander(f"[{item['timestamp'][:16]}{u_label}] {item['question'][:40]}..."):
                 st.markdown(f"**Topic:** {item['question']}")
@@ -91,6 +127,7 @@ def render_history():
                     st.markdown(f"**Conducted by:** `{item.get('user_id', 'Unknown')}`")
                 
                 for r in item["results"]: st.markdown(f"- **{r['name']}**: {r['vote']}")
+                if item["id"] in traces: render_waterfall(traces[item["id"]], key=f"wf_{item['id']}_{i}")
                 
                 md = f"# MAGI REPORT\n\n"
                 md += f"Topic: {item['question']}\n"
@@ -1,6 +1,6 @@
 import streamlit as st
 import time
-import asyncio
+import html
 import os
 import sys
 from streamlit_echarts import st_echarts
@@ -13,6 +13,41 @@ def render_decision_graph(res):
     options = {"backgroundColor":"transparent","radar":{"indicator":[{"name":"MELCHIOR","max":100},{"name":"BALTHASAR","max":100},{"name":"CASPER","max":100}],"splitArea":{"show":False},"splitLine":{"lineStyle":{"color":"#FF8C00","opacity":0.2}},"axisLine":{"lineStyle":{"color":"#FF8C00","opacity":0.4}}},"series":[{"type":"radar","data":[{"value":scores}],"lineStyle":{"color":"#FF8C00","width":3},"areaStyle":{"color":"#FF8C00","opacity":0.2},"itemStyle":{"color":"#FF8C00"}}]}
     st_echarts(options, height="200px")
 
+COLORS = {"是認": "#00FF00", "条件付是認": "#FFFF00", "否認": "#FF0000"}
+
+def panel_html(name, text, vote=None, condition="", cursor=False):
+    c = COLORS.get(vote, "#FFF")
+    cond_html = (f'<div style="margin-top:10px; border:1px dashed #FFFF00; padding:5px; font-size:0.8em; color:#FFFF00;">CONDITION: {condition}</div>' if condition else "")
+    vote_html = f'<div class="magi-vote" style="border-color:{c}; color:{c};">{vote}</div>' if vote else ""
+    return f'<div class="magi-panel" style="border-color:{c};"><div class="magi-header" style="color:{c};">{name}</div><div style="font-size:0.9em; white-space:pre-wrap; color:#EEE;">{text}{"_" if cursor else ""}</div>{cond_html}{vote_html}</div>'
+
+def seele_html(summary, cursor=False):
+    return f'<div style="border:2px double #FF4500; background:#0a0500; padding:25px; margin-bottom:20px; margin-top:30px;"><h2 style="color:#FF4500; text-align:center;">SEELE SUMMARY</h2><p style="white-space:pre-wrap; color:#FF8C00;">{summary}{"_" if cursor else ""}</p></div>'
+
+JOB_POLL_SECONDS = 0.25
+
+def render_job_snapshot(job):
+    """Draw the current state of a background deliberation: status line, the three panels and SEELE so far."""
+    personas = magi_core.persona_settings()
+    names = [personas.get(pid, {}).get("name", pid) for pid in magi_core.MAGI_UNITS]
+    label = f"ANALYZING... (ROUND {job.round})" if job.round else ("EXTRACTING MATERIAL..." if job.file_name else "ANALYZING...")
+    st.markdown(f'<div style="font-size:0.8em; color:#FF8C00;">MAGI: {label}</div>', unsafe_allow_html=True)
+    cols = st.columns(3)
+    for i in range(3):
+        r = job.results[i]
+        view = (r[0], r[1], r[2], r[3]) if r else (names[i], html.escape(job.texts[i]), None, "", True)
+        cols[i].markdown(panel_html(*view), unsafe_allow_html=True)
+    if job.seele_text:
+        st.markdown(seele_html(html.escape(job.seele_text), cursor=True), unsafe_allow_html=True)
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def job_monitor():
+    """Redraw the running job on a timer without holding the script; a full rerun collects the result once it is done."""
+    job = st.session_state.get("job")
+    if not job: return
+    render_job_snapshot(job)
+    if job.done(): st.rerun()
+
 def render_main():
     templates = magi_core.load_json(magi_core.TEMPLATES_PATH, {})
     if templates:
@@ -27,84 +62,63 @@ def render_main():
     with col_input:
         question = st.text_area("TOPIC", height=130, placeholder="審議事項を入力...", label_visibility="collapsed")
         uploaded_file = st.file_uploader("ATTACH MATERIAL (PDF/TXT)", type=["pdf", "txt"])
+        page_spec = st.text_input("PDF PAGES", placeholder="ALL (e.g. 1-50)", key="page_spec") if uploaded_file and uploaded_file.name.endswith(".pdf") else ""
     
     with col_opt:
         st.markdown('<div style="padding-top:20px;"></div>', unsafe_allow_html=True)
         debate = st.toggle("DEEP SIMULATION", value=False)
         synthesis = st.toggle("SEELE SYNTHESIS", value=True)
-        if st.button("START JUDGMENT", type="primary", use_container_width=True):
-            if question:
-                context = ""
-                if uploaded_file: context = magi_core.extract_text_from_file(uploaded_file.read(), uploaded_file.name)
-                with st.spinner("MAGI: ANALYZING..."):
-                    try:
-                        res = asyncio.run(magi_core.ask_magi_system(question, context, debate, synthesis, uploaded_file.name if uploaded_file else ""))
-                        # Record history with user context
-                        magi_core.add_history_with_user(
-                            st.session_state.user["username"], 
-                            question, res["magi_results"], res["final_score"], 
-                            res["seele_summary"], uploaded_file.name if uploaded_file else ""
-                        )
-                        st.session_state.results = res
-                        st.session_state.show_animation = True # Trigger Animation
-                        st.rerun()
-                    except magi_core.RateLimitError as e:
-                        st.error("【警告】API制限（429）に達しました。別のプロバイダーを使用してください。")
-                    except Exception as e: st.error(f"Error: {e}")
-            else: st.error("Enter topic.")
+        start = st.button("START JUDGMENT", type="primary", use_container_width=True)
+        if start and not question: st.error("Enter topic.")
         
         st.markdown("<br>", unsafe_allow_html=True)
         if st.button("📜 VIEW HISTORY", use_container_width=True, key="main_hist_btn"):
             st.session_state.page = "history"
             st.rerun()
 
+    if start and question:
+        try:
+            page_range = magi_core.parse_page_range(page_spec)
+        except ValueError as e:
+            st.error(str(e))
+        else:
+            file_name = uploaded_file.name if uploaded_file else ""
+            file_content = uploaded_file.getvalue() if uploaded_file else None
+            # Extraction and deliberation run on the shared background loop (history is recorded there); this page only polls it
+            st.session_state.job = magi_core.submit_deliberation(st.session_state.user["username"], question, "", debate, synthesis, file_name,
+                                                                 file_content, page_range)
+            st.session_state.results = None
+
+    job = st.session_state.get("job")
+    if job and job.done():
+        del st.session_state.job
+        try:
+            st.session_state.results = job.result()
+        except magi_core.RateLimitError:
+            st.error("【警告】API制限（429）に達しました。別のプロバイダーを使用してください。")
+        except Exception as e:
+            st.error(f"Error: {e}")
+    elif job:
+        job_monitor()
+
     if st.session_state.results:
         res = st.session_state.results
         render_decision_graph(res["magi_results"])
+        ee = res.get("early_exit") or {}
+        if ee.get("debate_skipped") or ee.get("early_synthesis"):
+            notes = ([f"DEBATE SKIPPED ({ee['debate_skipped'].upper()})"] if ee.get("debate_skipped") else []) + (["EARLY SEELE SYNTHESIS"] if ee.get("early_synthesis") else [])
+            saved = f"~{ee['saved_seconds']:.1f}s" + (f", ~{ee['saved_tokens']:,} TOKENS" if ee.get("saved_tokens") else "")
+            st.caption(f"⏩ {' / '.join(notes)} — SAVED {saved}")
+        dr = res.get("debate") or {}
+        if len(dr.get("round_seconds", [])) == 2:
+            st.caption(f"🗣️ DEBATE EXCHANGE: {dr['exchange'].upper()}{' (EXCLUDING SELF)' if dr['exclude_self'] else ''} — "
+                       f"~{dr['opinion_tokens']:,} OPINION TOKENS (FULL TEXT ~{dr['full_text_opinion_tokens']:,}) / ROUND 2 {dr['round_seconds'][1]:.1f}s")
         st.markdown("<br>", unsafe_allow_html=True)
-        cols = st.columns(3); colors = {"是認": "#00FF00", "条件付是認": "#FFFF00", "否認": "#FF0000"}
-        
-        # Checking if we should animate (newly generated)
-        should_animate = st.session_state.get("show_animation", False)
-        
-        if should_animate:
-            # Sequential Animation (Melchior -> Balthasar -> Casper)
-            placeholders = [cols[i].empty() for i in range(3)]
-            full_texts = [r[1] for r in res["magi_results"]]
-            
-            # 1. Render Headers first
-            for i, r in enumerate(res["magi_results"]):
-                c = colors.get(r[2], "#FFF")
-                # Initial state: empty body
-                html = f'<div class="magi-panel" style="border-color:{c};"><div class="magi-header" style="color:{c};">{r[0]}</div><div style="font-size:0.9em; white-space:pre-wrap; color:#EEE;"></div></div>'
-                placeholders[i].markdown(html, unsafe_allow_html=True)
-            
-            # 2. Animate one by one
-            for i, r in enumerate(res["magi_results"]):
-                c = colors.get(r[2], "#FFF")
-                full_text = r[1]
-                # Simulate typing
-                chunk_size = 3 # chars per frame
-                for char_i in range(0, len(full_text) + 1, chunk_size):
-                    current_text = full_text[:char_i]
-                    html = f'<div class="magi-panel" style="border-color:{c};"><div class="magi-header" style="color:{c};">{r[0]}</div><div style="font-size:0.9em; white-space:pre-wrap; color:#EEE;">{current_text}_</div></div>' # Add cursor
-                    placeholders[i].markdown(html, unsafe_allow_html=True)
-                    time.sleep(0.01) # Tuning speed
-                
-                # Finalize without cursor and with vote/condition
-                cond_html = (f'<div style="margin-top:10px; border:1px dashed #FFFF00; padding:5px; font-size:0.8em; color:#FFFF00;">CONDITION: {r[3]}</div>' if r[3] else "")
-                final_html = f'<div class="magi-panel" style="border-color:{c};"><div class="magi-header" style="color:{c};">{r[0]}</div><div style="font-size:0.9em; white-space:pre-wrap; color:#EEE;">{full_text}</div>{cond_html}<div class="magi-vote" style="border-color:{c}; color:{c};">{r[2]}</div></div>'
-                placeholders[i].markdown(final_html, unsafe_allow_html=True)
-            
-            st.session_state.show_animation = False # Turn off animation for future re-renders
-            
-        else:
-            # Static Render
-            for i, r in enumerate(res["magi_results"]):
-                c = colors.get(r[2], "#FFF")
-                cols[i].markdown(f'<div class="magi-panel" style="border-color:{c};"><div class="magi-header" style="color:{c};">{r[0]}</div><div style="font-size:0.9em; white-space:pre-wrap; color:#EEE;">{r[1]}</div>' + (f'<div style="margin-top:10px; border:1px dashed #FFFF00; padding:5px; font-size:0.8em; color:#FFFF00;">CONDITION: {r[3]}</div>' if r[3] else "") + f'<div class="magi-vote" style="border-color:{c}; color:{c};">{r[2]}</div></div>', unsafe_allow_html=True)
+        cols = st.columns(3)
+        for i, r in enumerate(res["magi_results"]):
+            cols[i].markdown(panel_html(r[0], r[1], r[2], r[3]), unsafe_allow_html=True)
         if res["seele_summary"]:
-            st.markdown(f'<div style="border:2px double #FF4500; background:#0a0500; padding:25px; margin-bottom:20px; margin-top:30px;"><h2 style="color:#FF4500; text-align:center;">SEELE SUMMARY</h2><p style="white-space:pre-wrap; color:#FF8C00;">{res["seele_summary"]}</p></div>', unsafe_allow_html=True)
+            st.markdown(seele_html(res["seele_summary"]), unsafe_allow_html=True)
             
             # Action Buttons
             st.markdown("### ⚡ ACTION EXECUTION")
@@ -112,10 +126,15 @@ def render_main():
             with c1:
                 if st.button("EXECUTE: SEND TO SLACK", use_container_width=True):
                     if magi_core.execute_webhook_action("slack", question, res["seele_summary"]):
-                        st.success("TRANSMISSION COMPLETE: SLACK")
+                        st.success("TRANSMISSION QUEUED: SLACK")
                     else: st.error("TRANSMISSION FAILED: CHECK SLACK CONFIG")
             with c2:
                 if st.button("EXECUTE: SEND TO DISCORD", use_container_width=True):
                     if magi_core.execute_webhook_action("discord", question, res["seele_summary"]):
-                        st.success("TRANSMISSION COMPLETE: DISCORD")
+                        st.success("TRANSMISSION QUEUED: DISCORD")
                     else: st.error("TRANSMISSION FAILED: CHECK DISCORD CONFIG")
+            with c3:
+                if st.button("EXECUTE: BROADCAST ALL", use_container_width=True):
+                    sent = magi_core.broadcast_webhook(question, res["seele_summary"])
+                    if sent: st.success(f"TRANSMISSION QUEUED: {', '.join(w.upper() for w in sent)}")
+                    else: st.error("TRANSMISSION FAILED: NO ACTIVE WEBHOOKS")